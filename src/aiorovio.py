@@ -0,0 +1,388 @@
+"""
+Non-blocking access to Rovios from a single event loop.
+
+AsyncRovio mirrors the Rovio commands, but instead of blocking until the Rovio
+answers, each command returns a rovio.Future at once.  The requests are driven
+by an asyncore event loop, so one thread can talk to dozens of Rovios at the
+same time.  URLs and responses are built and parsed by the Rovio class, so the
+results are the same as those of the blocking commands.
+
+Example:
+
+  robots = [AsyncRovio('r%d' % i, '192.168.0.%d' % (100 + i))
+            for i in range(10)]
+  reports = gather([r.get_report() for r in robots])
+
+Classes:
+  - AsyncRovio: non-blocking interface to one Rovio
+
+Module Functions:
+  - loop: run the event loop until it has nothing left to do
+  - gather: run the event loop until the given futures complete
+
+"""
+
+import asyncore
+import socket
+import sys
+import time
+import urllib2
+import mimetools
+import StringIO
+
+import rovio
+
+def loop(timeout=0.05, map=None):
+    """
+    Run the event loop until every outstanding request has completed.
+
+    Requests still unanswered at their deadline fail with
+    rovio.TimeoutError.
+
+    Parameters:
+      - timeout: poll timeout in seconds (default 0.05)
+      - map:     asyncore socket map (default the global asyncore map)
+
+    """
+    if map is None:
+        map = asyncore.socket_map
+    while map:
+        asyncore.loop(timeout=timeout, use_poll=True, map=map, count=1)
+        _expire(map)
+
+def gather(futures, timeout=None, return_exceptions=False, map=None):
+    """
+    Run the event loop until all futures are done and return their results.
+
+    Parameters:
+      - futures:           sequence of futures returned by AsyncRovio commands
+      - timeout:           give up after this many seconds (default None)
+      - return_exceptions: put exceptions in the result list instead of
+                           raising the first one (default False)
+      - map:               asyncore socket map (default the global asyncore
+                           map)
+
+    Return a list of results in the same order as futures.  Requests
+    unanswered at their own deadline fail with rovio.TimeoutError.  If
+    timeout expires first, the requests of the futures still pending are
+    abandoned (their futures fail with rovio.TimeoutError), and
+    rovio.TimeoutError is raised.
+
+    """
+    if map is None:
+        map = asyncore.socket_map
+    if timeout is not None:
+        deadline = time.time() + timeout
+    pending = [f for f in futures if not f.done()]
+    while pending:
+        if not map:
+            # nothing left in the loop that could complete them
+            break
+        if timeout is None:
+            wait = 0.05
+        else:
+            wait = min(0.05, deadline - time.time())
+            if wait <= 0:
+                _abandon(map, pending)
+                raise rovio.TimeoutError('gave up after %g s' % timeout)
+        asyncore.loop(timeout=wait, use_poll=True, map=map, count=1)
+        _expire(map)
+        pending = [f for f in pending if not f.done()]
+    results = []
+    for f in futures:
+        e = f.exception(0)
+        if e is not None and not return_exceptions:
+            raise e
+        results.append(e if e is not None else f.result(0))
+    return results
+
+def _expire(map):
+    """Fail the requests in map whose deadline has passed."""
+    now = time.time()
+    for obj in map.values():
+        if (isinstance(obj, _HTTPRequest) and obj.deadline is not None and
+            obj.deadline <= now):
+            obj._time_out()
+
+def _abandon(map, futures):
+    """Close the requests in map of futures, failing them."""
+    futures = set(futures)
+    for obj in map.values():
+        if isinstance(obj, _HTTPRequest) and obj._future in futures:
+            obj._fail(rovio.TimeoutError('request to %s abandoned' %
+                                         obj._rovio.name))
+
+class AsyncRovio(rovio.Rovio):
+
+    """
+    A non-blocking interface to one Rovio.
+
+    Every Rovio command is available and takes the same arguments, but returns
+    a rovio.Future that completes with the command's usual result once the
+    event loop has run (see gather and loop).  Network and HTTP errors
+    complete the future with rovio.ConnectError or urllib2.HTTPError, like
+    the blocking commands raise them.  The exceptions are stream_video and
+    drive_sequence, which hold a connection open for their duration and
+    raise rovio.RovioError here; use a Rovio for them.
+
+    Each command opens its own connection, so commands to the same Rovio run
+    concurrently.  Redirects are not followed.
+
+    As with the blocking commands, a request fails if it is not answered
+    within timeout seconds (or those of timeouts for its action), here with
+    rovio.TimeoutError; the deadlines are checked by loop and gather.
+    Requests are reported to the breaker and the recorder like those of
+    the blocking commands, and while the breaker is open, commands fail at
+    once with rovio.CircuitOpenError.
+
+    Properties:
+      - map: asyncore socket map the requests are run in (read-only)
+
+    """
+
+    def get_map(self): return self._map
+    map = property(get_map, doc="""asyncore socket map (read-only)""")
+
+    def __init__(self, name, host, username=None, password=None, port=80,
+                 map=None, timeout=rovio.DEFAULT_TIMEOUT, retries=2):
+        """
+        Initialize a new non-blocking Rovio interface.
+
+        Parameters:
+          - name:     name of this Rovio mobile webcam
+          - host:     hostname or IP address
+          - username: HTTP Auth name (default None)
+          - password: HTTP Auth password (default None)
+          - port:     HTTP port (default 80)
+          - map:      asyncore socket map (default the global asyncore map)
+          - timeout:  seconds before a request fails (default
+                      rovio.DEFAULT_TIMEOUT, None waits forever)
+          - retries:  as for Rovio, although requests are not retried
+                      (default 2)
+
+        """
+        rovio.Rovio.__init__(self, name, host, username, password, port,
+                             pool_size=0, timeout=timeout, retries=retries)
+        if map is None:
+            map = asyncore.socket_map
+        self._map = map
+
+    def _request(self, page, handler=None, buffers=None, idempotent=False,
+                 ordered=None):
+        """
+        Start a request for page and return a future of its result.
+
+        Requests are not retried or serialized, so idempotent and ordered
+        are ignored.
+
+        """
+        if buffers is not None:
+            # responses are assembled from received chunks anyway
+            handler = buffers.copy
+        future = rovio.Future()
+        future.set_running_or_notify_cancel()
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            future.set_exception(rovio.CircuitOpenError(self))
+            return future
+        timeout = self.timeout
+        if self.timeouts:
+            timeout = self.timeouts.get(rovio._action_label(page), timeout)
+        deadline = None if timeout is None else time.time() + timeout
+        _HTTPRequest(self, page, handler, future, deadline)
+        return future
+
+    def stream_video(self, *args, **kwargs):
+        """Raise rovio.RovioError: streams block, use a Rovio."""
+        raise rovio.RovioError('%s cannot stream video without blocking' %
+                               self.name)
+
+    def drive_sequence(self, *args, **kwargs):
+        """Raise rovio.RovioError: sequences block, use a Rovio."""
+        raise rovio.RovioError('%s cannot drive a sequence without blocking' %
+                               self.name)
+
+class _HTTPRequest(asyncore.dispatcher):
+
+    """One HTTP/1.0 GET request, completing a future with its response."""
+
+    def __init__(self, rovio_, page, handler, future, deadline=None):
+        asyncore.dispatcher.__init__(self, map=rovio_.map)
+        self.deadline = deadline
+        self._rovio = rovio_
+        self._page = page
+        self._handler = handler
+        self._future = future
+        self._sent = time.time()
+        self._connected = None
+        self._first_byte = None
+        lines = ['GET /%s HTTP/1.0' % page,
+                 'Host: %s' % rovio_.host,
+                 'Connection: close']
+        for item in rovio_._headers.items():
+            lines.append('%s: %s' % item)
+        self._out = '\r\n'.join(lines) + '\r\n\r\n'
+        self._in = []
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect((rovio_.host, rovio_.port))
+        except socket.error, e:
+            self._failed(rovio.ConnectError(rovio_, e))
+
+    def handle_connect(self):
+        self._connected = time.time()
+
+    def writable(self):
+        return bool(self._out) or not self.connected
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            if self._first_byte is None:
+                self._first_byte = time.time()
+            self._in.append(data)
+
+    def handle_close(self):
+        self.close()
+        if not self._future.done():
+            self._finish(''.join(self._in))
+
+    def handle_error(self):
+        self._failed(rovio.ConnectError(self._rovio, sys.exc_info()[1]))
+
+    def _time_out(self):
+        """Fail the request for not being answered before its deadline."""
+        self._failed(rovio.TimeoutError(
+            'No response from %s (host: %s) to %s' %
+            (self._rovio.name, self._rovio.host, self._page)))
+
+    def _failed(self, exception):
+        """Fail the request and report the failure like Rovio does."""
+        if not self._future.done():
+            self._rovio._account(self._page, self._sent, 0, None)
+        self._fail(exception)
+
+    def _fail(self, exception):
+        self.close()
+        if not self._future.done():
+            self._future.set_exception(exception)
+
+    def _finish(self, data):
+        """Parse the raw HTTP response and complete the future."""
+        head, sep, body = data.partition('\r\n\r\n')
+        status_line, _, header_text = head.partition('\r\n')
+        try:
+            version, status, reason = (status_line.split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            self._rovio._account(self._page, self._sent, 0, None)
+            self._future.set_exception(urllib2.URLError(
+                'bad status line: %r' % status_line))
+            return
+        now = time.time()
+        connected = self._connected or self._sent
+        first_byte = self._first_byte or now
+        self._rovio._account(self._page, self._sent, status, body,
+                             {'connect': connected - self._sent,
+                              'ttfb': first_byte - connected,
+                              'body': now - first_byte})
+        if not 200 <= status < 300:
+            headers = mimetools.Message(StringIO.StringIO(header_text))
+            self._future.set_exception(urllib2.HTTPError(
+                self._rovio._base_url + self._page, status, reason, headers,
+                None))
+            return
+        try:
+            if self._handler is None:
+                result = body
+            else:
+                start = time.time()
+                result = self._handler(body)
+                if rovio.metrics is not None:
+                    rovio.metrics.observe(self._rovio.name,
+                                          rovio._action_label(self._page),
+                                          'parse', time.time() - start)
+        except Exception, e:
+            self._future.set_exception(e)
+        else:
+            self._future.set_result(result)
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # drive a few dozen Rovios against a local stub from one event loop
+    import simulator
+    server = simulator.StubServer().start()
+    robots = [AsyncRovio('stub%d' % i, server.host, port=server.port)
+              for i in range(30)]
+    start = time.time()
+    reports = gather([r.get_report() for r in robots])
+    codes = gather([r.forward() for r in robots] +
+                   [r.change_framerate(20) for r in robots])
+    print '%d reports, %d commands in %.3f s' % (len(reports), len(codes),
+                                                  time.time() - start)
+    assert all(rep['resolution'] == [640, 480] for rep in reports)
+    assert gather([robots[0].get_path_list()]) == [[]]
+    # commands are recorded like the blocking ones
+    import os
+    import shutil
+    import tempfile
+    import replay
+    tmp = tempfile.mkdtemp()
+    recorder = replay.CommandRecorder(os.path.join(tmp, 'async.rcl'))
+    recorder.attach(robots[0])
+    gather([robots[0].get_report(), robots[0].forward()])
+    recorder.close()
+    log = replay.CommandLog(os.path.join(tmp, 'async.rcl'))
+    print 'recorded:', [c.page for c in log]
+    assert len(log) == 2 and all(c.status == 200 for c in log)
+    log.close()
+    shutil.rmtree(tmp)
+    # and timed into rovio.metrics
+    import metrics
+    m = metrics.enable()
+    gather([r.get_report() for r in robots])
+    stats = m.snapshot()['stub0']['rev.cgi:1']
+    print 'timed:', ', '.join('%s %.2f ms' % (p, 1000 * stats[p]['p50'])
+                              for p in metrics.PHASES)
+    assert all(stats[phase]['count'] == 1 for phase in metrics.PHASES)
+    metrics.disable()
+    server.stop()
+    # a Rovio that accepts connections but never answers
+    silent = socket.socket()
+    silent.bind(('127.0.0.1', 0))
+    silent.listen(16)
+    mute = AsyncRovio('mute', '127.0.0.1', port=silent.getsockname()[1],
+                      timeout=0.2)
+    mute.breaker.threshold = 2
+    start = time.time()
+    results = gather([mute.get_report(), mute.get_status()],
+                     return_exceptions=True)
+    print 'silent Rovio: %s in %.2f s' % (
+        [e.__class__.__name__ for e in results], time.time() - start)
+    assert all(isinstance(e, rovio.TimeoutError) for e in results)
+    assert mute.breaker.state == rovio.CircuitBreaker.OPEN
+    assert isinstance(mute.get_report().exception(0), rovio.CircuitOpenError)
+    mute.breaker.reset()
+    mute.timeout = None
+    future = mute.get_report()
+    try:
+        gather([future], timeout=0.1)
+    except rovio.TimeoutError:
+        pass
+    assert isinstance(future.exception(0), rovio.TimeoutError)
+    assert not mute.map
+    for blocking in (mute.stream_video, mute.drive_sequence):
+        try:
+            blocking([(1, 1, 100)])
+        except rovio.RovioError:
+            pass
+        else:
+            assert False, '%s did not refuse to block' % blocking.__name__
+    silent.close()
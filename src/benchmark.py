@@ -0,0 +1,373 @@
+"""
+Benchmarks for the PyRovio client against local simulated Rovios.
+
+Run as a script to print the results, and optionally write them as JSON for
+tracking regressions between versions:
+
+  python benchmark.py [-n requests] [-o results.json]
+
+The benchmarks use simulated Rovios without network latency, so they measure
+the client's own costs.  Random inputs are seeded, so runs are comparable.
+
+Module Functions:
+  - percentile: percentile of a sorted list of samples
+  - bench_requests: time a request function and summarize the latencies
+  - bench_latency: latency of single commands to one Rovio
+  - bench_pool: compare urllib2 requests with pooled keep-alive requests
+  - bench_fleet: throughput of commands to many Rovios
+  - bench_images: compare get_image with get_image_into a FrameRing
+  - bench_parser: compare the response parser with the original parser
+  - bench_decode: compare get_report dictionaries with Report records
+  - bench_controller: scheduling jitter of a RovioController
+  - run_all: run every benchmark and return the results
+
+"""
+
+import json
+import math
+import optparse
+import platform
+import random
+import sys
+import time
+
+import aiorovio
+import fleet
+import rovio
+import simulator
+import video
+
+def percentile(samples, p):
+    """Return the p-th percentile (0--100) of a sorted list of samples."""
+    if not samples:
+        return 0.0
+    k = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[k]
+
+def bench_requests(fn, n):
+    """
+    Call fn n times and summarize its latency.
+
+    Return a dict with requests per second and p50/p99 latency in ms.
+
+    """
+    samples = []
+    start = time.time()
+    for i in xrange(n):
+        t0 = time.time()
+        fn()
+        samples.append((time.time() - t0) * 1000.0)
+    elapsed = time.time() - start
+    samples.sort()
+    return {'requests': n,
+            'requests_per_sec': n / elapsed,
+            'p50_ms': percentile(samples, 50),
+            'p99_ms': percentile(samples, 99)}
+
+def bench_latency(n=1000):
+    """
+    Time single commands to one Rovio over the connection pool.
+
+    Return a dict of results keyed by command.
+
+    """
+    server = simulator.StubServer().start()
+    try:
+        r = rovio.Rovio('bench', server.host, port=server.port)
+        results = dict()
+        results['manual_drive'] = bench_requests(r.stop, n)
+        results['get_report'] = bench_requests(r.get_report, n)
+        results['get_report_record'] = bench_requests(
+            lambda: r.get_report(record=True), n)
+        results['get_status'] = bench_requests(r.get_status, n)
+        results['get_MCU_report'] = bench_requests(r.get_MCU_report, n)
+        r.pool.close()
+        del rovio.rovios[r.name]
+        return results
+    finally:
+        server.stop()
+
+def bench_pool(n=1000):
+    """
+    Compare one-connection-per-request urllib2 with the connection pool.
+
+    Return a dict of results keyed by 'urllib2' and 'pool'.
+
+    """
+    server = simulator.StubServer().start()
+    try:
+        r = rovio.Rovio('bench', server.host, port=server.port)
+        url = r._base_url + 'rev.cgi?Cmd=nav&action=18&drive=0&speed=1'
+        results = dict()
+        results['urllib2'] = bench_requests(lambda: r._urlopen(url), n)
+        results['pool'] = bench_requests(r.stop, n)
+        r.pool.close()
+        del rovio.rovios[r.name]
+        return results
+    finally:
+        server.stop()
+
+def bench_fleet(robots=20, n=20):
+    """
+    Measure the throughput of get_report to many Rovios at once.
+
+    Each of robots simulated Rovios gets n rounds of get_report, through a
+    fleet.RovioFleet (threads over the connection pools) and through
+    aiorovio.AsyncRovio (one event loop).  Return a dict of results keyed by
+    'fleet' and 'async', each with requests per second and p50/p99 round
+    latency in ms.
+
+    """
+    servers = simulator.start_fleet(robots)
+    try:
+        registry = dict()
+        for i, server in enumerate(servers):
+            name = 'bench%d' % i
+            registry[name] = rovio.Rovio(name, server.host, port=server.port)
+        results = dict()
+        f = fleet.RovioFleet(registry=registry, max_workers=robots)
+        res = bench_requests(lambda: f.call('get_report'), n)
+        f.shutdown()
+        res['requests_per_sec'] *= robots
+        res['robots'] = robots
+        results['fleet'] = res
+        clients = [aiorovio.AsyncRovio('async%d' % i, server.host,
+                                     port=server.port)
+                 for i, server in enumerate(servers)]
+        res = bench_requests(
+            lambda: aiorovio.gather([a.get_report() for a in clients]), n)
+        res['requests_per_sec'] *= robots
+        res['robots'] = robots
+        results['async'] = res
+        for r in registry.values() + clients:
+            r.pool.close()
+            del rovio.rovios[r.name]
+        return results
+    finally:
+        simulator.stop_fleet(servers)
+
+def bench_images(n=500):
+    """
+    Compare get_image with get_image_into a reusable FrameRing.
+
+    Return a dict of results keyed by 'get_image' and 'get_image_into', each
+    with requests per second, MB/s and the number of frame buffers allocated.
+
+    """
+    server = simulator.StubServer().start()
+    try:
+        r = rovio.Rovio('bench', server.host, port=server.port)
+        size = len(r.get_image())
+        ring = video.FrameRing(slots=4, size=size)
+        results = dict()
+        results['get_image'] = bench_requests(r.get_image, n)
+        results['get_image']['allocations'] = n
+        results['get_image_into'] = bench_requests(
+            lambda: r.get_image_into(ring), n)
+        results['get_image_into']['allocations'] = ring.allocations
+        for res in results.values():
+            res['mb_per_sec'] = res['requests_per_sec'] * size / 1e6
+        r.pool.close()
+        del rovio.rovios[r.name]
+        return results
+    finally:
+        server.stop()
+
+def _reference_parse(response):
+    """The original string-splitting response parser, for comparison."""
+    reply = dict()
+    rlst = response.split('|')
+    rlst[0:1] = rlst[0].splitlines()
+    for pair in rlst:
+        try:
+            (key,val) = pair.split('=')
+        except ValueError:
+            key = pair
+            val = None
+        key = key.strip()
+        if val is not None:
+            val = val.strip()
+        if key != 'flags':
+            try:
+                val = int(val)
+            except ValueError:
+                pass
+            except TypeError:
+                pass
+        reply[key] = val
+    return reply
+
+def _moving_reports(n):
+    """Return n get_report responses with varying position and heading."""
+    rnd = random.Random(42)
+    reports = []
+    for i in xrange(n):
+        r = simulator.REPORT.replace('x=-1339', 'x=%d' %
+                                     rnd.randint(-32767, 32767))
+        r = r.replace('y=-2296', 'y=%d' % rnd.randint(-32767, 32767))
+        r = r.replace('theta=-2.969', 'theta=%.3f' %
+                      rnd.uniform(-math.pi, math.pi))
+        reports.append(r)
+    return reports
+
+def bench_parser(n=20000):
+    """
+    Compare the response parser with the original parser.
+
+    Each parser parses the recorded responses (and a series of reports of a
+    moving Rovio) n times.  Return a dict of results keyed by response name,
+    each with ops per second for 'reference' and 'parser'.
+
+    """
+    r = rovio.Rovio('bench', 'localhost')
+    del rovio.rovios[r.name]
+    samples = {'report': [simulator.REPORT],
+               'moving_report': _moving_reports(1000),
+               'status': [simulator.STATUS],
+               'mcu_report': [simulator.MCU_REPORT]}
+    results = dict()
+    for name, responses in sorted(samples.items()):
+        for response in responses:
+            if r._parse_response(response) != _reference_parse(response):
+                raise AssertionError('parsers differ on %r' % response)
+        res = dict()
+        for label, parse in (('reference', _reference_parse),
+                             ('parser', r._parse_response)):
+            m = len(responses)
+            start = time.time()
+            for i in xrange(n):
+                parse(responses[i % m])
+            res[label] = n / (time.time() - start)
+        res['speedup'] = res['parser'] / res['reference']
+        results[name] = res
+    return results
+
+def bench_decode(n=20000):
+    """
+    Compare decoding get_report responses into dictionaries and Reports.
+
+    Return a dict of results keyed by 'dict' and 'record', each with ops per
+    second and the bytes of memory held per decoded report.
+
+    """
+    r = rovio.Rovio('bench', 'localhost')
+    del rovio.rovios[r.name]
+    responses = _moving_reports(1000)
+    results = dict()
+    for label, decode in (('dict', r._decode_report),
+                          ('record', r._decode_report_record)):
+        start = time.time()
+        for i in xrange(n):
+            decode(responses[i % 1000])
+        ops = n / (time.time() - start)
+        d = decode(responses[0])
+        size = sys.getsizeof(d)
+        if isinstance(d, dict):
+            size += sum(sys.getsizeof(v) for v in d.values()
+                        if isinstance(v, list))
+        results[label] = {'ops_per_sec': ops, 'bytes': size}
+    return results
+
+def bench_controller(duration=2.0, wait=0.02):
+    """
+    Measure the scheduling jitter of a RovioController.
+
+    The controller repeats manual_drive commands to a simulated Rovio every
+    wait seconds for duration seconds, while a second thread queues more
+    commands.  Return the controller's dispatch_jitter() statistics.
+
+    """
+    server = simulator.StubServer().start()
+    try:
+        r = rovio.Rovio('bench', server.host, port=server.port)
+        controller = rovio.RovioController(r)
+        controller.wait = wait
+        controller.start()
+        steps = 10
+        futures = controller.enqueue_all(
+            [(duration * 1000.0 / steps, r.forward, [])] * steps)
+        # concurrent queue traffic the controller must not stall on
+        for i in xrange(steps):
+            time.sleep(duration / steps)
+            futures.append(controller.enqueue(0, r.stop))
+        controller.wait_all(futures, duration * 2)
+        controller.stop()
+        controller.join()
+        results = controller.dispatch_jitter()
+        results['dispatches'] = sum(f.dispatches for f in futures)
+        r.pool.close()
+        del rovio.rovios[r.name]
+        return results
+    finally:
+        server.stop()
+
+def run_all(n=1000):
+    """
+    Run every benchmark with n requests each (parsers: 20 n parses).
+
+    Return a dict of the results keyed by benchmark, plus 'info' about the
+    run.
+
+    """
+    return {'info': {'pyrovio': rovio.__version__,
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'time': time.time(),
+                     'requests': n},
+            'latency': bench_latency(n),
+            'pool': bench_pool(n),
+            'fleet': bench_fleet(20, max(1, n // 20)),
+            'images': bench_images(n),
+            'parser': bench_parser(20 * n),
+            'decode': bench_decode(20 * n),
+            'controller': bench_controller()}
+
+def _print_results(title, results):
+    print title
+    for name, res in sorted(results.items()):
+        print ('  %-17s %8.1f req/s   p50 %6.3f ms   p99 %6.3f ms' %
+               (name, res['requests_per_sec'], res['p50_ms'], res['p99_ms']))
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog [-n requests] [-o file]')
+    parser.add_option('-n', '--requests', type='int', default=1000,
+                      help='requests per benchmark (default 1000)')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results to FILE as JSON')
+    options, args = parser.parse_args()
+    if args:
+        # the old form: benchmark.py [requests]
+        options.requests = int(args[0])
+    n = options.requests
+    results = run_all(n)
+    _print_results('single commands, %d requests' % n, results['latency'])
+    _print_results('manual_drive(stop), %d requests' % n, results['pool'])
+    _print_results('get_report to %d Rovios, %d rounds' %
+                   (results['fleet']['fleet']['robots'],
+                    results['fleet']['fleet']['requests']), results['fleet'])
+    _print_results('camera image, %d requests' % n, results['images'])
+    for name, res in sorted(results['images'].items()):
+        print ('  %-17s %6.2f MB/s   %d frame buffers allocated' %
+               (name, res['mb_per_sec'], res['allocations']))
+    print 'response parser, %d parses' % (20 * n)
+    for name, res in sorted(results['parser'].items()):
+        print ('  %-17s %8.0f parses/s (reference %8.0f)   %.2fx' %
+               (name, res['parser'], res['reference'], res['speedup']))
+    print 'get_report decoding, %d reports' % (20 * n)
+    for name, res in sorted(results['decode'].items()):
+        print ('  %-17s %8.0f reports/s   %d bytes each' %
+               (name, res['ops_per_sec'], res['bytes']))
+    res = results['controller']
+    print 'controller dispatch, %d dispatches' % res['dispatches']
+    print ('  lateness mean %.3f ms   p99 %.3f ms   max %.3f ms' %
+           (res['mean_ms'], res['p99_ms'], res['max_ms']))
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
@@ -0,0 +1,340 @@
+"""
+Change notifications for a Rovio's reports.
+
+Most get_report fields (brightness, resolution, volumes, ddns_state,
+privilege) hardly ever change between polls, yet a consumer of whole reports
+reprocesses every field of every report.  A ChangeFeed polls get_report at a
+fixed rate, compares each report with the previous one field by field, and
+calls each subscriber only with the changes to the fields it subscribed to.
+A subscriber can also ask for its changes to be coalesced: rapid changes are
+then merged and delivered at most once per coalesce seconds.
+
+Example:
+
+  feed = ChangeFeed(rovio, interval=0.2)
+  feed.subscribe(show_battery, fields=['battery', 'charging'])
+  feed.subscribe(redraw_map, fields=['x', 'y', 'theta'], coalesce=1.0)
+  feed.start()
+
+  def show_battery(changes, report):
+      old, new = changes['battery']
+      ...
+
+A subscriber's first notification has every field it subscribed to, with
+None as the old values.  Fields are those of rovio.Report, and resolution,
+head_position and ac_freq are reported decoded.
+
+Classes:
+  - ChangeFeed: polls a Rovio's reports and notifies subscribers of changes
+  - Subscription: a subscriber's fields and pending changes
+
+Module Functions:
+  - diff: return the fields that differ between two reports
+
+"""
+
+import threading
+import time
+
+import rovio
+
+_DECODED = ('resolution', 'head_position', 'ac_freq')
+
+def diff(old, new, fields=None):
+    """
+    Return the changes between two reports.
+
+    Parameters:
+      - old:    the earlier rovio.Report (or None)
+      - new:    the later rovio.Report
+      - fields: names of the fields to compare (default None, all of them)
+
+    Return a dictionary mapping the names of the fields that differ to
+    (old value, new value) pairs.
+
+    """
+    if fields is None:
+        fields = rovio.Report._fields
+    if old is None:
+        return dict([(name, (None, getattr(new, name))) for name in fields])
+    if old == new:
+        return {}
+    changes = dict()
+    for name in fields:
+        a = getattr(old, name)
+        b = getattr(new, name)
+        if a != b:
+            changes[name] = (a, b)
+    return changes
+
+def _index(name):
+    """Return the index in a Report of the field holding name."""
+    if name in _DECODED:
+        name = 'raw_' + name
+    try:
+        return rovio.Report._fields.index(name)
+    except ValueError:
+        raise rovio.RovioError('no report field %r' % name)
+
+class Subscription(object):
+
+    """
+    A subscriber of a ChangeFeed.
+
+    Attributes:
+      - fields:        names of the fields subscribed to
+      - coalesce:      seconds over which changes are merged (0 delivers
+                       each change at once)
+      - notifications: number of times the subscriber was called
+
+    """
+
+    def __init__(self, feed, fn, fields, coalesce):
+        self.fields = tuple(fields)
+        self.coalesce = coalesce
+        self.notifications = 0
+        self._feed = feed
+        self._fn = fn
+        self._indexes = frozenset([_index(name) for name in self.fields])
+        self._pending = dict()
+        self._started = False
+        self._last = 0.0
+
+    def cancel(self):
+        """Stop notifying the subscriber."""
+        self._feed._unsubscribe(self)
+
+    def _add(self, changed, old, new):
+        """Merge the changes of a new report into the pending changes."""
+        if not self._started:
+            self._started = True
+            for name in self.fields:
+                self._pending[name] = (None, getattr(new, name))
+            return
+        if changed.isdisjoint(self._indexes):
+            return
+        for name in self.fields:
+            b = getattr(new, name)
+            if name in self._pending:
+                a = self._pending[name][0]
+            else:
+                a = getattr(old, name)
+            if a != b:
+                self._pending[name] = (a, b)
+            else:
+                # changed back before it was delivered
+                self._pending.pop(name, None)
+
+    def _due(self):
+        """Return the time the pending changes are due (None if none)."""
+        if not self._pending:
+            return None
+        return self._last + self.coalesce
+
+    def _deliver(self, report, now):
+        """Call the subscriber with the pending changes."""
+        changes, self._pending = self._pending, dict()
+        self._last = now
+        self.notifications += 1
+        try:
+            self._fn(changes, report)
+        except Exception:
+            rovio.rlog.exception('Exception in change feed subscriber %r',
+                                 self._fn)
+
+class ChangeFeed(threading.Thread):
+
+    """
+    Polls a Rovio's reports and notifies subscribers of changed fields.
+
+    The feed polls get_report every interval seconds on its own thread (or
+    reads it from a poller.RovioPoller) and passes each report to update.
+    Subscribers are called on the feed's thread, with a dictionary mapping
+    each changed field to an (old value, new value) pair and the new
+    rovio.Report.  Failed polls are logged and counted.
+
+    Reports can also be passed to update without starting the thread.
+
+    Attributes:
+      - rovio:    the Rovio being polled (read-only)
+      - latest:   the last report (read-only)
+      - interval: seconds between polls
+      - coalesce: default seconds over which a subscriber's changes are
+                  merged
+      - polls:    number of reports received
+      - changes:  number of reports that differed from the previous one
+      - errors:   number of failed polls
+
+    """
+
+    def getRovio(self): return self._rovio
+    rovio = property(getRovio, doc="""Rovio being polled (read-only)""")
+
+    def getLatest(self): return self._latest
+    latest = property(getLatest, doc="""Last report received (read-only)""")
+
+    def __init__(self, rovio_, interval=1.0, coalesce=0.0, poller=None):
+        """
+        Initialize a change feed.
+
+        Parameters:
+          - rovio_:   the Rovio to poll
+          - interval: seconds between polls (default 1.0)
+          - coalesce: default seconds over which changes are merged
+                      (default 0, deliver each change at once)
+          - poller:   poller.RovioPoller to read the reports from (default
+                      None, request them from rovio_)
+
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._rovio = rovio_
+        self.interval = interval
+        self.coalesce = coalesce
+        self.polls = 0
+        self.changes = 0
+        self.errors = 0
+        self._poller = poller
+        self._latest = None
+        self._subscriptions = []
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+
+    def subscribe(self, fn, fields=None, coalesce=None):
+        """
+        Call fn(changes, report) when any of fields changes.
+
+        Parameters:
+          - fn:       function of the changes dictionary and the report
+          - fields:   names of the fields (default None, every field)
+          - coalesce: seconds over which changes are merged (default None,
+                      self.coalesce)
+
+        Return the Subscription.
+
+        """
+        if fields is None:
+            fields = rovio.Report._fields
+        if coalesce is None:
+            coalesce = self.coalesce
+        subscription = Subscription(self, fn, fields, coalesce)
+        with self._lock:
+            self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions
+                                   if s is not subscription]
+
+    def run(self):
+        next_poll = time.time()
+        while not self._stopped.isSet():
+            now = time.time()
+            if now >= next_poll:
+                self.poll()
+                next_poll += self.interval
+                now = time.time()
+                if next_poll < now:
+                    # fell behind; skip the missed polls
+                    next_poll = now
+            else:
+                self.flush(now)
+            wake = next_poll
+            for s in self._subscriptions:
+                due = s._due()
+                if due is not None and due < wake:
+                    wake = due
+            self._stopped.wait(max(0.0, wake - time.time()))
+
+    def stop(self):
+        """Stop polling."""
+        self._stopped.set()
+
+    def poll(self):
+        """Get a report now and notify the subscribers of its changes."""
+        try:
+            if self._poller is not None:
+                report = self._poller.get_report(max_staleness=self.interval,
+                                                 record=True)
+            else:
+                report = self._rovio.get_report(record=True)
+        except Exception:
+            self.errors += 1
+            rovio.rlog.exception('Error polling %s', self._rovio.name)
+            return
+        self.update(report)
+
+    def update(self, report, now=None):
+        """
+        Compare a report with the previous one and notify the subscribers.
+
+        Parameters:
+          - report: a rovio.Report
+          - now:    time of the report (default None, now)
+
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            old, self._latest = self._latest, report
+            self.polls += 1
+            if old is None or old == report:
+                changed = frozenset()
+            else:
+                changed = frozenset([i for i, (a, b)
+                                     in enumerate(zip(old, report))
+                                     if a != b])
+            if changed:
+                self.changes += 1
+            for s in self._subscriptions:
+                s._add(changed, old, report)
+            self.flush(now)
+
+    def flush(self, now=None):
+        """Deliver the pending changes that are due."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            report = self._latest
+            for s in self._subscriptions:
+                due = s._due()
+                if due is not None and due <= now:
+                    s._deliver(report, now)
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # watch a simulated Rovio drive: only the pose fields change
+    import simulator
+    server = simulator.StubServer().start()
+    r = rovio.Rovio('stub', server.host, port=server.port)
+    feed = ChangeFeed(r, interval=0.02)
+    seen = {'pose': [], 'settings': [], 'all': []}
+    feed.subscribe(lambda c, rep: seen['pose'].append(c), ['x', 'y', 'theta'],
+                   coalesce=0.2)
+    feed.subscribe(lambda c, rep: seen['settings'].append(c),
+                   ['brightness', 'resolution', 'speaker_volume'])
+    feed.subscribe(lambda c, rep: seen['all'].append(c))
+    feed.start()
+    time.sleep(0.1)
+    deadline = time.time() + 1.0
+    while time.time() < deadline:
+        r.forward(speed=5)
+        time.sleep(0.1)
+    r.change_resolution(1)
+    time.sleep(0.5)
+    feed.stop()
+    feed.join()
+    print '%d polls, %d with changes' % (feed.polls, feed.changes)
+    for name, notes in sorted(seen.items()):
+        print '%-8s %3d notifications' % (name, len(notes))
+    print 'settings:', seen['settings'][-1]
+    assert seen['settings'][0]['resolution'] == (None, (640, 480))
+    assert seen['settings'][-1] == {'resolution': ((640, 480), (320, 240))}
+    assert len(seen['pose']) < feed.changes
+    assert len(seen['all']) == feed.changes + 1
+    r.pool.close()
+    server.stop()
@@ -0,0 +1,250 @@
+"""
+Commands to many Rovios at once.
+
+A RovioFleet wraps the rovio.rovios registry (or a subset of its names) and
+sends a command to every Rovio in it concurrently, with a bounded number of
+worker threads.  Results and errors are collected per Rovio name, so one robot
+that is down or slow does not stop the others.
+
+Example:
+
+  fleet = RovioFleet(max_workers=32, timeout=2.0)
+  reports = fleet.call('get_report')
+  for name, report in reports.results.items(): ...
+  for name, error in reports.errors.items(): ...
+
+Classes:
+  - RovioFleet: concurrent fan-out of commands over many Rovios
+  - FleetResult: per-Rovio results and errors of a fleet command
+
+"""
+
+import Queue
+import threading
+import time
+
+import rovio
+
+class FleetResult(object):
+
+    """
+    Results of one fleet command.
+
+    Attributes:
+      - results: map of Rovio names to command results
+      - errors:  map of Rovio names to the exception the command raised
+                 (rovio.TimeoutError if it did not complete in time)
+
+    """
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+
+    def ok(self):
+        """Return True if the command succeeded on every Rovio."""
+        return not self.errors
+
+    def __getitem__(self, name):
+        """Return the result for name, or raise the error it got."""
+        if name in self.errors:
+            raise self.errors[name]
+        return self.results[name]
+
+    def __repr__(self):
+        return '<FleetResult: %d results, %d errors>' % (len(self.results),
+                                                         len(self.errors))
+
+class RovioFleet(object):
+
+    """
+    Sends commands to many Rovios concurrently.
+
+    At most max_workers commands are in flight at once.  A Rovio whose command
+    has been running longer than timeout seconds is reported with
+    rovio.TimeoutError; its worker is freed once the request returns (see
+    Rovio.timeout).  A Rovio that has dropped off the network fails fast with
+    rovio.CircuitOpenError once its circuit breaker opens, so it does not
+    hold up a worker per command.
+
+    Properties:
+      - names:       names of the Rovios in the fleet (read-only)
+      - max_workers: maximum number of concurrent commands (read-only)
+      - timeout:     default per-Rovio timeout in seconds (None for no limit)
+
+    """
+
+    def get_names(self):
+        if self._names is None:
+            return sorted(self._registry.keys())
+        return list(self._names)
+    names = property(get_names, doc="""Names of the Rovios in the fleet""")
+
+    def get_max_workers(self): return self._max_workers
+    max_workers = property(get_max_workers,
+                           doc="""Maximum number of concurrent commands""")
+
+    def __init__(self, names=None, registry=None, max_workers=16,
+                 timeout=None):
+        """
+        Initialize a new fleet.
+
+        Parameters:
+          - names:       names of the Rovios in the fleet (default None, every
+                         Rovio in the registry at the time of each command)
+          - registry:    map of names to Rovio objects (default rovio.rovios)
+          - max_workers: maximum number of concurrent commands (default 16)
+          - timeout:     default per-Rovio timeout in seconds (default None)
+
+        """
+        if registry is None:
+            registry = rovio.rovios
+        self._registry = registry
+        self._names = names
+        self._max_workers = max_workers
+        self.timeout = timeout
+        self._jobs = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+
+    def call(self, command, *args, **kwargs):
+        """
+        Run a command on every Rovio in the fleet and wait for the results.
+
+        Parameters:
+          - command: name of a Rovio method (e.g. 'get_report'), or a function
+                     called with each Rovio object
+          - args, kwargs: passed on to the command
+
+        Return a FleetResult.
+
+        """
+        return self.wait(self.submit(command, *args, **kwargs))
+
+    def batch(self, commands, timeout=None):
+        """
+        Run a sequence of commands on every Rovio in the fleet.
+
+        The commands run in order on each Rovio, and the Rovios run
+        concurrently.  A Rovio stops at its first failing command.
+
+        Parameters:
+          - commands: list of (command, args, kwargs) tuples, where command is
+                      as for call, and args and kwargs may be omitted
+          - timeout:  per-Rovio timeout for the whole sequence (default
+                      self.timeout)
+
+        Return a FleetResult whose results are lists of command results.
+
+        """
+        steps = [tuple(c) + ((), {})[len(c) - 1:] for c in commands]
+        def run(r):
+            return [_bind(r, cmd)(*args, **kwargs)
+                    for cmd, args, kwargs in steps]
+        return self.wait(self.submit(run), timeout)
+
+    def submit(self, command, *args, **kwargs):
+        """
+        Start a command on every Rovio in the fleet without waiting.
+
+        Return a map of Rovio names to rovio.Future objects.
+
+        """
+        futures = dict()
+        for name in self.names:
+            r = self._registry[name]
+            futures[name] = self._submit(_bind(r, command), args, kwargs)
+        return futures
+
+    def wait(self, futures, timeout=None):
+        """
+        Wait for the futures returned by submit and collect their results.
+
+        Parameters:
+          - futures: map of Rovio names to futures
+          - timeout: per-Rovio timeout in seconds, counted from when the
+                     Rovio's command started (default self.timeout)
+
+        Return a FleetResult.
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+        results = dict()
+        errors = dict()
+        pending = dict(futures)
+        with self._changed:
+            while pending:
+                now = time.time()
+                deadline = None
+                for name, f in pending.items():
+                    if f.done():
+                        e = f.exception(0)
+                        if e is None:
+                            results[name] = f.result(0)
+                        else:
+                            errors[name] = e
+                        del pending[name]
+                    elif timeout is not None and f.started is not None:
+                        if now - f.started >= timeout:
+                            errors[name] = rovio.TimeoutError()
+                            del pending[name]
+                        elif deadline is None or f.started < deadline:
+                            deadline = f.started
+                if pending:
+                    if deadline is None:
+                        self._changed.wait()
+                    else:
+                        self._changed.wait(deadline + timeout - now)
+        for name in errors:
+            futures[name].cancel()
+        return FleetResult(results, errors)
+
+    def shutdown(self):
+        """Stop the worker threads once the queued commands have run."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for w in workers:
+            self._jobs.put(None)
+        for w in workers:
+            w.join()
+
+    def _submit(self, fn, args, kwargs):
+        """Queue fn(*args, **kwargs) for a worker and return its future."""
+        future = rovio.Future()
+        future.started = None
+        self._jobs.put((future, fn, args, kwargs))
+        with self._lock:
+            if len(self._workers) < self._max_workers:
+                w = threading.Thread(target=self._work)
+                w.setDaemon(True)
+                w.start()
+                self._workers.append(w)
+        return future
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, fn, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._changed:
+                future.started = time.time()
+                self._changed.notifyAll()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            with self._changed:
+                self._changed.notifyAll()
+
+def _bind(r, command):
+    """Return the function that runs command on Rovio r."""
+    if callable(command):
+        return lambda *args, **kwargs: command(r, *args, **kwargs)
+    return getattr(r, command)
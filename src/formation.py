@@ -0,0 +1,410 @@
+"""
+Coordinated motion of several Rovios.
+
+Calling forward() on each robot of a group in turn starts them one round
+trip apart, tens of milliseconds per robot.  A Formation removes everything
+but the writes from the moment the robots must start:
+
+  - connect opens a keep-alive connection to each robot in advance and
+    warms it up with a request;
+  - prepare builds the HTTP request of a command for each robot in advance;
+  - release writes the prepared requests to all robots in one tight loop at
+    a scheduled instant, and then collects the responses.
+
+The time each request was written is measured, so the skew of each robot
+(how long after the instant its command went out) and the spread of a release
+are known.  run plays a RovioController-style script on the whole formation:
+each command is repeated every wait seconds for its duration, and every
+repeat is released to all robots at once, on a fixed schedule, so the robots
+stay in step for the whole script.
+
+Example:
+
+  formation = Formation(['rovio1', 'rovio2', 'rovio3'])
+  formation.connect()
+  release = formation.move('forward', speed=3)
+  print release.spread()
+  formation.run([(2000, 'forward', [3]), (1000, 'rotate_right', [5])])
+  formation.close()
+
+Classes:
+  - Formation: pre-connected Rovios released in lockstep
+  - Prepared: requests of a command prepared for every Rovio of a Formation
+  - Release: outcome of one release: send times, results and errors
+
+"""
+
+import copy
+import time
+import urllib2
+
+import rovio
+
+# get_status, the request that warms up a connection
+_WARM_UP = '/rev.cgi?Cmd=nav&action=22'
+
+class Release(object):
+
+    """
+    Outcome of one release of a command to a Formation.
+
+    Attributes:
+      - time:    the instant the commands were scheduled for
+      - sent:    map of Rovio names to the times their requests were written
+      - results: map of Rovio names to the command's result
+      - errors:  map of Rovio names to the exception the command raised
+
+    """
+
+    def __init__(self, time_):
+        self.time = time_
+        self.sent = dict()
+        self.results = dict()
+        self.errors = dict()
+        self._futures = []
+
+    def ok(self):
+        """Return True if the command succeeded on every Rovio."""
+        return not self.errors
+
+    def skew(self):
+        """Return a map of Rovio names to seconds sent after self.time."""
+        return dict([(name, t - self.time) for name, t in self.sent.items()])
+
+    def spread(self):
+        """Return the seconds between the first and last requests written."""
+        if not self.sent:
+            return 0.0
+        return max(self.sent.values()) - min(self.sent.values())
+
+    def __repr__(self):
+        return '<Release: %d sent, %d errors, spread %.3f ms>' % (
+            len(self.sent), len(self.errors), 1000 * self.spread())
+
+    def _collect(self, timeout):
+        """Wait for the responses and decode them into results."""
+        deadline = None if timeout is None else time.time() + timeout
+        for name, r, page, future, handler in self._futures:
+            if name in self.errors:
+                continue
+            try:
+                if deadline is None:
+                    status, reason, headers, body = future.result()
+                else:
+                    status, reason, headers, body = future.result(
+                        max(0, deadline - time.time()))
+                if not 200 <= status < 300:
+                    raise urllib2.HTTPError(r._base_url + page[1:], status,
+                                            reason, headers, None)
+                result = body if handler is None else handler(body)
+            except Exception, e:
+                self.errors[name] = e
+                self.results.pop(name, None)
+            else:
+                # a command of several requests results in its last one
+                self.results[name] = result
+        self._futures = []
+        return self
+
+class Prepared(object):
+
+    """
+    The requests of a command, prepared for every Rovio of a Formation.
+
+    A Prepared command can be released any number of times.
+
+    Attributes:
+      - command: the command's name (or function)
+      - requests: map of Rovio names to lists of (page, request bytes,
+                  response handler)
+
+    """
+
+    def __init__(self, command, requests):
+        self.command = command
+        self.requests = requests
+
+class Formation(object):
+
+    """
+    Rovios whose commands are released at the same instant.
+
+    Each Rovio gets its own keep-alive connection, separate from its
+    connection pool, on which requests are pipelined: a release writes the
+    next requests without waiting for the responses to the last ones.  The
+    order the Rovios are written to rotates from one release to the next, so
+    no robot is always last.
+
+    Commands are names of Rovio methods (or functions called with a Rovio)
+    that make their requests through Rovio._request, which is every command
+    except stream_video.  Results are the commands' usual results.  The
+    requests are reported to each Rovio's breaker, metrics and recorder as
+    if made through its pool, and a Rovio whose breaker is open is left out
+    of a release with a CircuitOpenError.  Drive and path commands are
+    ordered with each Rovio's other drive commands: a release takes the
+    Rovios' drive locks before its instant and lets go once it has written.
+
+    Properties:
+      - names: names of the connected Rovios (read-only)
+
+    Attributes:
+      - lead:    seconds from a release being asked for to its instant
+      - timeout: seconds to wait for the responses of a release (None for
+                 no limit)
+      - rtt:     map of Rovio names to the round trip time in seconds of
+                 the warm-up request
+
+    """
+
+    def get_names(self): return [name for name, r, conn in self._robots]
+    names = property(get_names, doc="""Names of the connected Rovios""")
+
+    def __init__(self, names=None, registry=None, lead=0.005, timeout=10.0):
+        """
+        Initialize a formation (call connect before releasing commands).
+
+        Parameters:
+          - names:    names of the Rovios (default None, every Rovio in the
+                      registry)
+          - registry: map of names to Rovio objects (default rovio.rovios)
+          - lead:     seconds from a release to its instant (default 0.005)
+          - timeout:  seconds to wait for responses (default 10)
+
+        """
+        if registry is None:
+            registry = rovio.rovios
+        if names is None:
+            names = sorted(registry.keys())
+        self._members = [(name, registry[name]) for name in names]
+        self._robots = []
+        self._turn = 0
+        self.lead = lead
+        self.timeout = timeout
+        self.rtt = dict()
+
+    def connect(self):
+        """
+        Open and warm up a connection to each Rovio.
+
+        Rovios that cannot be reached are left out of the formation.
+
+        Return a map of the names of those Rovios to their errors.
+
+        """
+        self.close()
+        errors = dict()
+        for name, r in self._members:
+            try:
+                conn = rovio._PipelinedConnection(r.host, r.port, r._headers,
+                                                  r.timeout, max_in_flight=64,
+                                                  account=r._account)
+            except Exception, e:
+                errors[name] = e
+                continue
+            start = time.time()
+            try:
+                conn.send(_WARM_UP).result(self.timeout)
+            except Exception, e:
+                conn.close()
+                errors[name] = e
+                continue
+            self.rtt[name] = time.time() - start
+            self._robots.append((name, r, conn))
+        for name, e in errors.items():
+            rovio.rlog.warning('Rovio %s left out of formation: %s', name, e)
+        return errors
+
+    def close(self):
+        """Close the connections."""
+        robots, self._robots = self._robots, []
+        for name, r, conn in robots:
+            conn.close()
+
+    def prepare(self, command, *args, **kwargs):
+        """
+        Prepare the requests of a command for every Rovio.
+
+        Parameters:
+          - command: name of a Rovio method (e.g. 'forward'), or a function
+                     called with each Rovio object
+          - args, kwargs: passed on to the command
+
+        Return a Prepared command.
+
+        """
+        requests = dict()
+        for name, r, conn in self._robots:
+            requests[name] = [(page, conn.prepare(page), handler)
+                              for page, handler in _capture(r, command, args,
+                                                            kwargs)]
+        return Prepared(command, requests)
+
+    def release(self, prepared, at=None, wait=True):
+        """
+        Send a prepared command to every Rovio at the same instant.
+
+        Parameters:
+          - prepared: a Prepared command
+          - at:       the instant (default None, lead seconds from now)
+          - wait:     wait for the responses (default True); if False, the
+                      Release has no results until it is collected
+
+        Return the Release.
+
+        """
+        if at is None:
+            at = time.time() + self.lead
+        robots = self._robots
+        k = self._turn % len(robots) if robots else 0
+        self._turn += 1
+        requests = prepared.requests
+        release = Release(at)
+        order = []
+        for robot in robots[k:] + robots[:k]:
+            name, r, conn = robot
+            if r.breaker is not None and not r.breaker.allow():
+                release.errors[name] = rovio.CircuitOpenError(r)
+            else:
+                order.append(robot)
+        # in name order, so that formations sharing Rovios cannot deadlock
+        locks = [r._drive_lock for name, r, conn in sorted(order)
+                 if [page for page, data, handler in requests[name]
+                     if rovio._is_ordered(page[1:])]]
+        for lock in locks:
+            lock.acquire()
+        try:
+            delay = at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            # nothing but the writes from here
+            for name, r, conn in order:
+                try:
+                    for page, data, handler in requests[name]:
+                        release._futures.append((name, r, page,
+                                                 conn.send_prepared(data),
+                                                 handler))
+                except Exception, e:
+                    release.errors[name] = e
+                release.sent[name] = time.time()
+        finally:
+            for lock in locks:
+                lock.release()
+        if wait:
+            release._collect(self.timeout)
+        return release
+
+    def move(self, command, *args, **kwargs):
+        """Prepare a command and release it at once; return the Release."""
+        return self.release(self.prepare(command, *args, **kwargs))
+
+    def run(self, script, wait=0.1, start=None):
+        """
+        Run a script of timed commands on the whole formation in lockstep.
+
+        Each command of the script is released to every Rovio every wait
+        seconds for its duration, and the next command starts when the
+        duration has passed, as with RovioController.  The releases follow
+        a fixed schedule from the start; if a release is late, the missed
+        repeats are skipped rather than sent in a burst.
+
+        Parameters:
+          - script: sequence of (millis, command, params) tuples: the
+                    duration in milliseconds, the command as for prepare,
+                    and a list or tuple of positional arguments or a dict of
+                    keyword arguments
+          - wait:   seconds between repeats (default 0.1)
+          - start:  time to start at (default None, lead seconds from now)
+
+        Return the list of Releases, in order.
+
+        """
+        steps = []
+        for millis, command, params in script:
+            if isinstance(params, dict):
+                prepared = self.prepare(command, **params)
+            else:
+                prepared = self.prepare(command, *params)
+            steps.append((millis / 1000.0, prepared))
+        if start is None:
+            start = time.time() + self.lead
+        releases = []
+        step_start = start
+        for duration, prepared in steps:
+            at = step_start
+            end = step_start + duration
+            while True:
+                releases.append(self.release(prepared, at, wait=False))
+                at += wait
+                now = time.time()
+                if at < now:
+                    # fell behind; skip the missed repeats
+                    at += (int((now - at) / wait) + 1) * wait
+                if at >= end:
+                    break
+            step_start = end
+        for release in releases:
+            release._collect(self.timeout)
+        return releases
+
+def _capture(r, command, args, kwargs):
+    """Return the (page, handler) requests command would make on r."""
+    requests = []
+    def capture(page, handler=None, buffers=None, idempotent=False,
+                ordered=None):
+        requests.append(('/' + page, handler))
+    clone = copy.copy(r)
+    clone._request = capture
+    if callable(command):
+        command(clone, *args, **kwargs)
+    else:
+        getattr(clone, command)(*args, **kwargs)
+    if not requests:
+        raise rovio.RovioError('%r makes no requests' % (command,))
+    return requests
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # start ten simulated Rovios serially, then as a formation
+    import simulator
+    servers = simulator.start_fleet(10, latency=0.01)
+    robots = [rovio.Rovio('sim%d' % i, s.host, port=s.port)
+              for i, s in enumerate(servers)]
+    names = [r.name for r in robots]
+    sent = []
+    for r in robots:
+        sent.append(time.time())
+        r.forward(speed=3)
+    print 'serial:    spread %7.3f ms' % (1000 * (sent[-1] - sent[0]))
+    formation = Formation(names)
+    assert not formation.connect()
+    release = formation.move('forward', speed=3)
+    print 'formation: spread %7.3f ms, worst skew %.3f ms' % (
+        1000 * release.spread(), 1000 * max(release.skew().values()))
+    assert release.ok() and set(release.results.values()) == set([0])
+    time.sleep(0.3)
+    before = [s.robot.pose for s in servers]
+    releases = formation.run([(1000, 'forward', [3]),
+                              (500, 'rotate_right', {'speed': 5})])
+    spreads = [r.spread() for r in releases]
+    print '%d releases, mean spread %.3f ms, max %.3f ms' % (
+        len(releases), 1000 * sum(spreads) / len(spreads),
+        1000 * max(spreads))
+    assert all(r.ok() for r in releases)
+    time.sleep(0.3)
+    moved = [(s.robot.pose.x - p.x, s.robot.pose.theta - p.theta)
+             for s, p in zip(servers, before)]
+    print 'x moved: %.3f--%.3f m' % (min(m[0] for m in moved),
+                                     max(m[0] for m in moved))
+    # idle connections outlive the robots' timeout
+    for r in robots:
+        r.timeout = 0.2
+    assert not formation.connect()
+    time.sleep(0.5)
+    assert formation.move('stop').ok()
+    formation.close()
+    for r in robots:
+        r.pool.close()
+    simulator.stop_fleet(servers)
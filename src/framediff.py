@@ -0,0 +1,236 @@
+"""
+Detecting camera frames that have not changed.
+
+When a Rovio is idle, consecutive camera images are nearly identical, and
+fetching and processing each of them is wasted work.  A FrameDiffer tells
+whether a frame differs from the last frame it let through: it decodes the
+JPEG at an eighth of its size (only the DC coefficient of each 8x8 block, so
+the decoding is cheap), scales the luminance down to a small thumbnail, and
+compares the thumbnails pixel by pixel.  Slow changes accumulate against the
+last frame let through, so a scene that drifts is eventually reported as
+changed.
+
+Example:
+
+  differ = FrameDiffer(threshold=3.0)
+  pipe = pipeline.FramePipeline(detect, differ=differ)
+  pipe.feed(watch(rovio, differ, min_interval=0.1, max_interval=2.0))
+
+watch fetches images with get_image and yields only the changed ones,
+fetching less and less often while the scene is static and at the full rate
+again as soon as it changes.  A differ passes the frame it has just let
+through again without comparing it, so watch and the pipeline can share it.
+
+The thumbnails are made with PIL, and compared with NumPy if it is installed.
+Without PIL, frames are compared by a hash of their bytes, so only identical
+frames are detected as unchanged.
+
+Classes:
+  - FrameDiffer: classifies frames as changed or unchanged
+
+Module Functions:
+  - watch: generate the changed camera images of a Rovio at an adaptive rate
+
+"""
+
+import hashlib
+import io
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import rovio
+
+class FrameDiffer(object):
+
+    """
+    Classifies camera frames as changed or unchanged.
+
+    A frame is changed if the mean absolute difference of its luminance
+    thumbnail from that of the last changed frame is more than threshold
+    (on a scale of 0--255).  The first frame is always changed, and so is a
+    frame that cannot be decoded.  Checking the last changed frame again
+    (the same object) returns True without counting or comparing it.
+
+    Attributes:
+      - mode:      'luminance' (with PIL) or 'hash' (read-only)
+      - threshold: mean luminance difference above which a frame changed
+      - size:      (width, height) of the thumbnails
+      - frames:    number of frames checked
+      - unchanged: number of frames found unchanged
+
+    """
+
+    def getMode(self): return self._mode
+    mode = property(getMode, doc="""'luminance' or 'hash' (read-only)""")
+
+    def __init__(self, threshold=3.0, size=(32, 24)):
+        """
+        Initialize a differ.
+
+        Parameters:
+          - threshold: mean luminance difference (0--255) above which a
+                       frame changed (default 3.0)
+          - size:      (width, height) of the thumbnails (default (32, 24))
+
+        """
+        self.threshold = threshold
+        self.size = tuple(size)
+        self.frames = 0
+        self.unchanged = 0
+        self._mode = 'hash' if Image is None else 'luminance'
+        self._reference = None
+        self._changed = None
+
+    def signature(self, frame):
+        """
+        Return the signature of a JPEG frame (a string or memoryview).
+
+        The signature is the bytes of the luminance thumbnail, or a digest
+        of the frame in hash mode.
+
+        """
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()
+        if Image is None:
+            return hashlib.sha1(frame).digest()
+        image = Image.open(io.BytesIO(frame))
+        # decode at the smallest scale at least twice the thumbnail's size
+        image.draft('L', (2 * self.size[0], 2 * self.size[1]))
+        return image.convert('L').resize(self.size, Image.BILINEAR).tobytes()
+
+    def difference(self, a, b):
+        """Return the mean absolute difference of two signatures (0--255)."""
+        if self._mode == 'hash' or len(a) != len(b):
+            return 0.0 if a == b else 255.0
+        if numpy is not None:
+            x = numpy.frombuffer(a, dtype=numpy.uint8).astype(numpy.int16)
+            y = numpy.frombuffer(b, dtype=numpy.uint8).astype(numpy.int16)
+            return float(numpy.abs(x - y).mean())
+        total = 0
+        for p, q in zip(bytearray(a), bytearray(b)):
+            total += abs(p - q)
+        return float(total) / len(a)
+
+    def check(self, frame):
+        """
+        Return True if a frame changed from the last changed frame.
+
+        A changed frame becomes the frame the next ones are compared with.
+
+        """
+        if frame is self._changed and frame is not None:
+            # already let through, e.g. by watch before a pipeline
+            return True
+        self.frames += 1
+        try:
+            signature = self.signature(frame)
+        except Exception:
+            rovio.rlog.exception('Error decoding frame for comparison')
+            self._changed = None
+            return True
+        if (self._reference is not None and
+            self.difference(self._reference, signature) <= self.threshold):
+            self.unchanged += 1
+            return False
+        self._reference = signature
+        self._changed = frame
+        return True
+
+    def reset(self):
+        """Forget the last changed frame, so the next frame is changed."""
+        self._reference = None
+        self._changed = None
+
+def watch(rovio_, differ=None, min_interval=0.1, max_interval=2.0,
+          backoff=1.5):
+    """
+    Generate the changed camera images of a Rovio, at an adaptive rate.
+
+    Images are fetched every min_interval seconds while the scene changes.
+    Each unchanged image multiplies the interval by backoff, up to
+    max_interval, and a changed image sets it back to min_interval; so a
+    change to a static scene is seen within max_interval seconds.
+
+    Parameters:
+      - rovio_:       the Rovio
+      - differ:       FrameDiffer to classify the images (default None, a
+                      new one)
+      - min_interval: seconds between fetches while the scene changes
+                      (default 0.1)
+      - max_interval: longest seconds between fetches (default 2.0)
+      - backoff:      factor the interval grows by per unchanged image
+                      (default 1.5)
+
+    """
+    if differ is None:
+        differ = FrameDiffer()
+    interval = min_interval
+    while True:
+        start = time.time()
+        frame = rovio_.get_image()
+        if differ.check(frame):
+            interval = min_interval
+            yield frame
+        else:
+            interval = min(max_interval, interval * backoff)
+        delay = interval - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # a static simulated camera: count the fetches with and without backoff
+    import threading
+    import simulator
+    server = simulator.StubServer().start()
+    r = rovio.Rovio('stub', server.host, port=server.port)
+    differ = FrameDiffer()
+    print 'mode:', differ.mode
+    frames = []
+    def consume():
+        try:
+            for frame in watch(r, differ, min_interval=0.05,
+                               max_interval=0.5):
+                frames.append(frame)
+        except rovio.ConnectError:
+            pass                         # the server has stopped
+    t = threading.Thread(target=consume)
+    t.setDaemon(True)
+    t.start()
+    time.sleep(3.0)
+    print '%d fetches in 3 s (%d at a fixed rate), %d frames yielded' % (
+        differ.frames, 3.0 / 0.05, len(frames))
+    assert len(frames) == 1
+    assert differ.unchanged == differ.frames - 1
+    assert differ.frames < 3.0 / 0.05 / 3
+    assert differ.check(simulator.JPEG[:-2] + '\x01' + simulator.JPEG[-2:])
+    r.pool.close()
+    server.stop()
+    # watch feeding a pipeline through the same differ loses no frame
+    import itertools
+    import pipeline
+    class Camera(object):
+        images = iter([simulator.JPEG[:-2] + chr(i) + simulator.JPEG[-2:]
+                       for i in (1, 2, 2, 3, 4)])
+        def get_image(self):
+            return next(self.images)
+    differ = FrameDiffer()
+    pipe = pipeline.FramePipeline(len, workers=1, backlog=4, differ=differ)
+    pipe.feed(itertools.islice(watch(Camera(), differ, min_interval=0), 4))
+    results = list(pipe)
+    print 'watch and pipeline: %d frames processed, %d unchanged' % (
+        len(results), differ.unchanged)
+    assert len(results) == 4 and pipe.unchanged == 0
+    assert differ.frames == 5 and differ.unchanged == 1
+    pipe.close()
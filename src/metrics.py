@@ -0,0 +1,387 @@
+"""
+Latency metrics of the requests made to Rovios.
+
+When control feels sluggish, the time of a command can go to the network, to
+the Rovio's CGI or to parsing the response.  With metrics enabled, every
+request a Rovio makes through its connection pool is timed in phases:
+
+  - connect: opening a new connection (not timed for a reused one)
+  - ttfb:    sending the request until the response headers are received
+  - body:    reading the response body
+  - parse:   handling the response (parsing and decoding)
+
+The times are aggregated into a histogram per Rovio, CGI action and phase,
+from which percentiles are estimated.  They can be read as a dictionary, or
+rendered in the Prometheus text format, optionally served over HTTP.
+
+Example:
+
+  m = metrics.enable()
+  ...
+  print m.snapshot()['rovio1']['rev.cgi:1']['ttfb']['p99']
+  server = MetricsServer(m, port=9108).start()   # http://host:9108/metrics
+
+Actions are labelled by their CGI path, with the action number for rev.cgi
+commands (e.g. 'rev.cgi:18' for manual_drive).  Requests pipelined by
+drive_sequence and by a formation.Formation are timed too, with no parse
+phase and a ttfb that includes waiting for the responses ahead of them.
+Requests sent by aiorovio.AsyncRovio are not timed.
+
+Classes:
+  - Histogram: bucketed distribution of durations
+  - Metrics: histograms of request phases per Rovio and action
+  - MetricsServer: HTTP server of a Metrics in the Prometheus format
+  - MetricsHandler: request handler used by MetricsServer
+
+Module Functions:
+  - enable: start timing the requests of all Rovios
+  - disable: stop timing requests
+
+Module Constants:
+  - BUCKETS: default histogram bucket bounds in seconds
+  - PERCENTILES: default percentiles in snapshots
+  - PHASES: the phases of a request that are timed
+
+"""
+
+import BaseHTTPServer
+import bisect
+import json
+import SocketServer
+import threading
+
+import rovio
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+"""Default upper bounds in seconds of the histogram buckets"""
+PERCENTILES = (50, 90, 99)
+"""Default percentiles included in snapshots"""
+
+PHASES = ('connect', 'ttfb', 'body', 'parse')
+"""The phases of a request that are timed, in order"""
+
+def enable(bounds=BUCKETS, percentiles=PERCENTILES):
+    """
+    Time the requests of all Rovios into a new Metrics.
+
+    Parameters:
+      - bounds:      histogram bucket bounds (default BUCKETS)
+      - percentiles: percentiles in snapshots (default PERCENTILES)
+
+    Return the Metrics (also rovio.metrics).
+
+    """
+    rovio.metrics = Metrics(bounds, percentiles)
+    return rovio.metrics
+
+def disable():
+    """Stop timing requests."""
+    rovio.metrics = None
+
+class Histogram(object):
+
+    """
+    A distribution of durations in fixed buckets.
+
+    Bucket i counts the values at most bounds[i] (and greater than the
+    previous bound); the last bucket counts the values above every bound.
+    Percentiles are interpolated linearly within a bucket, so their accuracy
+    is that of the bucket bounds.  A Histogram is not thread-safe.
+
+    Attributes:
+      - bounds: upper bounds of the buckets, in increasing order
+      - counts: number of values in each bucket (one more than bounds)
+      - count:  number of values
+      - sum:    sum of the values
+      - min:    smallest value (None if there are none)
+      - max:    largest value (None if there are none)
+
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        """
+        Initialize an empty histogram.
+
+        Parameters:
+          - bounds: bucket upper bounds in seconds (default BUCKETS)
+
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """Add a value."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return an estimate of the p-th percentile (0--100), or None."""
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                break
+            seen += n
+        low = self.bounds[i - 1] if i > 0 else 0.0
+        high = self.bounds[i] if i < len(self.bounds) else self.max
+        value = low + (high - low) * (rank - seen) / n
+        return min(max(value, self.min), self.max)
+
+    def as_dict(self, percentiles=PERCENTILES):
+        """
+        Return a dictionary of the histogram's statistics.
+
+        The keys are count, sum, mean, min, max and 'p%d' for each of
+        percentiles (e.g. 'p99'), in seconds.
+
+        """
+        d = {'count': self.count, 'sum': self.sum, 'min': self.min,
+             'max': self.max,
+             'mean': self.sum / self.count if self.count else None}
+        for p in percentiles:
+            d['p%g' % p] = self.percentile(p)
+        return d
+
+class Metrics(object):
+
+    """
+    Histograms of request phases per Rovio and action.
+
+    The observe and error methods are called by the Rovio class when a
+    Metrics is set as rovio.metrics (see enable).  All methods are
+    thread-safe.
+
+    Attributes:
+      - bounds:      bucket bounds of the histograms
+      - percentiles: percentiles included in snapshots
+
+    """
+
+    def __init__(self, bounds=BUCKETS, percentiles=PERCENTILES):
+        """
+        Initialize empty metrics.
+
+        Parameters:
+          - bounds:      histogram bucket bounds (default BUCKETS)
+          - percentiles: percentiles in snapshots (default PERCENTILES)
+
+        """
+        self.bounds = tuple(bounds)
+        self.percentiles = tuple(percentiles)
+        self._histograms = dict()
+        self._errors = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, name, action, phase, seconds):
+        """
+        Add the duration of a request phase.
+
+        Parameters:
+          - name:    name of the Rovio
+          - action:  label of the CGI action (e.g. 'rev.cgi:1')
+          - phase:   'connect', 'ttfb', 'body' or 'parse'
+          - seconds: duration of the phase
+
+        """
+        key = (name, action, phase)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = Histogram(self.bounds)
+            h.observe(seconds)
+
+    def error(self, name, action):
+        """Count a failed request of a Rovio's action."""
+        key = (name, action)
+        with self._lock:
+            self._errors[key] = self._errors.get(key, 0) + 1
+
+    def reset(self):
+        """Discard all histograms and error counts."""
+        with self._lock:
+            self._histograms.clear()
+            self._errors.clear()
+
+    def snapshot(self):
+        """
+        Return the metrics as nested dictionaries.
+
+        The result maps Rovio names to action labels to a dictionary with
+        the number of failed requests ('errors') and, for each phase timed,
+        the phase's Histogram.as_dict.
+
+        """
+        result = dict()
+        with self._lock:
+            for (name, action, phase), h in self._histograms.iteritems():
+                actions = result.setdefault(name, {})
+                stats = actions.setdefault(action, {'errors': 0})
+                stats[phase] = h.as_dict(self.percentiles)
+            for (name, action), n in self._errors.iteritems():
+                actions = result.setdefault(name, {})
+                actions.setdefault(action, {'errors': 0})['errors'] = n
+        return result
+
+    def prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+
+        The phases are the histogram rovio_request_phase_seconds and the
+        failures the counter rovio_request_errors_total, both labelled by
+        rovio and action (and phase).
+
+        """
+        lines = ['# HELP rovio_request_phase_seconds Duration of a phase of '
+                 'a request to a Rovio.',
+                 '# TYPE rovio_request_phase_seconds histogram']
+        with self._lock:
+            histograms = sorted((key, h.counts[:], h.sum, h.count)
+                                for key, h in self._histograms.iteritems())
+            errors = sorted(self._errors.iteritems())
+        for (name, action, phase), counts, total, count in histograms:
+            labels = 'rovio="%s",action="%s",phase="%s"' % (
+                _escape(name), _escape(action), _escape(phase))
+            cumulative = 0
+            for bound, n in zip(self.bounds, counts):
+                cumulative += n
+                lines.append('rovio_request_phase_seconds_bucket{%s,le="%r"} '
+                             '%d' % (labels, bound, cumulative))
+            lines.append('rovio_request_phase_seconds_bucket{%s,le="+Inf"} '
+                         '%d' % (labels, count))
+            lines.append('rovio_request_phase_seconds_sum{%s} %r' %
+                         (labels, total))
+            lines.append('rovio_request_phase_seconds_count{%s} %d' %
+                         (labels, count))
+        lines.append('# HELP rovio_request_errors_total Failed requests to '
+                     'a Rovio.')
+        lines.append('# TYPE rovio_request_errors_total counter')
+        for (name, action), n in errors:
+            lines.append('rovio_request_errors_total{rovio="%s",action="%s"} '
+                         '%d' % (_escape(name), _escape(action), n))
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    """Escape a Prometheus label value."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve /metrics (Prometheus format) and /metrics.json (snapshot)."""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = self.server.metrics.prometheus()
+            content_type = 'text/plain; version=0.0.4'
+        elif path == '/metrics.json':
+            body = json.dumps(self.server.metrics.snapshot())
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """
+    A local web server exporting a Metrics.
+
+    Attributes:
+      - host:    address the server is bound to
+      - port:    port the server is bound to (chosen by the OS if 0 was
+                 given)
+      - metrics: the Metrics served
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, metrics=None, host='127.0.0.1', port=9108,
+                 handler=MetricsHandler):
+        """
+        Bind a new server (call start to serve).
+
+        Parameters:
+          - metrics: Metrics to serve (default None, rovio.metrics)
+          - host:    address to bind to (default '127.0.0.1')
+          - port:    port to bind to (default 9108)
+          - handler: request handler class (default MetricsHandler)
+
+        """
+        if metrics is None:
+            metrics = rovio.metrics
+        if metrics is None:
+            raise rovio.RovioError('metrics are not enabled')
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), handler)
+        self.host, self.port = self.server_address[:2]
+        self.metrics = metrics
+        self._thread = None
+
+    def start(self):
+        """Serve requests on a background thread and return self."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        self.shutdown()
+        self.server_close()
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # time requests to a stub with some latency and serve the metrics
+    import urllib2
+    import simulator
+    server = simulator.StubServer(latency=0.002, jitter=0.002).start()
+    r = rovio.Rovio('stub', server.host, port=server.port)
+    m = enable()
+    for i in range(200):
+        r.get_report()
+        r.get_MCU_report()
+    r.get_image()
+    exporter = MetricsServer(m, port=0).start()
+    text = urllib2.urlopen('http://%s:%d/metrics' %
+                           (exporter.host, exporter.port)).read()
+    snap = json.loads(urllib2.urlopen('http://%s:%d/metrics.json' %
+                                      (exporter.host, exporter.port)).read())
+    for action, stats in sorted(snap['stub'].items()):
+        for phase in PHASES:
+            if phase in stats:
+                s = stats[phase]
+                print '%-20s %-8s n=%-4d p50=%6.2f ms p99=%6.2f ms' % (
+                    action, phase, s['count'], 1000 * s['p50'],
+                    1000 * s['p99'])
+    print text.count('\n'), 'lines of Prometheus text'
+    assert snap['stub']['rev.cgi:1']['ttfb']['count'] == 200
+    assert snap['stub']['rev.cgi:1']['parse']['count'] == 200
+    assert 'rovio_request_phase_seconds_count{rovio="stub",' in text
+    disable()
+    exporter.stop()
+    r.pool.close()
+    server.stop()
@@ -0,0 +1,220 @@
+"""
+Obstacle detection from a Rovio's IR radar.
+
+The IR radar's obstacle bit is in the status byte of the MCU report.  Checking
+it with a request per check is slow and, in a tight control loop, floods the
+Rovio with requests.  An ObstacleMonitor samples the MCU report at a fixed
+rate on a background thread, keeps a history of the status bytes, and calls
+back when an obstacle is detected or cleared.  Detection is debounced: the
+state only changes after the same reading several samples in a row.
+
+Example:
+
+  monitor = ObstacleMonitor(rovio, interval=0.1)
+  monitor.on_detected(lambda t: controller.interrupt(0, rovio.stop,
+                                                     priority=controller.HIGH))
+  monitor.start()
+  ...
+  if monitor.obstacle: ...
+  print monitor.fraction(50)       # share of the last 50 samples blocked
+
+The IR radar must be on (see MCUReport.ir_power) for the obstacle bit to mean
+anything.  Since the wheel encoder ticks of an MCU report are counted since
+the previous report, pass an odometry.Odometer to the monitor to keep the
+pose up to date from the same samples.
+
+Classes:
+  - ObstacleMonitor: background obstacle sampling with debounced callbacks
+
+"""
+
+import threading
+import time
+
+import rovio
+
+# maps a status byte to 1 if it has the obstacle bit, else 0
+_OBSTACLE_BITS = ''.join([chr((i >> 2) & 1) for i in range(256)])
+
+class ObstacleMonitor(threading.Thread):
+
+    """
+    Samples a Rovio's IR radar at a fixed rate.
+
+    The status byte of each MCU report is stored in a ring buffer of the last
+    history samples.  The debounced state (obstacle) turns True after
+    debounce consecutive samples with an obstacle, and False after debounce
+    consecutive samples without; the detected and cleared callbacks are
+    called with the time of the sample on the monitor's thread.  Failed
+    samples are logged and counted, and do not change the state.
+
+    Attributes:
+      - rovio:    the Rovio being monitored (read-only)
+      - obstacle: debounced obstacle state (read-only)
+      - last:     last MCUReport sampled (read-only)
+      - interval: seconds between samples
+      - debounce: consecutive samples needed to change the state
+      - samples:  number of samples taken
+      - errors:   number of failed samples
+
+    """
+
+    def getRovio(self): return self._rovio
+    rovio = property(getRovio, doc="""Rovio being monitored (read-only)""")
+
+    def getObstacle(self): return self._obstacle
+    obstacle = property(getObstacle,
+                        doc="""Debounced obstacle state (read-only)""")
+
+    def getLast(self): return self._last
+    last = property(getLast, doc="""Last MCUReport sampled (read-only)""")
+
+    def __init__(self, rovio_, interval=0.1, debounce=2, history=1024,
+                 odometer=None):
+        """
+        Initialize a monitor.
+
+        Parameters:
+          - rovio_:   the Rovio to monitor
+          - interval: seconds between samples (default 0.1)
+          - debounce: consecutive samples needed to change the state
+                      (default 2)
+          - history:  number of samples kept (default 1024)
+          - odometer: odometry.Odometer to update with each sample (default
+                      None)
+
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        if debounce < 1:
+            raise rovio.OutOfRangeError(rovio_, 'debounce', [1, history],
+                                        debounce)
+        self._rovio = rovio_
+        self.interval = interval
+        self.debounce = debounce
+        self.samples = 0
+        self.errors = 0
+        self._odometer = odometer
+        self._ring = bytearray(history)
+        self._obstacle = False
+        self._last = None
+        self._run = 0
+        self._detected = []
+        self._cleared = []
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+
+    def on_detected(self, fn):
+        """Call fn(t) when an obstacle is detected by the sample at time t."""
+        self._detected.append(fn)
+
+    def on_cleared(self, fn):
+        """Call fn(t) when an obstacle is cleared by the sample at time t."""
+        self._cleared.append(fn)
+
+    def run(self):
+        next_sample = time.time()
+        while not self._stopped.isSet():
+            self.sample()
+            next_sample += self.interval
+            now = time.time()
+            if next_sample < now:
+                # fell behind; skip the missed samples
+                next_sample = now
+            self._stopped.wait(next_sample - now)
+
+    def stop(self):
+        """Stop sampling."""
+        self._stopped.set()
+
+    def sample(self):
+        """Sample the MCU report now and update the state."""
+        try:
+            report = self._rovio.get_MCU_report(record=True)
+        except Exception:
+            self.errors += 1
+            rovio.rlog.exception('Error sampling %s', self._rovio.name)
+            return
+        now = time.time()
+        if self._odometer is not None:
+            self._odometer.update(report)
+        self.add(report, now)
+
+    def add(self, report, t=None):
+        """
+        Record a sample and update the state.
+
+        Parameters:
+          - report: a rovio.MCUReport
+          - t:      time of the sample (default None, now)
+
+        """
+        if t is None:
+            t = time.time()
+        blocked = report.obstacle
+        with self._cond:
+            self._ring[self.samples % len(self._ring)] = report.raw_status
+            self.samples += 1
+            self._last = report
+            if blocked == self._obstacle:
+                self._run = 0
+                return
+            self._run += 1
+            if self._run < self.debounce:
+                return
+            self._obstacle = blocked
+            self._run = 0
+            self._cond.notifyAll()
+        if blocked:
+            callbacks = self._detected
+        else:
+            callbacks = self._cleared
+        for fn in callbacks:
+            try:
+                fn(t)
+            except Exception:
+                rovio.rlog.exception('Exception in obstacle callback %r', fn)
+
+    def wait_for(self, obstacle=True, timeout=None):
+        """
+        Wait until the debounced state is obstacle.
+
+        Return True if it is, False if timeout seconds passed first.
+
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self._obstacle != obstacle:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+
+    def history(self, n=None):
+        """
+        Return the last n status bytes, oldest first, as a bytearray.
+
+        n defaults to (and is at most) the number of samples kept.
+
+        """
+        with self._cond:
+            size = min(self.samples, len(self._ring))
+            if n is None or n > size:
+                n = size
+            end = self.samples % len(self._ring)
+            if n <= end:
+                return self._ring[end - n:end]
+            return self._ring[len(self._ring) - (n - end):] + self._ring[:end]
+
+    def fraction(self, n=None):
+        """Return the fraction of the last n samples with an obstacle."""
+        statuses = self.history(n)
+        if not statuses:
+            return 0.0
+        blocked = statuses.translate(_OBSTACLE_BITS).count('\x01')
+        return float(blocked) / len(statuses)
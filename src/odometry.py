@@ -0,0 +1,157 @@
+"""
+Dead reckoning from a Rovio's wheel encoders.
+
+get_report gives the Rovio's position from the NorthStar navigation system,
+which is slow to query and only works in range of a room beacon.  The MCU
+report carries the encoder ticks each wheel has turned since the previous
+report; an Odometer integrates these over successive MCU reports into a pose
+estimate, so the pose can be tracked at a high rate with cheap requests.
+
+Example:
+
+  odometer = Odometer()
+  while driving:
+      pose = odometer.poll(rovio)
+      print pose.x, pose.y, pose.theta
+
+The Rovio drives on three omni-wheels (a kiwi drive): front left, front right
+and rear, 120 degrees apart.  The wheel geometry and the distance per encoder
+tick are parameters; the defaults are rough and should be calibrated for the
+best results (drive a known distance and compare).
+
+Classes:
+  - Odometer: integrates MCU reports into a pose estimate
+  - Pose: position and heading of the Rovio
+
+Module Constants:
+  - TICK_DISTANCE: default distance in meters a wheel rolls per encoder tick
+  - BASE_RADIUS: default distance in meters from the center to the wheels
+  - WHEEL_ANGLES: default angles in degrees of the wheels around the center
+
+"""
+
+import collections
+import math
+
+import rovio
+
+TICK_DISTANCE = 0.0004
+"""Default distance in meters a wheel rolls per encoder tick"""
+BASE_RADIUS = 0.1
+"""Default distance in meters from the center of the Rovio to the wheels"""
+WHEEL_ANGLES = (60.0, -60.0, 180.0)
+"""Default angles in degrees of the left, right and rear wheels, counter-
+clockwise from straight ahead"""
+
+class Pose(collections.namedtuple('Pose', ['x', 'y', 'theta'])):
+
+    """Position (x, y) in meters and heading theta in radians (-PI--PI)."""
+
+    __slots__ = ()
+
+class Odometer(object):
+
+    """
+    Integrates wheel encoder ticks into a pose estimate.
+
+    Each wheel rolls tangentially to the circle through the wheels (counter-
+    clockwise for positive ticks); a wheel whose encoder counts the other way
+    is given a sign of -1.  Each update solves the wheels' rolled distances
+    for the motion of the Rovio in its own frame (forward, left, turn) and
+    adds it to the pose along the mean heading of the step.
+
+    The pose starts at the origin, heading along the x axis, unless another
+    is given.  Errors accumulate; reset the pose from get_report when the
+    navigation system has a good fix.
+
+    Attributes:
+      - pose:     the current Pose
+      - distance: total distance in meters travelled
+      - updates:  number of MCU reports integrated
+
+    """
+
+    def __init__(self, tick_distance=TICK_DISTANCE, base_radius=BASE_RADIUS,
+                 wheel_angles=WHEEL_ANGLES, signs=(1, 1, 1), pose=None):
+        """
+        Initialize an odometer.
+
+        Parameters:
+          - tick_distance: meters a wheel rolls per encoder tick (default
+                           TICK_DISTANCE)
+          - base_radius:   meters from the center to the wheels (default
+                           BASE_RADIUS)
+          - wheel_angles:  angles in degrees of the left, right and rear
+                           wheels (default WHEEL_ANGLES)
+          - signs:         1 or -1 for each wheel's encoder direction
+                           (default (1, 1, 1))
+          - pose:          initial Pose (default None, the origin)
+
+        """
+        rows = []
+        for angle in wheel_angles:
+            a = math.radians(angle)
+            rows.append((-math.sin(a), math.cos(a), base_radius))
+        inverse = _inverse(rows)
+        if inverse is None:
+            raise rovio.RovioError('wheel angles %r do not determine the '
+                                   'motion' % (wheel_angles,))
+        # scale each column by the wheel's tick distance and sign
+        self._solve = [[inverse[i][j] * tick_distance * signs[j]
+                        for j in range(3)] for i in range(3)]
+        self.distance = 0.0
+        self.updates = 0
+        self.reset(pose)
+
+    def reset(self, pose=None):
+        """Set the pose (default None, the origin)."""
+        if pose is None:
+            pose = Pose(0.0, 0.0, 0.0)
+        self.pose = Pose(*pose)
+
+    def update(self, report):
+        """
+        Integrate one MCU report.
+
+        Parameters:
+          - report: a rovio.MCUReport or a get_MCU_report hex string
+
+        Return the new Pose.
+
+        """
+        if not isinstance(report, rovio.MCUReport):
+            report = rovio.MCUReport.from_hex(report)
+        left, right, rear = report.left, report.right, report.rear
+        self.updates += 1
+        if not (left or right or rear):
+            return self.pose
+        s = self._solve
+        forward = s[0][0] * left + s[0][1] * right + s[0][2] * rear
+        sideways = s[1][0] * left + s[1][1] * right + s[1][2] * rear
+        turn = s[2][0] * left + s[2][1] * right + s[2][2] * rear
+        x, y, theta = self.pose
+        heading = theta + turn / 2.0
+        c = math.cos(heading)
+        sn = math.sin(heading)
+        theta = math.atan2(math.sin(theta + turn), math.cos(theta + turn))
+        self.pose = Pose(x + forward * c - sideways * sn,
+                         y + forward * sn + sideways * c, theta)
+        self.distance += math.hypot(forward, sideways)
+        return self.pose
+
+    def poll(self, rovio_):
+        """Get an MCU report from rovio_, integrate it and return the Pose."""
+        return self.update(rovio_.get_MCU_report(record=True))
+
+def _inverse(m):
+    """Return the inverse of a 3x3 matrix (None if it is singular)."""
+    (a, b, c), (d, e, f), (g, h, i) = m
+    det = a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+    if abs(det) < 1e-12:
+        return None
+    return [[(e * i - f * h) / det, (c * h - b * i) / det,
+             (b * f - c * e) / det],
+            [(f * g - d * i) / det, (a * i - c * g) / det,
+             (c * d - a * f) / det],
+            [(d * h - e * g) / det, (b * g - a * h) / det,
+             (a * e - b * d) / det]]
@@ -0,0 +1,405 @@
+"""
+Processing camera frames in a pool of worker processes.
+
+CPU-heavy work on camera frames (decoding, resizing, feature detection) holds
+the GIL and stalls the threads controlling the Rovio.  A FramePipeline hands
+each frame to one of a pool of worker processes instead.  Frames are passed
+through shared memory: the pipeline copies a frame into a free slot of a
+shared buffer and sends the worker only the slot number, and the worker's
+function receives a memoryview of the slot.
+
+Results come out in the order the frames went in.  When the workers fall
+behind, frames waiting for a worker are dropped, oldest first, so the results
+stay close to real time.
+
+Example:
+
+  def count_edges(frame):          # runs in the worker processes
+      return detect(decode(frame))
+
+  pipe = FramePipeline(count_edges, workers=4)
+  pipe.feed(rovio.stream_video(policy=video.DROP_OLDEST))
+  for captured, edges in pipe:
+      ...
+  print pipe.stats()
+
+The function must be defined at the top level of a module, and the pipeline
+created before it is needed: the worker processes are forked when the
+pipeline is created.
+
+Given a framediff.FrameDiffer, the pipeline skips the frames that have not
+changed since the last frame it processed.
+
+Classes:
+  - FramePipeline: ordered, frame-dropping process pool for camera frames
+
+Module Functions:
+  - images: generate camera images of a Rovio with get_image
+
+"""
+
+import collections
+import cPickle
+import ctypes
+import multiprocessing
+import threading
+import time
+from multiprocessing import sharedctypes
+
+import rovio
+
+# shared frame buffer and processing function of a worker process
+_shared = None
+_slot_size = None
+_process = None
+
+def images(rovio_, interval=0.0):
+    """
+    Generate camera images of a Rovio, one get_image request per image.
+
+    Parameters:
+      - rovio_:   the Rovio
+      - interval: minimum seconds between requests (default 0)
+
+    """
+    while True:
+        start = time.time()
+        yield rovio_.get_image()
+        delay = interval - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+class FramePipeline(object):
+
+    """
+    Runs a function over frames in worker processes.
+
+    At most one frame per worker is being processed at a time, and at most
+    backlog more wait for a worker; a new frame arriving when the backlog is
+    full replaces the oldest waiting frame (which is counted as dropped).
+    Frames larger than frame_size bypass the shared buffer and are pickled
+    to the worker; they count against the backlog all the same.  With a
+    differ, frames it finds unchanged are skipped (and counted as
+    unchanged) before they are queued.
+
+    Iterating over the pipeline returns (captured, result) pairs in the order
+    the frames were submitted, where captured is the time the frame was
+    submitted.  Frames whose function raised an exception are logged and
+    counted, and skipped, as are results that cannot be pickled.  Iteration
+    ends once the pipeline is closed and its results are consumed.
+
+    Each frame costs a copy into shared memory and a round trip through
+    the workers' queues, so the pipeline only pays off with more than one
+    CPU and a function that takes well over a millisecond a frame; for
+    cheaper functions, or on a single CPU, calling the function in the
+    capturing thread is faster.
+
+    Attributes:
+      - workers:    number of worker processes
+      - backlog:    maximum number of frames waiting for a worker
+      - frame_size: size in bytes of each shared memory slot
+      - differ:     framediff.FrameDiffer skipping unchanged frames, or None
+
+    """
+
+    def __init__(self, process, workers=None, backlog=1, frame_size=262144,
+                 differ=None):
+        """
+        Start the worker processes.
+
+        Parameters:
+          - process:    function of a frame (a memoryview) returning a
+                        picklable result, run in the workers
+          - workers:    number of worker processes (default None, the
+                        number of CPUs)
+          - backlog:    maximum number of frames waiting for a worker
+                        (default 1)
+          - frame_size: bytes of shared memory per frame (default 256 KB)
+          - differ:     framediff.FrameDiffer to skip unchanged frames with
+                        (default None, process every frame)
+
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.backlog = backlog
+        self.frame_size = frame_size
+        self.differ = differ
+        slots = workers + backlog
+        self._shared = sharedctypes.RawArray(ctypes.c_char,
+                                             slots * frame_size)
+        self._view = memoryview(self._shared)
+        self._free = range(slots)
+        self._waiting = collections.deque()
+        self._in_flight = 0
+        self._results = dict()
+        self._ready = collections.deque()
+        self._next_seq = 0
+        self._next_out = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._times = collections.deque(maxlen=31)
+        self._latency = collections.deque(maxlen=100)
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.unchanged = 0
+        self.errors = 0
+        self._feeder = None
+        self._pool = multiprocessing.Pool(workers, _init_worker,
+                                          (self._shared, frame_size, process))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next (captured, result) pair, waiting for it."""
+        with self._cond:
+            while not self._ready:
+                if self._closed and self._next_out == self._next_seq:
+                    raise StopIteration
+                self._cond.wait()
+            return self._ready.popleft()
+
+    def submit(self, frame):
+        """
+        Queue a frame (a string, bytearray or memoryview) for processing.
+
+        Return False if the pipeline is closed.
+
+        """
+        now = time.time()
+        if self.differ is not None and not self._closed:
+            # compare outside the lock, not to hold up the results
+            if not self.differ.check(frame):
+                with self._cond:
+                    self.unchanged += 1
+                return True
+        with self._cond:
+            if self._closed:
+                return False
+            self.submitted += 1
+            if (self._in_flight >= self.workers and
+                len(self._waiting) >= self.backlog):
+                if not self._waiting:
+                    # no backlog, and every worker is busy
+                    self.dropped += 1
+                    return True
+                # the workers are behind: drop the oldest waiting frame
+                slot = self._waiting.popleft()[0]
+                if slot is not None:
+                    self._free.append(slot)
+                self.dropped += 1
+            n = len(frame)
+            if n > self.frame_size:
+                slot = None
+                frame = bytes(bytearray(frame))
+            else:
+                # fewer than backlog frames wait, so a slot is free
+                slot = self._free.pop()
+                start = slot * self.frame_size
+                self._view[start:start + n] = frame
+                frame = None
+            self._waiting.append((slot, n, frame, now))
+            self._dispatch()
+        return True
+
+    def feed(self, source):
+        """
+        Submit every frame of an iterable on a background thread.
+
+        Parameters:
+          - source: iterable of frames, e.g. an MJPEGStream or images(rovio)
+
+        The pipeline is closed when the source ends.
+
+        """
+        def run():
+            try:
+                for frame in source:
+                    if not self.submit(frame):
+                        break
+            except Exception:
+                rovio.rlog.exception('Error reading frames for %r', self)
+            self.close(wait=False)
+        self._feeder = threading.Thread(target=run)
+        self._feeder.setDaemon(True)
+        self._feeder.start()
+
+    def close(self, wait=True):
+        """
+        Stop accepting frames.
+
+        Parameters:
+          - wait: wait for the queued frames to be processed and stop the
+                  workers (default True)
+
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notifyAll()
+            if not wait:
+                return
+            while self._in_flight or self._waiting:
+                self._cond.wait()
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Stop the workers at once, discarding the queued frames."""
+        with self._cond:
+            self._closed = True
+            self.dropped += len(self._waiting)
+            self._waiting.clear()
+            # frames being processed will never come back
+            self._next_seq = self._next_out
+            self._cond.notifyAll()
+        self._pool.terminate()
+
+    def fps(self):
+        """Return the frames processed per second over the last 30."""
+        with self._cond:
+            if len(self._times) < 2:
+                return 0.0
+            span = self._times[-1] - self._times[0]
+            if span <= 0:
+                return 0.0
+            return (len(self._times) - 1) / span
+
+    def stats(self):
+        """
+        Return a dict of the pipeline's counters and queues.
+
+        submitted, processed, dropped and errors count frames (unchanged
+        counts those skipped by the differ, which are not submitted); waiting,
+        in_flight and ready are the current depths of the queues of frames
+        waiting for a worker, frames being processed and results not yet
+        consumed; fps is the processing rate and latency_ms the mean time
+        from submission to result over the last 100 frames.
+
+        """
+        fps = self.fps()
+        with self._cond:
+            latency = list(self._latency)
+            return {'submitted': self.submitted, 'processed': self.processed,
+                    'dropped': self.dropped, 'unchanged': self.unchanged,
+                    'errors': self.errors,
+                    'waiting': len(self._waiting),
+                    'in_flight': self._in_flight, 'ready': len(self._ready),
+                    'fps': fps,
+                    'latency_ms': (1000.0 * sum(latency) / len(latency)
+                                   if latency else 0.0)}
+
+    def _dispatch(self):
+        """Send waiting frames to idle workers; call with _cond held."""
+        while self._waiting and self._in_flight < self.workers:
+            slot, n, frame, captured = self._waiting.popleft()
+            seq = self._next_seq
+            self._next_seq += 1
+            self._in_flight += 1
+            def done(outcome, seq=seq, slot=slot, captured=captured):
+                self._done(seq, slot, captured, outcome)
+            self._pool.apply_async(_work, (slot, n, frame), callback=done)
+
+    def _done(self, seq, slot, captured, outcome):
+        """Collect a worker's outcome; runs on the pool's result thread."""
+        now = time.time()
+        ok, value = outcome
+        if ok:
+            try:
+                outcome = True, cPickle.loads(value)
+            except Exception, e:
+                outcome = False, '%s: %s' % (e.__class__.__name__, e)
+        with self._cond:
+            self._in_flight -= 1
+            if slot is not None:
+                self._free.append(slot)
+            self.processed += 1
+            self._times.append(now)
+            self._latency.append(now - captured)
+            self._results[seq] = (captured, outcome)
+            # release the results in order
+            while self._next_out in self._results:
+                captured, (ok, value) = self._results.pop(self._next_out)
+                self._next_out += 1
+                if ok:
+                    self._ready.append((captured, value))
+                else:
+                    self.errors += 1
+                    rovio.rlog.error('Error processing frame: %s', value)
+            self._dispatch()
+            self._cond.notifyAll()
+
+def _init_worker(shared, slot_size, process):
+    global _shared, _slot_size, _process
+    _shared = memoryview(shared)
+    _slot_size = slot_size
+    _process = process
+
+def _work(slot, n, frame):
+    """Run the processing function on a frame in a worker process."""
+    if frame is None:
+        start = slot * _slot_size
+        frame = _shared[start:start + n]
+    try:
+        # pickle the result here: a result the pool fails to send back
+        # would never reach the callback, and its frame never come out
+        return True, cPickle.dumps(_process(frame), cPickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        return False, '%s: %s' % (e.__class__.__name__, e)
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+def _checksum(frame):
+    # stands in for decoding and feature detection
+    import hashlib
+    data = frame.tobytes() if isinstance(frame, memoryview) else frame
+    for i in xrange(200):
+        data = hashlib.sha256(data).digest() + data[32:]
+    return len(frame), data[:4].encode('hex')
+
+def _length(frame):
+    # a result that cannot be pickled for frames starting with 'x'
+    if str(bytearray(frame[:1])) == 'x':
+        return lambda: None
+    return len(frame)
+
+if __name__ == "__main__":
+    # process the stub's camera images serially, then in a pipeline; with a
+    # few milliseconds of work a frame, the pipeline only beats serial
+    # processing on more than one CPU
+    import itertools
+    import simulator
+    server = simulator.StubServer().start()
+    r = rovio.Rovio('stub', server.host, port=server.port)
+    n = 300
+    pipe = FramePipeline(_checksum, backlog=2)
+    print 'cpus:     %6d' % pipe.workers
+    start = time.time()
+    for image in itertools.islice(images(r), n):
+        _checksum(image)
+    print 'serial:   %6.1f frames/s' % (n / (time.time() - start))
+    start = time.time()
+    pipe.feed(itertools.islice(images(r), n))
+    results = list(pipe)
+    elapsed = time.time() - start
+    print 'pipeline: %6.1f frames/s of %d submitted' % (len(results) / elapsed,
+                                                        n)
+    print pipe.stats()
+    assert len(results) == pipe.processed == n - pipe.dropped
+    assert [c for c, res in results] == sorted(c for c, res in results)
+    pipe.close()
+    # oversize frames count against the backlog; bad results are errors
+    pipe = FramePipeline(_length, workers=1, backlog=1, frame_size=16)
+    for frame in ['o' * 100, 'w' * 10, 'o' * 200, 'w' * 12, 'x' * 10]:
+        pipe.submit(frame)
+        assert len(pipe._waiting) <= pipe.backlog
+    pipe.close()
+    results = [res for c, res in pipe]
+    print 'mixed sizes:', results, pipe.stats()['dropped'], 'dropped'
+    assert pipe.processed + pipe.dropped == pipe.submitted == 5
+    assert len(results) + pipe.errors == pipe.processed and pipe.errors == 1
+    r.pool.close()
+    server.stop()
@@ -0,0 +1,321 @@
+"""
+Shared, cached polling of a Rovio's status.
+
+Parts of an application that each call get_report, get_status or
+get_MCU_report make one HTTP request per call, even when they ask the same
+Rovio within milliseconds of each other.  A RovioPoller refreshes these
+queries on a background thread at a fixed interval each, and serves reads from
+the latest timestamped snapshot.  A read that needs fresher data than the
+snapshot (max_staleness) fetches it, and concurrent fetches of the same query
+share one request (single-flight).
+
+Example:
+
+  poller = RovioPoller(rovio, intervals={'get_report': 0.25})
+  poller.start()
+  ...
+  report = poller.get_report(max_staleness=0.5)
+  status = poller.snapshot('get_status')
+  print status.age(), status.value.state
+
+Cached reports and statuses are kept as rovio.Report and rovio.Status
+records, which are immutable and so safe to share between threads, along
+with the dictionaries Rovio.get_report and get_status returned for them; each
+caller gets its own copy of a dictionary.
+
+Note that the wheel encoder ticks of get_MCU_report are counted since the last
+read, so with a poller running, the ticks are only complete over the
+successive snapshots the poller takes.
+
+Classes:
+  - RovioPoller: background poller and snapshot cache for one Rovio
+  - Snapshot: a query result and the time it was taken
+
+Module Constants:
+  - DEFAULT_INTERVALS: seconds between polls of each query
+
+"""
+
+import collections
+import threading
+import time
+
+import rovio
+
+DEFAULT_INTERVALS = {'get_report': 1.0, 'get_status': 1.0,
+                     'get_MCU_report': 1.0}
+"""Seconds between polls of each query"""
+
+# fields decoded in the dictionaries, with the raw values under 'raw_' + name
+_DECODED = {'get_report': ('resolution', 'head_position', 'ac_freq'),
+            'get_status': ('state',)}
+
+class Snapshot(collections.namedtuple('Snapshot', ['value', 'time'])):
+
+    """
+    The result of a query and the time (seconds since the epoch) it was
+    taken.
+
+    """
+
+    __slots__ = ()
+
+    def age(self):
+        """Return the number of seconds since the snapshot was taken."""
+        return time.time() - self.time
+
+class RovioPoller(threading.Thread):
+
+    """
+    Polls a Rovio in the background and caches the latest results.
+
+    Each query (a Rovio method taking no arguments) is polled every
+    intervals[query] seconds.  Failed polls are logged and counted, and the
+    previous snapshot is kept.  Reads can also be made without starting the
+    thread, in which case every read older than max_staleness fetches.
+
+    Attributes:
+      - rovio:         the Rovio being polled (read-only)
+      - intervals:     map of query names to seconds between polls
+      - max_staleness: default maximum age in seconds of the results served
+      - requests:      number of requests made to the Rovio
+      - errors:        number of failed background polls
+
+    """
+
+    def getRovio(self): return self._rovio
+    rovio = property(getRovio, doc="""Rovio being polled (read-only)""")
+
+    def __init__(self, rovio_, intervals=None, max_staleness=None):
+        """
+        Initialize a poller.
+
+        Parameters:
+          - rovio_:        the Rovio to poll
+          - intervals:     map of query names to seconds between polls
+                           (default DEFAULT_INTERVALS)
+          - max_staleness: default maximum age in seconds of the results
+                           served by the get methods (default None, the
+                           latest snapshot of any age)
+
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        if intervals is None:
+            intervals = DEFAULT_INTERVALS
+        self._rovio = rovio_
+        self.intervals = dict(intervals)
+        self.max_staleness = max_staleness
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        # query names to the latest (Snapshot, dictionary or None)
+        self._latest = dict()
+        self._in_flight = dict()
+        self._stopped = threading.Event()
+
+    def run(self):
+        due = dict.fromkeys(self.intervals, time.time())
+        while not self._stopped.isSet():
+            now = time.time()
+            for query, t in due.items():
+                if t > now:
+                    continue
+                snap = self.snapshot(query)
+                failed = False
+                # skip the poll if a reader has just refreshed the query
+                if snap is None or now - snap.time >= self.intervals[query]:
+                    try:
+                        self.fetch(query)
+                    except Exception:
+                        failed = True
+                        self.errors += 1
+                        rovio.rlog.exception('Error polling %s of %s', query,
+                                             self._rovio.name)
+                    snap = self.snapshot(query)
+                if snap is None or failed:
+                    # the old snapshot's next poll is already past
+                    due[query] = now + self.intervals[query]
+                else:
+                    due[query] = snap.time + self.intervals[query]
+            self._stopped.wait(max(0.0, min(due.values()) - time.time()))
+
+    def stop(self):
+        """Stop polling."""
+        self._stopped.set()
+
+    def snapshot(self, query):
+        """Return the latest Snapshot of a query (None if there is none)."""
+        entry = self._latest.get(query)
+        return None if entry is None else entry[0]
+
+    def get(self, query, max_staleness=None):
+        """
+        Return the result of a query, at most max_staleness seconds old.
+
+        Parameters:
+          - query:         name of a Rovio method taking no arguments
+          - max_staleness: maximum age in seconds of the result (default
+                           self.max_staleness)
+
+        Fetch the result if there is no recent enough snapshot.  Raise the
+        query's exception if that fetch fails.
+
+        """
+        return self._get(query, max_staleness)[0].value
+
+    def fetch(self, query):
+        """
+        Request a query now and return its new Snapshot.
+
+        If a request for the query is already in flight, wait for its result
+        instead of making another.
+
+        """
+        return self._fetch(query)[0]
+
+    def _get(self, query, max_staleness):
+        """Return the latest (Snapshot, dictionary), fetching it if stale."""
+        if max_staleness is None:
+            max_staleness = self.max_staleness
+        with self._lock:
+            entry = self._latest.get(query)
+        if entry is not None and (
+                max_staleness is None or
+                time.time() - entry[0].time <= max_staleness):
+            return entry
+        return self._fetch(query)
+
+    def _fetch(self, query):
+        """Request a query now and return its new (Snapshot, dictionary)."""
+        with self._lock:
+            future = self._in_flight.get(query)
+            leader = future is None
+            if leader:
+                future = self._in_flight[query] = rovio.Future()
+                future.set_running_or_notify_cancel()
+                self.requests += 1
+        if not leader:
+            return future.result()
+        try:
+            value, d = self._call(query)
+            snap = Snapshot(value, time.time())
+        except Exception, e:
+            with self._lock:
+                del self._in_flight[query]
+            future.set_exception(e)
+            raise
+        entry = (snap, d)
+        with self._lock:
+            self._latest[query] = entry
+            del self._in_flight[query]
+        future.set_result(entry)
+        return entry
+
+    def get_report(self, max_staleness=None, record=False):
+        """
+        Return the cached result of Rovio.get_report.
+
+        Parameters:
+          - max_staleness: as for get (default self.max_staleness)
+          - record:        return the Report instead of a dictionary (default
+                           False)
+
+        """
+        snap, d = self._get('get_report', max_staleness)
+        if record:
+            return snap.value
+        return _copy(d)
+
+    def get_status(self, max_staleness=None, record=False):
+        """
+        Return the cached result of Rovio.get_status.
+
+        Parameters:
+          - max_staleness: as for get (default self.max_staleness)
+          - record:        return the Status instead of a dictionary (default
+                           False)
+
+        """
+        snap, d = self._get('get_status', max_staleness)
+        if record:
+            return snap.value
+        return _copy(d)
+
+    def get_MCU_report(self, max_staleness=None):
+        """Return the cached result of Rovio.get_MCU_report."""
+        return self.get('get_MCU_report', max_staleness)
+
+    def _call(self, query):
+        """
+        Request a query from the Rovio.
+
+        Return its result, as a record if it has one, and its dictionary (or
+        None).
+
+        """
+        if query not in _DECODED:
+            return getattr(self._rovio, query)(), None
+        d = getattr(self._rovio, query)()
+        # the record is made from the undecoded response, as by the Rovio
+        response = dict(d)
+        for name in _DECODED[query]:
+            if 'raw_' + name in response:
+                response[name] = response.pop('raw_' + name)
+        if query == 'get_report':
+            return rovio.Report.from_response(response), d
+        return rovio.Status.from_response(response), d
+
+def _copy(d):
+    """Return a copy of a query's dictionary for a caller."""
+    return dict([(k, list(v) if isinstance(v, list) else v)
+                 for k, v in d.iteritems()])
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # many readers sharing one poller against a local stub
+    import simulator
+    server = simulator.StubServer().start()
+    r = rovio.Rovio('stub', server.host, port=server.port, pool_size=4)
+    poller = RovioPoller(r, intervals={'get_report': 0.05,
+                                       'get_status': 0.1,
+                                       'get_MCU_report': 0.1},
+                         max_staleness=0.1)
+    poller.start()
+    reads = [0]
+    def reader():
+        for i in range(500):
+            poller.get_report()
+            poller.get_status()
+            poller.get_MCU_report(max_staleness=0)
+            reads[0] += 3
+    readers = [threading.Thread(target=reader) for i in range(8)]
+    start = time.time()
+    for t in readers:
+        t.start()
+    for t in readers:
+        t.join()
+    poller.stop()
+    poller.join()
+    print '%d reads, %d requests in %.3f s' % (reads[0], poller.requests,
+                                               time.time() - start)
+    assert poller.get_report()['resolution'] == [640, 480]
+    # the dictionaries are those of the Rovio, records made from the same
+    assert poller.get_report(max_staleness=0) == r.get_report()
+    assert poller.get_status(max_staleness=0) == r.get_status()
+    assert poller.get_report(record=True) == r.get_report(record=True)
+    assert poller.get_status(record=True) == r.get_status(record=True)
+    server.stop()
+    r.pool.close()
+    # with the Rovio gone, failed polls wait for their interval too
+    poller = RovioPoller(r, intervals={'get_report': 0.5, 'get_status': 0.5})
+    poller.start()
+    time.sleep(2.0)
+    poller.stop()
+    poller.join()
+    print '%d requests, %d errors in 2 s without a Rovio' % (poller.requests,
+                                                             poller.errors)
+    assert poller.errors and poller.requests <= 2 * (2.0 / 0.5 + 1)
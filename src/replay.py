@@ -0,0 +1,454 @@
+"""
+Recording and replaying the commands sent to Rovios.
+
+A CommandRecorder attached to a Rovio logs every request the Rovio makes:
+the page requested (which holds the command and its arguments), the robot's
+name, the time, how long the request took, the HTTP status and, for short
+responses, the response body.  Requests pipelined by drive_sequence and by a
+formation.Formation are logged too; those of an aiorovio.AsyncRovio are not.
+replay() sends a recorded session again, to the same robot or another (such
+as a simulator.StubServer), at the original speed or faster.
+
+Example:
+
+  recorder = CommandRecorder('session.rcl')
+  recorder.attach(rovio1)
+  ...                                  # drive around
+  recorder.close()
+
+  log = CommandLog('session.rcl')
+  start = log.index(time.time() - 60)  # the last minute
+  replay(log, rovio2, speed=2.0, start=log[start].time)
+
+The log is append-only and made of fixed-size records, so recording is a
+struct.pack_into per command, and the file can be memory-mapped and searched
+by time without reading it.  Recording a session into an existing log appends
+to it.  A log is three files:
+
+  - path:         a header and one RECORD per command
+  - path.strings: robot names and pages, one per line; records refer to them
+                  by line number
+  - path.bodies:  the stored response bodies, back to back
+
+Records are written in the order the requests completed, and their times are
+the completion times, so they are sorted by time even when commands are sent
+from several threads.
+
+Classes:
+  - Command: one recorded command
+  - CommandRecorder: records the commands of Rovios to a log
+  - CommandLog: read-only, memory-mapped view of a log
+
+Module Functions:
+  - replay: send the commands of a log again
+
+Module Constants:
+  - RECORD: struct.Struct of a record
+
+"""
+
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib2
+
+import rovio
+
+RECORD = struct.Struct('<dfIIiIq')
+"""Layout of a record: completion time, seconds taken, robot name and page
+string numbers, HTTP status (0 if the request failed), body length and body
+offset (-1 if the body was not stored)"""
+
+_MAGIC = 'RVCL'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHH')
+
+class Command(collections.namedtuple('Command', [
+        'time', 'elapsed', 'rovio', 'page', 'status', 'length', 'body'])):
+
+    """
+    One recorded command.
+
+    time is when the response was received, elapsed the seconds the request
+    took, rovio the robot's name, page the page requested, status the HTTP
+    status (0 if the request failed), length the size of the response body,
+    and body the body (None if it was not stored).
+
+    """
+
+    __slots__ = ()
+
+    def getSent(self): return self.time - self.elapsed
+    sent = property(getSent, doc="""Time the command was sent""")
+
+class CommandRecorder(object):
+
+    """
+    Records the commands of Rovios to a log.
+
+    Records are buffered and written buffer_size at a time, and when the
+    recorder is flushed or closed; bodies longer than max_body bytes (camera
+    images, for example) are not stored.  One recorder can record many
+    Rovios.  record is thread-safe.
+
+    Attributes:
+      - path:     path of the record file
+      - max_body: longest response body stored, in bytes
+      - records:  number of commands recorded (including earlier sessions)
+
+    """
+
+    def __init__(self, path, max_body=4096, buffer_size=1024):
+        """
+        Open a log for appending, creating it if needed.
+
+        Parameters:
+          - path:        path of the record file
+          - max_body:    longest response body stored (default 4096)
+          - buffer_size: records buffered before they are written (default
+                         1024)
+
+        """
+        self.path = path
+        self.max_body = max_body
+        self._strings = dict()
+        if os.path.exists(path) and os.path.getsize(path):
+            size = os.path.getsize(path) - _HEADER.size
+            self.records = size // RECORD.size
+            f = open(path, 'r+b')
+            try:
+                _check_header(f.read(_HEADER.size), path)
+                if size % RECORD.size:
+                    # drop a record cut short by a crash
+                    f.truncate(_HEADER.size + self.records * RECORD.size)
+            finally:
+                f.close()
+            for line in _read_strings(path):
+                self._strings[line] = len(self._strings)
+            new = False
+        else:
+            self.records = 0
+            new = True
+        self._records = open(path, 'ab')
+        if new:
+            self._records.write(_HEADER.pack(_MAGIC, _VERSION, RECORD.size))
+            self._records.flush()
+        self._strings_file = open(path + '.strings', 'ab')
+        self._bodies = open(path + '.bodies', 'ab')
+        self._bodies.seek(0, os.SEEK_END)
+        self._offset = self._bodies.tell()
+        self._buffer = bytearray(buffer_size * RECORD.size)
+        self._buffered = 0
+        self._new_strings = []
+        self._body_buffer = bytearray()
+        self._lock = threading.Lock()
+
+    def attach(self, rovio_):
+        """Record the commands of rovio_."""
+        rovio_.recorder = self
+
+    def detach(self, rovio_):
+        """Stop recording the commands of rovio_."""
+        if rovio_.recorder is self:
+            rovio_.recorder = None
+
+    def record(self, name, page, sent, status, body):
+        """
+        Record a command; called by the Rovio when its request completes.
+
+        Parameters:
+          - name:   name of the Rovio
+          - page:   page requested
+          - sent:   time the request was sent
+          - status: HTTP status (0 if the request failed)
+          - body:   response body, or None
+
+        """
+        with self._lock:
+            now = time.time()
+            length = 0 if body is None else len(body)
+            if body is not None and length <= self.max_body:
+                offset = self._offset
+                self._body_buffer += body
+                self._offset += length
+            else:
+                offset = -1
+            RECORD.pack_into(self._buffer, self._buffered * RECORD.size,
+                             now, now - sent, self._string(name),
+                             self._string(page), status, length, offset)
+            self._buffered += 1
+            self.records += 1
+            if self._buffered * RECORD.size == len(self._buffer):
+                self._flush()
+
+    def flush(self):
+        """Write the buffered records."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Write the buffered records and close the log."""
+        with self._lock:
+            self._flush()
+            self._records.close()
+            self._strings_file.close()
+            self._bodies.close()
+
+    def _string(self, s):
+        """Return the number of a string, adding it to the table."""
+        n = self._strings.get(s)
+        if n is None:
+            n = self._strings[s] = len(self._strings)
+            self._new_strings.append(s)
+        return n
+
+    def _flush(self):
+        """Write the strings, bodies and records; call with _lock held."""
+        # records must only refer to strings and bodies already written
+        if self._new_strings:
+            self._strings_file.write(''.join([s + '\n'
+                                              for s in self._new_strings]))
+            self._strings_file.flush()
+            self._new_strings = []
+        if self._body_buffer:
+            self._bodies.write(self._body_buffer)
+            self._bodies.flush()
+            self._body_buffer = bytearray()
+        if self._buffered:
+            self._records.write(
+                memoryview(self._buffer)[:self._buffered * RECORD.size])
+            self._records.flush()
+            self._buffered = 0
+
+class CommandLog(object):
+
+    """
+    A read-only view of a log, as a sequence of Commands.
+
+    The record and body files are memory-mapped, so opening a log reads
+    only its string table, and log[i] reads only record i.  The view is of
+    the log as it was when opened.
+
+    Attributes:
+      - path:    path of the record file
+      - strings: list of the robot names and pages in the log
+
+    """
+
+    def __init__(self, path):
+        """Open a log written by a CommandRecorder."""
+        self.path = path
+        self.strings = _read_strings(path)
+        self._files = []
+        self._records = self._map(path)
+        _check_header(self._records[:_HEADER.size], path)
+        self._bodies = self._map(path + '.bodies')
+        self._len = (len(self._records) - _HEADER.size) // RECORD.size
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('record index out of range')
+        t, elapsed, name, page, status, length, offset = RECORD.unpack_from(
+            self._records, _HEADER.size + i * RECORD.size)
+        body = None
+        if offset >= 0:
+            body = self._bodies[offset:offset + length]
+        return Command(t, elapsed, self.strings[name], self.strings[page],
+                       status, length, body)
+
+    def __iter__(self):
+        for i in xrange(self._len):
+            yield self[i]
+
+    def time(self, i):
+        """Return the time of record i, without decoding the rest of it."""
+        return struct.unpack_from('<d', self._records,
+                                  _HEADER.size + i * RECORD.size)[0]
+
+    def index(self, t):
+        """Return the index of the first command at or after time t."""
+        low, high = 0, self._len
+        while low < high:
+            mid = (low + high) // 2
+            if self.time(mid) < t:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def between(self, start=None, end=None):
+        """
+        Generate the commands from time start up to (not including) end.
+
+        Parameters:
+          - start: first time (default None, from the first command)
+          - end:   end time (default None, up to the last command)
+
+        """
+        i = 0 if start is None else self.index(start)
+        j = self._len if end is None else self.index(end)
+        for k in xrange(i, j):
+            yield self[k]
+
+    def close(self):
+        """Unmap the files."""
+        for f, m in self._files:
+            if m is not None:
+                m.close()
+            f.close()
+        self._files = []
+
+    def _map(self, path):
+        """Return a read-only map of a file ('' if it is empty)."""
+        f = open(path, 'rb')
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            self._files.append((f, None))
+            return ''
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files.append((f, m))
+        return m
+
+def replay(log, rovio_, speed=1.0, start=None, end=None, name=None,
+           select=None):
+    """
+    Send the commands of a log to a Rovio again, on the original schedule.
+
+    Each command is sent (speed times faster) when it was sent relative to
+    the first command replayed; a command whose time has passed is sent at
+    once.  Failed commands are logged and counted, and the replay goes on.
+
+    Parameters:
+      - log:    a CommandLog
+      - rovio_: the Rovio to send the commands to
+      - speed:  factor to speed up the replay by (default 1, None sends the
+                commands back to back)
+      - start:  time of the first command replayed (default None, the first)
+      - end:    time to stop the replay at (default None, the end)
+      - name:   replay only the commands sent to the Rovio named name
+                (default None, every command)
+      - select: function of a page returning True to replay it (default
+                None, every page)
+
+    Return a dict with the number of commands sent, the number of errors,
+    the number of commands whose HTTP status differed from the recording
+    (mismatches) and the largest lateness in seconds behind the schedule.
+
+    """
+    sent = errors = mismatches = 0
+    lateness = 0.0
+    first = None
+    for command in log.between(start, end):
+        if name is not None and command.rovio != name:
+            continue
+        if select is not None and not select(command.page):
+            continue
+        if speed is not None:
+            if first is None:
+                first = command.sent
+                began = time.time()
+            due = began + (command.sent - first) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lateness = max(lateness, -delay)
+        sent += 1
+        try:
+            rovio_._request(command.page)
+            status = 200
+        except urllib2.HTTPError, e:
+            status = e.code
+        except Exception:
+            rovio.rlog.exception('Error replaying %s on %s', command.page,
+                                 rovio_.name)
+            errors += 1
+            status = 0
+        # a followed redirect counts as a success
+        if (status != command.status and
+            not (200 <= status < 400 and 200 <= command.status < 400)):
+            mismatches += 1
+    return {'sent': sent, 'errors': errors, 'mismatches': mismatches,
+            'lateness': lateness}
+
+def _check_header(header, path):
+    """Raise RovioError unless header is that of a log."""
+    if len(header) < _HEADER.size:
+        raise rovio.RovioError('%s is not a command log' % path)
+    magic, version, size = _HEADER.unpack(header)
+    if magic != _MAGIC:
+        raise rovio.RovioError('%s is not a command log' % path)
+    if version != _VERSION or size != RECORD.size:
+        raise rovio.RovioError('unsupported command log version %d' % version)
+
+def _read_strings(path):
+    """Return the string table of a log as a list."""
+    try:
+        f = open(path + '.strings', 'rb')
+    except IOError:
+        return []
+    try:
+        return f.read().splitlines()
+    finally:
+        f.close()
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # record a drive on one simulated Rovio, replay it on another
+    import shutil
+    import tempfile
+    import simulator
+    servers = simulator.start_fleet(2)
+    r1 = rovio.Rovio('sim1', servers[0].host, port=servers[0].port)
+    r2 = rovio.Rovio('sim2', servers[1].host, port=servers[1].port)
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'session.rcl')
+    recorder = CommandRecorder(path, max_body=512, buffer_size=64)
+    recorder.attach(r1)
+    r1.change_resolution(1)
+    r1.get_image()
+    for command, n in ((1, 10), (5, 5), (3, 8)):
+        for i in range(n):
+            r1.manual_drive(command, 3)
+            r1.get_report(record=True)
+            time.sleep(0.1)
+    r1.drive_sequence([(1, 3, 300)])     # pipelined, recorded all the same
+    start = time.time()
+    for i in range(10000):
+        recorder.record('bench', 'rev.cgi?Cmd=nav&action=1', start, 200,
+                        'Cmd = nav\nresponses = 0')
+    elapsed = time.time() - start
+    recorder.close()
+    print '%.0f records/s, %d bytes per record' % (10000 / elapsed,
+                                                   RECORD.size)
+    log = CommandLog(path)
+    print len(log), 'commands,', len(log.strings), 'strings'
+    assert log[0].page.startswith('ChangeResolution.cgi')
+    assert log[1].body is None and log[1].length > recorder.max_body
+    assert log[2].body.startswith('Cmd = nav')
+    assert log.index(log[10].time) <= 10 < log.index(log[10].time + 1e-6)
+    assert len([c for c in log if 'action=18&' in c.page]) == 23 + 4
+    time.sleep(0.3)      # let sim1 stop
+    t = time.time()
+    result = replay(log, r2, name='sim1')
+    print 'replayed in %.2f s: %r' % (time.time() - t, result)
+    print 'recorded pose', servers[0].robot.pose
+    print 'replayed pose', servers[1].robot.pose
+    assert result['sent'] == len(log) - 10000
+    assert result['errors'] == result['mismatches'] == 0
+    log.close()
+    shutil.rmtree(tmp)
+    r1.pool.close()
+    r2.pool.close()
+    simulator.stop_fleet(servers)
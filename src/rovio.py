@@ -7,9 +7,20 @@ provides some additional support methods for parsing the responses.
 
 Classes:
   - Rovio: Access to an instance of a Rovio mobile webcam
+  - RovioController: Timed command queue for a Rovio
+  - ConnectionPool: Persistent HTTP/1.1 connections to one Rovio
+  - CircuitBreaker: Fails requests fast while a Rovio is unreachable
+  - Future: Result of a command that may not have completed yet
+  - Report: Compact record of a get_report response
+  - Status: Compact record of a get_status response
+  - MCUReport: Decoded record of a get_MCU_report response
 
 Exceptions:
   - RovioError: base class for Rovio-related exceptions
+  - ConnectError: a Rovio could not be reached (a urllib2.URLError)
+  - CircuitOpenError: a request was refused because a Rovio is down
+  - CancelledError: a Future was cancelled
+  - TimeoutError: a Future did not complete in time
 
 Handlers:
   - NullHandler: do-nothing handler for logging
@@ -17,6 +28,7 @@ Handlers:
 Module Attributes:
   - rovios: a map of Rovio names to Rovio objects
   - rlog: logging.Logger object for logging
+  - metrics: object receiving request timings (default None; see metrics.py)
 
 Module Functions:
   - getRovio: return the rovio object with the given name
@@ -30,6 +42,7 @@ Module Constants:
   - COPYRIGHT
   - LICENSE
   - USER_AGENT: For use with HTTP requests
+  - DEFAULT_TIMEOUT: Default socket timeout of requests in seconds
   - response_codes: map of response codes to [name, docstring]
     
     Response Code Commands Table
@@ -75,8 +88,20 @@ Public License (UBPL) version 1.0 (see license.txt).
 """
 
 import base64
+import binascii
+import collections
+import heapq
+import httplib
+import itertools
+import socket
 import urllib2
+import urlparse
 import logging
+import math
+import random
+import re
+import select
+import struct
 import threading
 import time
 
@@ -100,6 +125,8 @@ LICENSE = 'UBPL v1.0'
 ####################
 
 USER_AGENT = 'PyRovio/%s' % __version__
+DEFAULT_TIMEOUT = 10.0
+"""Default socket timeout of requests in seconds"""
 
 # Response Code Commands
 SUCCESS                          = 0
@@ -188,6 +215,30 @@ response_codes = {
 rovios = dict()
 """Map of Rovio names to interface objects"""
 rlog = logging.getLogger('rovio')
+metrics = None
+"""Receiver of request timings: an object with methods observe(name, action,
+phase, seconds) and error(name, action), or None to not time requests"""
+
+_RESET_ERRORS = (socket.error, httplib.BadStatusLine,
+                 httplib.CannotSendRequest, httplib.ResponseNotReady)
+"""Errors meaning a kept-alive connection was dropped by the Rovio"""
+_REDIRECTS = (301, 302, 303, 307)
+_INT_RE = re.compile(r'[-+]?\d+\Z')
+_ACTION_RE = re.compile(r'[?&]action=(\d+)')
+_ORDERED_ACTIONS = frozenset([2, 3, 4, 5, 7, 8, 9, 10, 11, 12, 13, 14, 15, 17,
+                              18, 21, 27])
+"""rev.cgi actions that drive the Rovio or change its paths (see rconst)"""
+
+# Decoding tables for get_report and get_status
+_RESOLUTIONS = {0: (176, 144), 1: (320, 240), 2: (352, 240), 3: (640, 480)}
+_HEAD_POSITIONS = tuple(['high'] * 135 + ['mid'] * 6 + ['low'] * 115)
+_AC_FREQS = {1: 50, 2: 60}
+_STATES = {0: 'idle', 1: 'driving home', 2: 'docking', 3: 'executing path',
+           4: 'recording path'}
+
+# Layout of the get_MCU_report payload (see Rovio.get_MCU_report)
+_MCU_STRUCT = struct.Struct('>BBBHBHBHBBBB')
+_MCU_DIRECTION = 0x04
 
 ####################
 # MODULE FUNCTIONS #
@@ -197,6 +248,32 @@ def getRovio(name):
     """Return the Rovio object named by name."""
     return rovios[name]
 
+def _head_position(raw):
+    """Return 'high', 'mid' or 'low' for a raw head position."""
+    if 0 <= raw < len(_HEAD_POSITIONS):
+        return _HEAD_POSITIONS[raw]
+    return 'high' if raw < 135 else 'low'
+
+def _action_label(page):
+    """
+    Return the metrics label of a command page: the CGI path, with the
+    action number for rev.cgi commands (e.g. 'rev.cgi:18').
+
+    """
+    path = page.split('?', 1)[0]
+    if path == 'rev.cgi':
+        m = _ACTION_RE.search(page)
+        if m is not None:
+            return 'rev.cgi:' + m.group(1)
+    return path
+
+def _is_ordered(page):
+    """Return True if a command page drives the Rovio or changes its paths."""
+    if not page.startswith('rev.cgi'):
+        return False
+    m = _ACTION_RE.search(page)
+    return m is not None and int(m.group(1)) in _ORDERED_ACTIONS
+
 ###########
 # CLASSES #
 ###########
@@ -211,20 +288,43 @@ rlog.addHandler(NullHandler())
 class RovioError(Exception):
     """Base class for errors in the Rovio package."""
 
-class ConnectError(RovioError):
+class ConnectError(RovioError, urllib2.URLError):
     """
     Exception raised for error connecting to the Rovio.
 
+    This includes requests that time out.  It is also a urllib2.URLError,
+    which is what connection errors were raised as before.
+
     Attributes:
       - rovio:   Rovio object
+      - reason:  the underlying error (or None)
       - message: explanation of the error
 
     """
 
-    def __init__(self, rovio):
+    def __init__(self, rovio, reason=None):
+        urllib2.URLError.__init__(self, reason)
         self.rovio = rovio
         self.message = ('Error connecting to %s (host: %s)' %
                         (self.rovio.name, self.rovio.host))
+        if reason is not None:
+            self.message += ': %s' % (reason,)
+
+    def __str__(self):
+        return self.message
+
+class CircuitOpenError(ConnectError):
+    """
+    Exception raised instead of making a request to a Rovio that is down.
+
+    See CircuitBreaker.
+
+    """
+
+    def __init__(self, rovio):
+        ConnectError.__init__(self, rovio)
+        self.message = ('%s (host: %s) is not responding; not sending the '
+                        'request' % (self.rovio.name, self.rovio.host))
 
 class ResponseError(RovioError):
     """
@@ -282,7 +382,842 @@ class OutOfRangeError(ParamError):
         self.range = range_
         self.value = value
 
-class Rovio:
+class CancelledError(RovioError):
+    """Exception raised when the result of a cancelled Future is requested."""
+
+class TimeoutError(RovioError):
+    """Exception raised when a Future does not complete in time."""
+
+class Future(object):
+
+    """
+    The result of a command that may not have completed yet.
+
+    The interface follows concurrent.futures.Future: result() and exception()
+    block until the command completes, done callbacks are called with the
+    future once it completes, and a pending future can be cancelled.
+
+    Futures are completed by whoever runs the command, using set_result or
+    set_exception.
+
+    """
+
+    _PENDING = 'PENDING'
+    _RUNNING = 'RUNNING'
+    _CANCELLED = 'CANCELLED'
+    _FINISHED = 'FINISHED'
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = self._PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        Cancel the command if it has not started.
+
+        Return True if the future is cancelled.
+
+        """
+        with self._condition:
+            if self._state in (self._RUNNING, self._FINISHED):
+                return False
+            if self._state != self._CANCELLED:
+                self._state = self._CANCELLED
+                self._condition.notifyAll()
+        self._invoke_callbacks()
+        return True
+
+    def cancelled(self):
+        """Return True if the future was cancelled."""
+        return self._state == self._CANCELLED
+
+    def running(self):
+        """Return True if the command is running."""
+        return self._state == self._RUNNING
+
+    def done(self):
+        """Return True if the future was cancelled or has completed."""
+        return self._state in (self._CANCELLED, self._FINISHED)
+
+    def result(self, timeout=None):
+        """
+        Return the result of the command, waiting up to timeout seconds.
+
+        Raise the command's exception if it failed, CancelledError if the
+        future was cancelled, or TimeoutError if it did not complete in time.
+
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Return the exception raised by the command (None if it succeeded).
+
+        Waits like result().
+
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn(future) when the future completes (now if it is done)."""
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        self._call(fn)
+
+    def set_running_or_notify_cancel(self):
+        """
+        Mark the future as running.
+
+        Return False if it was cancelled, in which case the command should not
+        be run.
+
+        """
+        with self._condition:
+            if self._state == self._CANCELLED:
+                return False
+            self._state = self._RUNNING
+            return True
+
+    def set_result(self, result):
+        """Complete the future with the command's result."""
+        with self._condition:
+            self._result = result
+            self._state = self._FINISHED
+            self._condition.notifyAll()
+        self._invoke_callbacks()
+
+    def set_exception(self, exception):
+        """Complete the future with the command's exception."""
+        with self._condition:
+            self._exception = exception
+            self._state = self._FINISHED
+            self._condition.notifyAll()
+        self._invoke_callbacks()
+
+    def _wait(self, timeout):
+        """Wait for completion; raise CancelledError or TimeoutError."""
+        with self._condition:
+            if not self.done():
+                self._condition.wait(timeout)
+            if self._state == self._CANCELLED:
+                raise CancelledError()
+            if self._state != self._FINISHED:
+                raise TimeoutError()
+
+    def _invoke_callbacks(self):
+        with self._condition:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._call(fn)
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            rlog.exception('Exception in callback %r of %r', fn, self)
+
+class _TicketLock(object):
+
+    """
+    A lock granted in the order it was asked for.
+
+    threading.Lock wakes an arbitrary waiter, so commands waiting for it can
+    overtake each other; a ticket lock serves its waiters first come, first
+    served.  Not reentrant.
+
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._next = 0
+        self._serving = 0
+
+    def acquire(self):
+        with self._cond:
+            ticket = self._next
+            self._next += 1
+            while self._serving != ticket:
+                self._cond.wait()
+
+    def release(self):
+        with self._cond:
+            self._serving += 1
+            self._cond.notifyAll()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class ConnectionPool(object):
+
+    """
+    A pool of persistent HTTP/1.1 connections to one Rovio.
+
+    Connections are kept open between requests so that repeated commands (for
+    example manual_drive at 10 Hz) do not pay for a TCP handshake each time.
+    Idle connections older than idle_timeout are closed rather than reused.  A
+    request on a reused connection that the Rovio has reset is retried once on
+    a fresh connection.
+
+    The pool never blocks: if every connection is busy a new one is opened,
+    and connections beyond size are closed when they are released.
+
+    Attributes:
+      - host:         hostname or IP address of the Rovio
+      - port:         HTTP port
+      - size:         maximum number of idle connections kept open (0 opens a
+                      new connection for every request)
+      - idle_timeout: seconds an idle connection may be kept open
+      - timeout:      socket timeout in seconds (default None, blocking)
+
+    """
+
+    def __init__(self, host, port=80, size=2, idle_timeout=30.0, timeout=None):
+        """
+        Initialize a new, empty connection pool.
+
+        Parameters:
+          - host:         hostname or IP address
+          - port:         HTTP port (default 80)
+          - size:         maximum number of idle connections (default 2)
+          - idle_timeout: seconds to keep an idle connection (default 30)
+          - timeout:      socket timeout in seconds (default None)
+
+        """
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def request(self, path, headers=None, buffers=None, timings=None,
+                timeout=None):
+        """
+        Send a GET request and read the whole response.
+
+        Parameters:
+          - path:    absolute path of the request, e.g. '/rev.cgi?Cmd=nav'
+          - headers: dict of extra request headers (default None)
+          - buffers: a video.FrameRing to read the body into (default None,
+                     read it into a new string)
+          - timings: dict to store the seconds taken by each phase of the
+                     request in (default None): 'connect' (only for a new
+                     connection), 'ttfb' (sending the request and receiving
+                     the response headers) and 'body'
+          - timeout: socket timeout in seconds for this request (default
+                     None, self.timeout)
+
+        Return a tuple (status, reason, headers, body).  With buffers, body is
+        a memoryview of one of its buffers.
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+        conn, reused = self._acquire()
+        try:
+            try:
+                self._set_timeout(conn, timeout)
+                response, body = self._send(conn, path, headers, buffers,
+                                            timings)
+            except socket.timeout:
+                raise
+            except _RESET_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                # the Rovio dropped an idle keep-alive connection
+                rlog.debug('Connection to %s:%d reset, reconnecting',
+                           self.host, self.port)
+                conn = self._connect()
+                self._set_timeout(conn, timeout)
+                response, body = self._send(conn, path, headers, buffers,
+                                            timings)
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return response.status, response.reason, response.msg, body
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, last_used in idle:
+            conn.close()
+
+    def _send(self, conn, path, headers, buffers=None, timings=None):
+        """Send one request on conn and return (response, body)."""
+        if timings is not None:
+            start = time.time()
+            if conn.sock is None:
+                conn.connect()
+                now = time.time()
+                timings['connect'] = now - start
+                start = now
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        if timings is not None:
+            now = time.time()
+            timings['ttfb'] = now - start
+            start = now
+        if buffers is None:
+            body = response.read()
+        else:
+            body = self._read_into(conn, response, buffers)
+        if timings is not None:
+            timings['body'] = time.time() - start
+        return response, body
+
+    def _set_timeout(self, conn, timeout):
+        """Set the socket timeout of conn (None for blocking)."""
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        if conn.timeout != timeout:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    conn.sock.settimeout(socket.getdefaulttimeout())
+                else:
+                    conn.sock.settimeout(timeout)
+
+    def _read_into(self, conn, response, buffers):
+        """Read the body of response into one of buffers."""
+        length = response.length
+        if (length is None or response.chunked or response.will_close or
+            conn.sock is None):
+            return buffers.copy(response.read())
+        # the response reads its headers unbuffered, so the body can be
+        # received straight from the socket into the buffer
+        view = memoryview(buffers.acquire(length))[:length]
+        got = 0
+        while got < length:
+            n = conn.sock.recv_into(view[got:])
+            if n == 0:
+                raise httplib.IncompleteRead(view[:got].tobytes(),
+                                             length - got)
+            got += n
+        response.length = 0
+        response.close()
+        return view
+
+    def _acquire(self):
+        """Return (connection, reused), preferring the most recent idle one."""
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._connect(), False
+
+    def _release(self, conn):
+        """Return conn to the pool, or close it if the pool is full."""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _connect(self):
+        """Return a new (not yet connected) HTTP connection."""
+        if self.timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        else:
+            timeout = self.timeout
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+
+class _PipelinedConnection(object):
+
+    """
+    One keep-alive connection with several requests in flight at once.
+
+    Requests are written as soon as they are sent, without waiting for the
+    responses to the earlier ones; a reader thread reads the responses in
+    order and completes the future of each request with (status, reason,
+    headers, body).  If the connection fails or the Rovio closes it, the
+    unanswered requests fail with urllib2.URLError.
+
+    The timeout applies only while responses are outstanding: a request
+    fails if its response has not started timeout seconds after it was
+    sent, but an idle connection is kept open indefinitely.
+
+    If account is given, it is called on the reader thread as each request
+    completes, before its future, with the page (without the leading '/'),
+    the time it was sent, the status (0 if it failed), the body (or None)
+    and its timings (ttfb, from sending it, and body), like
+    Rovio._account.
+
+    """
+
+    def __init__(self, host, port=80, headers=None, timeout=None,
+                 max_in_flight=8, account=None):
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        self.host = host
+        self._headers = headers or {}
+        self._account = account
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_in_flight)
+        self._error = None
+        try:
+            self._sock = socket.create_connection((host, port), timeout)
+        except socket.error, e:
+            raise urllib2.URLError(e)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._timeout = self._sock.gettimeout()
+        self._reader = threading.Thread(target=self._read_responses)
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+    def send(self, path):
+        """Write a GET request for path and return the future response."""
+        return self.send_prepared(self.prepare(path))
+
+    def prepare(self, path):
+        """Return the bytes of a GET request for path."""
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % self.host]
+        for item in self._headers.items():
+            lines.append('%s: %s' % item)
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def send_prepared(self, data):
+        """Write a request prepared by prepare and return its future."""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._slots.acquire()
+        with self._lock:
+            if self._error is not None:
+                self._slots.release()
+                raise self._error
+            # queue the future first: the response may come back at once
+            self._pending.append((future, time.time(), data))
+            try:
+                self._sock.sendall(data)
+            except socket.error, e:
+                self._pending.pop()
+                self._slots.release()
+                raise urllib2.URLError(e)
+        return future
+
+    def close(self):
+        """Close the connection; unanswered requests fail."""
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        self._reader.join()
+
+    def _read_responses(self):
+        f = self._sock.makefile('rb')
+        error = None
+        try:
+            while True:
+                # f._rbuf holds the bytes already read but not consumed
+                if not f._rbuf.tell():
+                    self._wait_for_response()
+                line = f.readline()
+                if not line:
+                    break
+                started = time.time()
+                try:
+                    version, status, reason = (line.split(None, 2) +
+                                               [''])[:3]
+                    status = int(status)
+                except ValueError:
+                    raise httplib.BadStatusLine(line)
+                headers = httplib.HTTPMessage(f, 0)
+                length = headers.getheader('content-length')
+                close = (version == 'HTTP/1.0' or
+                         'close' in (headers.getheader('connection') or
+                                     '').lower())
+                if length is None:
+                    body = f.read()
+                    close = True
+                else:
+                    body = f.read(int(length))
+                with self._lock:
+                    future, sent, data = self._pending.popleft()
+                self._slots.release()
+                if self._account is not None:
+                    timings = {'ttfb': started - sent,
+                               'body': time.time() - started}
+                    self._report(data, sent, status, body, timings)
+                future.set_result((status, reason.strip(), headers, body))
+                if close:
+                    break
+        except (socket.error, select.error, httplib.HTTPException,
+                IndexError), e:
+            error = e
+        f.close()
+        with self._lock:
+            self._error = urllib2.URLError(error or 'connection closed')
+            pending, self._pending = self._pending, collections.deque()
+        for future, sent, data in pending:
+            self._slots.release()
+            if self._account is not None:
+                self._report(data, sent, 0, None, None)
+            future.set_exception(self._error)
+
+    def _report(self, data, sent, status, body, timings):
+        """Pass a completed request to account."""
+        try:
+            page = data.split(' ', 2)[1][1:]
+            self._account(page, sent, status, body, timings)
+        except Exception:
+            rlog.exception('Exception accounting for a pipelined request')
+
+    def _wait_for_response(self):
+        """
+        Wait until the socket is readable.
+
+        Raise socket.timeout if the oldest unanswered request was sent more
+        than timeout seconds ago; wait with no limit while none is pending.
+
+        """
+        if self._timeout is None:
+            return
+        while True:
+            with self._lock:
+                if self._pending:
+                    wait = self._pending[0][1] + self._timeout - time.time()
+                else:
+                    wait = self._timeout
+            if wait <= 0:
+                raise socket.timeout('timed out')
+            if select.select([self._sock], [], [], wait)[0]:
+                return
+
+class CircuitBreaker(object):
+
+    """
+    Fails requests to a Rovio fast while it is not responding.
+
+    The breaker is closed (requests are made) until threshold requests in a
+    row fail to connect or time out; it then opens, and requests are refused
+    without being made.  After reset_timeout seconds one request is let
+    through as a probe (half-open): if it succeeds the breaker closes, if it
+    fails the breaker stays open for another reset_timeout seconds.
+
+    A robot that has dropped off the network thus costs a fleet loop one
+    timeout per reset_timeout instead of one per command.
+
+    Attributes:
+      - state:         CLOSED, OPEN or HALF_OPEN (read-only)
+      - threshold:     consecutive failures that open the breaker
+      - reset_timeout: seconds before a probe request is let through
+      - failures:      current number of consecutive failures
+      - rejected:      number of requests refused
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def getState(self): return self._state
+    state = property(getState, doc="""CLOSED, OPEN or HALF_OPEN (read-only)""")
+
+    def __init__(self, threshold=5, reset_timeout=5.0):
+        """
+        Initialize a closed breaker.
+
+        Parameters:
+          - threshold:     consecutive failures that open the breaker
+                           (default 5)
+          - reset_timeout: seconds before a probe request (default 5)
+
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.rejected = 0
+        self._state = self.CLOSED
+        self._opened = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a request may be made now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            now = time.time()
+            if now - self._opened >= self.reset_timeout:
+                # let one probe through; the next waits another reset_timeout
+                self._state = self.HALF_OPEN
+                self._opened = now
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        """Record a request that got a response."""
+        with self._lock:
+            if self._state != self.CLOSED:
+                rlog.info('Circuit closed after %d failures', self.failures)
+            self._state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        """Record a request that failed to connect or timed out."""
+        with self._lock:
+            self.failures += 1
+            if (self._state == self.HALF_OPEN or
+                self.failures >= self.threshold):
+                if self._state == self.CLOSED:
+                    rlog.warning('Circuit opened after %d failures',
+                                 self.failures)
+                self._state = self.OPEN
+                self._opened = time.time()
+
+    def reset(self):
+        """Close the breaker."""
+        with self._lock:
+            self._state = self.CLOSED
+            self.failures = 0
+
+_REPORT_KEYS = ('responses', 'x', 'y', 'theta', 'room', 'ss', 'beacon',
+                'beacon_x', 'next_room', 'next_room_ss', 'state', 'ui_status',
+                'resistance', 'sm', 'pp', 'flags', 'brightness', 'resolution',
+                'video_compression', 'frame_rate', 'privilege', 'user_check',
+                'speaker_volume', 'mic_volume', 'wifi_ss', 'show_time',
+                'ddns_state', 'email_state', 'battery', 'charging',
+                'head_position', 'ac_freq')
+"""Keys of a get_report response, in the order of the Report fields"""
+
+class Report(collections.namedtuple('Report', [
+        'raw_' + k if k in ('resolution', 'head_position', 'ac_freq') else k
+        for k in _REPORT_KEYS])):
+
+    """
+    A compact, immutable record of a get_report response.
+
+    Reports have the fields of the get_report dictionary as attributes (see
+    Rovio.get_report), but are tuples without a per-instance dictionary, so
+    they take a fraction of the memory of the dictionaries.  Only the raw
+    values are stored: resolution, head_position and ac_freq are decoded from
+    raw_resolution, raw_head_position and raw_ac_freq when they are read.
+    theta is a float.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, d):
+        """Return a Report of a parsed get_report response dictionary."""
+        get = d.get
+        values = [get(k) for k in _REPORT_KEYS]
+        if values[3] is not None:
+            values[3] = float(values[3])
+        return cls._make(values)
+
+    @property
+    def resolution(self):
+        """Size of the camera image as (horz, vert)."""
+        return _RESOLUTIONS.get(self.raw_resolution, self.raw_resolution)
+
+    @property
+    def head_position(self):
+        """'low', 'mid', or 'high'."""
+        if self.raw_head_position is None:
+            return None
+        return _head_position(self.raw_head_position)
+
+    @property
+    def ac_freq(self):
+        """Projector's frequency in Hz, or 0 if none."""
+        return _AC_FREQS.get(self.raw_ac_freq, self.raw_ac_freq)
+
+    def as_dict(self):
+        """Return the report as a get_report dictionary."""
+        d = dict(zip(self._fields, self))
+        d['Cmd'] = 'nav'
+        d['resolution'] = self.resolution
+        if isinstance(d['resolution'], tuple):
+            d['resolution'] = list(d['resolution'])
+        d['head_position'] = self.head_position
+        d['ac_freq'] = self.ac_freq
+        return d
+
+class Status(collections.namedtuple('Status', ['responses', 'raw_state'])):
+
+    """
+    A compact, immutable record of a get_status response.
+
+    The state name is decoded from raw_state when it is read.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, d):
+        """Return a Status of a parsed get_status response dictionary."""
+        return cls(d.get('responses'), d.get('state'))
+
+    @property
+    def state(self):
+        """'idle', 'driving home', 'docking', 'executing path', or
+        'recording path'."""
+        return _STATES.get(self.raw_state, self.raw_state)
+
+    def as_dict(self):
+        """Return the status as a get_status dictionary."""
+        d = dict(zip(self._fields, self))
+        d['Cmd'] = 'nav'
+        d['state'] = self.state
+        return d
+
+class MCUReport(collections.namedtuple('MCUReport', [
+        'length', 'left_direction', 'left_ticks', 'right_direction',
+        'right_ticks', 'rear_direction', 'rear_ticks', 'raw_head_position',
+        'battery', 'raw_status'])):
+
+    """
+    A decoded get_MCU_report payload.
+
+    The fields are the bytes of the payload as described in
+    Rovio.get_MCU_report, without the unused ones.  The encoder ticks are
+    counted since the previous MCU report; left, right and rear are the tick
+    counts signed by the wheels' direction bits.  The flags of the status
+    byte are decoded when they are read.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_hex(cls, payload):
+        """Return the MCUReport of a hex payload string."""
+        try:
+            values = _MCU_STRUCT.unpack_from(binascii.unhexlify(payload))
+        except (TypeError, struct.error):
+            raise RovioError('bad MCU report %r' % payload)
+        return cls(values[0], values[2], values[3], values[4], values[5],
+                   values[6], values[7], values[9], values[10], values[11])
+
+    @property
+    def left(self):
+        """Left wheel encoder ticks, negative when turning backward."""
+        if self.left_direction & _MCU_DIRECTION:
+            return -self.left_ticks
+        return self.left_ticks
+
+    @property
+    def right(self):
+        """Right wheel encoder ticks, negative when turning backward."""
+        if self.right_direction & _MCU_DIRECTION:
+            return -self.right_ticks
+        return self.right_ticks
+
+    @property
+    def rear(self):
+        """Rear wheel encoder ticks, negative when turning backward."""
+        if self.rear_direction & _MCU_DIRECTION:
+            return -self.rear_ticks
+        return self.rear_ticks
+
+    @property
+    def head_position(self):
+        """'low', 'mid', or 'high'."""
+        return _head_position(self.raw_head_position)
+
+    @property
+    def light(self):
+        """True if the head light is on."""
+        return bool(self.raw_status & 0x01)
+
+    @property
+    def ir_power(self):
+        """True if the IR radar is powered."""
+        return bool(self.raw_status & 0x02)
+
+    @property
+    def obstacle(self):
+        """True if the IR radar detects a barrier."""
+        return bool(self.raw_status & 0x04)
+
+    @property
+    def charger(self):
+        """Charger status: 0 nothing happening, 1 charging completed, 2 in
+        charging, 4 error."""
+        return (self.raw_status >> 3) & 0x07
+
+class _ResponseParser(object):
+
+    """
+    Parser for the key=value responses of the Rovio CGI commands.
+
+    A response is split into key=value tokens, and each distinct token is
+    decoded once and cached: most fields of a report (volumes, resolution,
+    battery, ...) are the same from one poll to the next, so repeated
+    responses are parsed with dictionary lookups instead of conversions.
+
+    Values that look like integers are converted to int, except for the keys
+    in strings.
+
+    """
+
+    def __init__(self, strings=('flags',), max_tokens=4096):
+        """
+        Initialize a parser.
+
+        Parameters:
+          - strings:    keys whose values are never converted to int
+          - max_tokens: size of the token cache before it is emptied
+
+        """
+        self._strings = frozenset(strings)
+        self._max_tokens = max_tokens
+        self._tokens = dict()
+
+    def parse(self, response):
+        """Return a dictionary of the response's key/value pairs."""
+        # split on | (bar), handling the Cmd=... lines specially
+        rlst = response.split('|')
+        rlst[0:1] = rlst[0].splitlines()
+        get = self._tokens.get
+        return dict([get(pair) or self._decode(pair) for pair in rlst])
+
+    def _decode(self, pair):
+        """Decode one key=value token into (key, value) and cache it."""
+        key, sep, val = pair.partition('=')
+        if not sep or '=' in val:
+            item = (pair.strip(), None)
+        else:
+            key = key.strip()
+            val = val.strip()
+            if key not in self._strings and _INT_RE.match(val):
+                val = int(val)
+            item = (key, val)
+        if len(self._tokens) >= self._max_tokens:
+            self._tokens.clear()
+        self._tokens[pair] = item
+        return item
+
+_PARSER = _ResponseParser()
+_MCU_PARSER = _ResponseParser(strings=('flags', 'responses'))
+"""The MCU report is a hex string, even if it happens to be all digits"""
+
+class Rovio(object):
     
     """
     An instance of the Rovio class provides an interface to one Rovio.
@@ -312,6 +1247,29 @@ class Rovio:
       - speed:    Default Rovio speed (1 fastest, 10 slowest, default 1)
       - username: HTTP Auth name (default None)
       - password: HTTP Auth password (default None)
+      - pool:     ConnectionPool shared by all commands (read-only)
+      - timeout:  socket timeout in seconds of commands (None blocks)
+
+    Attributes:
+      - timeouts: map of action labels to timeouts overriding timeout, e.g.
+                  {'Jpeg/CamImg.jpg': 20.0} (labels as in metrics.py)
+      - retries:  times an idempotent query (get_report, get_status,
+                  get_image) is retried after a connection error
+      - backoff:  base delay in seconds between retries
+      - breaker:  CircuitBreaker failing commands fast while the Rovio is
+                  not responding, or None
+      - recorder: replay.CommandRecorder logging every request, or None
+
+    A command that cannot reach the Rovio or times out raises ConnectError
+    (a urllib2.URLError); while the breaker is open, commands raise
+    CircuitOpenError at once.  Retries wait a random time of up to backoff
+    seconds, doubled for each retry.
+
+    A Rovio can be shared by several threads.  Its requests share the
+    connection pool, so queries made at the same time run in parallel on
+    separate connections, while drive and path commands are serialized: they
+    are sent one at a time, in the order they were called.  Setting host,
+    port, username or password is safe while requests are being made.
 
     Commands:
       - abort_recording
@@ -323,6 +1281,7 @@ class Rovio:
       - change_speaker_volume
       - clear_all_paths
       - delete_path
+      - drive_sequence:       pipelined, timed sequence of movement commands
       - email_image
       - get_data
       - get_host
@@ -390,8 +1349,9 @@ class Rovio:
     def get_port(self): return self._port
     def set_port(self, value):
         if 0 <= value <= 65535:
-            self._port = value
-            self._compile_URLs()
+            with self._lock:
+                self._port = value
+                self._compile_URLs()
         else:
             raise OutOfRangeError(self, 'port', [0, 65535], value)
     port = property(get_port, set_port,
@@ -414,8 +1374,9 @@ class Rovio:
     def get_username(self): return self._username
     def set_username(self, value):
         if (isinstance(value, str) or value is None):
-            self._username = value
-            self._compile_URLs()
+            with self._lock:
+                self._username = value
+                self._compile_URLs()
         else:
             raise ParamError(self, 'username', value,
                              'must be a string or None')
@@ -425,8 +1386,9 @@ class Rovio:
     def get_password(self): return self._password
     def set_password(self, value):
         if (isinstance(value, str) or value is None):
-            self._password = value
-            self._compile_URLs()
+            with self._lock:
+                self._password = value
+                self._compile_URLs()
         else:
             raise ParamError(self, 'password', value,
                              'must be a string or None')
@@ -439,25 +1401,58 @@ class Rovio:
     def get_host(self): return self._host
     def set_host(self, value):
         if (isinstance(value, str)):
-            self._host = value
-            self._compile_URLs()
+            with self._lock:
+                self._host = value
+                self._compile_URLs()
         else:
             raise ParamError(self, 'host', value, 'must be a valid URL string')
     host = property(get_host, set_host,
                     doc="""Hostname or IP address of the Rovio""")
+
+    def get_pool(self): return self._pool
+    pool = property(get_pool,
+                    doc="""ConnectionPool shared by all commands (read-only)""")
     
-    def __init__(self, name, host, username=None, password=None, port=80):
+    def get_timeout(self): return self._timeout
+    def set_timeout(self, value):
+        with self._lock:
+            self._timeout = value
+            if self._pool is not None:
+                self._pool.timeout = value
+    timeout = property(get_timeout, set_timeout,
+                       doc="""Socket timeout in seconds of commands (None
+                       blocks)""")
+
+    def __init__(self, name, host, username=None, password=None, port=80,
+                 pool_size=2, idle_timeout=30.0, timeout=DEFAULT_TIMEOUT,
+                 retries=2):
         """
         Initialize a new Rovio interface.
 
         Parameters:
-          - name:     name of this Rovio mobile webcam
-          - host:     hostname or IP address
-          - username: HTTP Auth name (default None)
-          - password: HTTP Auth password (default None)
-          - port:     HTTP port (default 80)
-
-        """
+          - name:         name of this Rovio mobile webcam
+          - host:         hostname or IP address
+          - username:     HTTP Auth name (default None)
+          - password:     HTTP Auth password (default None)
+          - port:         HTTP port (default 80)
+          - pool_size:    number of persistent connections kept open to the
+                          Rovio (default 2, 0 disables keep-alive)
+          - idle_timeout: seconds before an idle connection is dropped
+                          (default 30)
+          - timeout:      socket timeout of commands in seconds (default
+                          DEFAULT_TIMEOUT, None blocks)
+          - retries:      retries of idempotent queries (default 2)
+
+        """
+        self._timeout = timeout
+        self.timeouts = dict()
+        self.retries = retries
+        self.backoff = 0.05
+        self.breaker = CircuitBreaker()
+        self.recorder = None
+        self._lock = threading.RLock()
+        self._drive_lock = _TicketLock()
+        self._stops = 0
         self._name = name
         self._host = host
         self._username = username
@@ -465,6 +1460,9 @@ class Rovio:
         self._port = port
         self._protocol = 'http'
         self._speed = 1
+        self._pool = None
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
         self._compile_URLs()
         rovios[self.name] = self
 
@@ -552,12 +1550,17 @@ class Rovio:
         """Move camera head to middle position, looking ahead."""
         return self.manual_drive(13)
 
-    def get_report(self):
+    def get_report(self, record=False):
         """
         Get Rovio's current status.
 
         Generate a report from libNS module that provides Rovio's current
-        status.  Return a dictionary (keys are strings).
+        status.  Return a dictionary (keys are strings), or a Report if record
+        is True.  Reports have the same fields as attributes (except Cmd) and
+        take much less memory, for keeping long histories.
+
+        Parameters:
+          - record: return a Report instead of a dictionary (default False)
 
         Key                Description
         -----------------------------------------------------------------------
@@ -635,32 +1638,28 @@ class Rovio:
 
         """
         page = 'rev.cgi?Cmd=nav&action=%d' % (1,)
-        r = self._get_request_response(page)
-        d = self._parse_response(r)
+        if record:
+            return self._request(page, self._decode_report_record,
+                                 idempotent=True)
+        return self._request(page, self._decode_report, idempotent=True)
+
+    def _decode_report(self, response):
+        """Parse a get_report response and decode its derived fields."""
+        d = self._parse_response(response)
         if d['responses'] == SUCCESS:
             d['raw_resolution'] = d['resolution']
-            if d['raw_resolution'] == 0:
-                d['resolution'] = [176,144]
-            elif d['raw_resolution'] == 1:
-                d['resolution'] = [320,240]
-            elif d['raw_resolution'] == 2:
-                d['resolution'] = [352,240]
-            elif d['raw_resolution'] == 3:
-                d['resolution'] = [640,480]
+            if d['raw_resolution'] in _RESOLUTIONS:
+                d['resolution'] = list(_RESOLUTIONS[d['raw_resolution']])
             d['raw_head_position'] = d['head_position']
-            if d['raw_head_position'] < 135:
-                d['head_position'] = 'high'
-            elif d['raw_head_position'] > 140:
-                d['head_position'] = 'low'
-            else:
-                d['head_position'] = 'mid'
+            d['head_position'] = _head_position(d['raw_head_position'])
             d['raw_ac_freq'] = d['ac_freq']
-            if d['raw_ac_freq'] == 1:
-                d['ac_freq'] = 50
-            elif d['raw_ac_freq'] == 2:
-                d['ac_freq'] = 60
+            d['ac_freq'] = _AC_FREQS.get(d['raw_ac_freq'], d['raw_ac_freq'])
         return d
 
+    def _decode_report_record(self, response):
+        """Parse a get_report response into a Report."""
+        return Report.from_response(self._parse_response(response))
+
     def start_recording(self):
         """
         Start recording a path.
@@ -723,7 +1722,11 @@ class Rovio:
 
         """
         page = 'rev.cgi?Cmd=nav&action=%d' % (6,)
-        r = self._get_request_response(page).strip()
+        return self._request(page, self._decode_path_list)
+
+    def _decode_path_list(self, response):
+        """Return the list of path names in a get_path_list response."""
+        r = response.strip()
         if r.startswith('Cmd = nav\nresponses = 0'):
             p = r[24:]
             paths = p.split('|')
@@ -782,8 +1785,7 @@ class Rovio:
         """
         page = ('rev.cgi?Cmd=nav&action=%d&name=%s&newname=%s' %
                 (11, old_path_name, new_path_name))
-        r = self._get_request_response(page)
-        return self._parse_response(r)['responses']
+        return self._request(page, self._response_code)
 
     def go_home(self):
         """Drive to home location in front of charging station."""
@@ -811,20 +1813,24 @@ class Rovio:
     def get_tuning_parameters(self):
         """Return home, docking, and driving parameters."""
         page = 'rev.cgi?Cmd=nav&action=%d' % (16,)
-        r = self._get_request_response(page)
-        return self._parse_response(r)
+        return self._request(page, self._parse_response)
 
     def reset_nav_state_machine(self):
         """Stops whatever it was doing and resets to idle state."""
         return self._simple_rev_cmd(17)
 
-    def get_MCU_report(self):
+    def get_MCU_report(self, record=False):
         """
         Return MCU report (motor controller unit?).
 
         Including wheel encoders and IR obstacle avoidance.
 
-        Return a firmware-dependent byte sequence.
+        Return a firmware-dependent byte sequence as a hex string, or an
+        MCUReport decoded from it if record is True.
+
+        Parameters:
+          - record: return an MCUReport instead of the hex string (default
+                    False)
 
         WARNING: The following table is OUT OF DATE with version 5 of the
         firmware!
@@ -865,19 +1871,30 @@ class Rovio:
 
         """
         page = 'rev.cgi?Cmd=nav&action=%d' % (20,)
-        r = self._get_request_response(page)
-        d = self._parse_response(r)
-        return d['responses']
+        if record:
+            return self._request(page, self._decode_MCU_report_record)
+        return self._request(page, self._decode_MCU_report)
+
+    def _decode_MCU_report(self, response):
+        """Return the hex string of a get_MCU_report response."""
+        return _MCU_PARSER.parse(response)['responses']
+
+    def _decode_MCU_report_record(self, response):
+        """Decode a get_MCU_report response into an MCUReport."""
+        return MCUReport.from_hex(self._decode_MCU_report(response))
 
     def clear_all_paths(self):
         """Delete all paths in flash memory."""
         return self._simple_rev_cmd(21)
 
-    def get_status(self):
+    def get_status(self, record=False):
         """
         Report navigation state.
 
-        Return a dictionary:
+        Parameters:
+          - record: return a Status instead of a dictionary (default False)
+
+        Return a dictionary (or a Status with the same fields):
         {'responses': response code,
          'raw_state': 0 (idle)
                       1 (driving home)
@@ -889,22 +1906,23 @@ class Rovio:
 
         """
         page = 'rev.cgi?Cmd=nav&action=%d' % (22,)
-        r = self._get_request_response(page)
-        d = self._parse_response(r)
+        if record:
+            return self._request(page, self._decode_status_record,
+                                 idempotent=True)
+        return self._request(page, self._decode_status, idempotent=True)
+
+    def _decode_status(self, response):
+        """Parse a get_status response and decode its state."""
+        d = self._parse_response(response)
         if d['responses'] == SUCCESS:
             d['raw_state'] = d['state']
-            if d['raw_state'] == 0:
-                d['state'] = 'idle'
-            elif d['raw_state'] == 1:
-                d['state'] = 'driving home'
-            elif d['raw_state'] == 2:
-                d['state'] = 'docking'
-            elif d['raw_state'] == 3:
-                d['state'] = 'executing path'
-            elif d['raw_state'] == 4:
-                d['state'] = 'recording path'
+            d['state'] = _STATES.get(d['raw_state'], d['raw_state'])
         return d
 
+    def _decode_status_record(self, response):
+        """Parse a get_status response into a Status."""
+        return Status.from_response(self._parse_response(response))
+
     def save_parameter(self, index, value):
         """
         Stores parameter in the robot's flash.
@@ -919,8 +1937,7 @@ class Rovio:
         """
         page = ('rev.cgi?Cmd=nav&action=%d&index=%d&value=%d' %
                 (23, index, value))
-        r = self._get_request_response(page)
-        return self._parse_response(r)
+        return self._request(page, self._parse_response)
 
     def read_parameter(self, index):
         """
@@ -934,8 +1951,7 @@ class Rovio:
         """
         page = ('rev.cgi?Cmd=nav&action=%d&index=%d' % (24,
                                                         index))
-        r = self._get_request_response(page)
-        return self._parse_response(r)
+        return self._request(page, self._parse_response)
 
     def read_all_parameters(self):
         """
@@ -945,14 +1961,16 @@ class Rovio:
 
         """
         page = 'rev.cgi?Cmd=nav&action=%d' % 24
-        r = self._get_request_response(page)
-        return self._parse_response(r)
+        return self._request(page, self._parse_response)
 
     def get_libNS_version(self):
         """Return string version of libNS and NS sensor."""
         page = 'rev.cgi?Cmd=nav&action=%d' % (25,)
-        r = self._get_request_response(page)
-        return self._parse_response(r)['version']
+        return self._request(page, self._decode_libNS_version)
+
+    def _decode_libNS_version(self, response):
+        """Return the version string in a get_libNS_version response."""
+        return self._parse_response(response)['version']
 
     def email_image(self, email):
         """
@@ -964,8 +1982,7 @@ class Rovio:
         """
         page = ('rev.cgi?Cmd=nav&action=%d&email=%d' % (26,
                                                         email))
-        r = self._get_request_response(page)
-        return self._parse_response(r)
+        return self._request(page, self._parse_response)
 
     def reset_home_location(self):
         """Clear home location in flash memory."""
@@ -992,13 +2009,58 @@ class Rovio:
 
         """
         if imgID is None:
-            return self._get_request_response('Jpeg/CamImg.jpg')
+            return self._request('Jpeg/CamImg.jpg', idempotent=True)
         else:
-            return self._get_request_response('Jpeg/CamImg%d.jpg' % imgID)
+            return self._request('Jpeg/CamImg%d.jpg' % imgID,
+                                 idempotent=True)
 
-    def stream_video(self):
-        """Streaming video not yet supported."""
-        return None
+    def get_image_into(self, buffers, imgID=None):
+        """
+        Acquire an image from the Rovio webcam into a reusable buffer.
+
+        The image is received straight into the next buffer of a
+        video.FrameRing, without allocating a new string per image.  The
+        returned memoryview stays valid until the ring has wrapped around.
+
+        Parameters:
+          - buffers: video.FrameRing to read the image into
+          - imgID:   optional integer value for image tagging (default None)
+
+        Return a memoryview of a JPEG image.
+
+        """
+        if imgID is None:
+            return self._request('Jpeg/CamImg.jpg', buffers=buffers,
+                                 idempotent=True)
+        else:
+            return self._request('Jpeg/CamImg%d.jpg' % imgID, buffers=buffers,
+                                 idempotent=True)
+
+    def stream_video(self, buffer=2, policy='block', ring=None,
+                     timeout=None):
+        """
+        Stream MJPEG video from the Rovio webcam.
+
+        Parameters:
+          - buffer:  maximum number of frames buffered for the caller
+                     (default 2)
+          - policy:  'block' to slow the stream down, or 'drop_oldest' to
+                     drop buffered frames, when the caller falls behind
+                     (default 'block')
+          - ring:    video.FrameRing to receive frames into, yielding
+                     memoryviews instead of new strings (default None)
+          - timeout: seconds without data after which the stream fails
+                     (default None, timeouts['GetData.cgi'] or self.timeout)
+
+        Return a video.MJPEGStream, an iterator of JPEG images.  Close it when
+        done.
+
+        """
+        import video
+        if timeout is None:
+            timeout = self.timeouts.get(video.STREAM_PAGE, self.timeout)
+        return video.MJPEGStream(self, buffer, policy, timeout=timeout,
+                                 ring=ring)
 
     def change_resolution(self, ResType=2, RedirectURL=None):
         """
@@ -1020,7 +2082,7 @@ class Rovio:
         else:
             page = ('ChangeResolution.cgi?ResType=%d&RedirectURL=%s' %
                     (ResType, RedirectURL))
-        return self._get_request_response(page)
+        return self._request(page)
         
     def change_compress_ratio(self, Ratio=1, RedirectURL=None):
         """
@@ -1038,7 +2100,7 @@ class Rovio:
         else:
             page = ('ChangeCompressRatio.cgi?Ratio=%d&RedirectURL=%s' %
                     (Ratio, RedirectURL))
-        return self._get_request_response(page)
+        return self._request(page)
         
     def change_framerate(self, Framerate=30, RedirectURL=None):
         """
@@ -1056,7 +2118,7 @@ class Rovio:
         else:
             page = ('ChangeFramerate.cgi?Framerate=%d&RedirectURL=%s' %
                     (Framerate, RedirectURL))
-        return self._get_request_response(page)
+        return self._request(page)
         
     def change_brightness(self, Brightness=6, RedirectURL=None):
         """
@@ -1074,7 +2136,7 @@ class Rovio:
         else:
             page = ('ChangeBrightness.cgi?Brightness=%d&RedirectURL=%s' %
                     (Brightness, RedirectURL))
-        return self._get_request_response(page)
+        return self._request(page)
         
     def change_speaker_volume(self, SpeakerVolume=15, RedirectURL=None):
         """
@@ -1093,7 +2155,7 @@ class Rovio:
         else:
             page = ('ChangeSpeakerVolume.cgi?SpeakerVolume=%d&RedirectURL=%s' %
                     (SpeakerVolume, RedirectURL))
-        return self._get_request_response(page)
+        return self._request(page)
         
     def change_mic_volume(self, MicVolume=15, RedirectURL=None):
         """
@@ -1111,7 +2173,7 @@ class Rovio:
         else:
             page = ('ChangeMicVolume.cgi?MicVolume=%d&RedirectURL=%s' %
                     (MicVolume, RedirectURL))
-        return self._get_request_response(page)
+        return self._request(page)
         
     def set_camera(self, Frequency=0, RedirectURL=None):
         """
@@ -1129,7 +2191,7 @@ class Rovio:
         else:
             page = ('SetCamera.cgi?Frequency=%d&RedirectURL=%s' %
                     (Frequency, RedirectURL))
-        return self._get_request_response(page)
+        return self._request(page)
         
     def manual_drive(self, command, speed=None, angle=None):
         """
@@ -1160,6 +2222,105 @@ class Rovio:
         Return the response code (0 for success).
 
         """
+        if command == 0:
+            # tell a drive_sequence in progress to give up
+            with self._lock:
+                self._stops += 1
+        return self._request(self._drive_page(command, speed, angle),
+                             self._response_code)
+
+    def drive_sequence(self, steps, interval=0.1, stop=True, timeout=10.0):
+        """
+        Drive through a sequence of movements at a steady command rate.
+
+        The Rovio only keeps moving while it receives movement commands, so
+        each step's command is repeated every interval seconds for the step's
+        duration.  The commands are pipelined on one keep-alive connection
+        (not the connection pool): each is sent on schedule without waiting
+        for the responses to the earlier ones, so a slow response does not
+        delay the next command.  Each command takes its turn with the drive
+        commands of other threads, and if another thread stops the Rovio
+        meanwhile (manual_drive(0) or stop()), the rest of the sequence is
+        not sent.
+
+        Parameters:
+          - steps:    sequence of (command, speed, duration_ms) tuples, with
+                      a manual_drive command ID (see rconst), a speed (None
+                      for self.speed) and the duration of the step in ms
+          - interval: seconds between repeated commands (default 0.1)
+          - stop:     send a stop command after the last step (default True)
+          - timeout:  seconds to wait for the last responses (default 10)
+
+        Return a list with, for each step, the list of response codes of its
+        commands (and a last list for the stop command if stop is True); if
+        the sequence was stopped, only the steps begun are listed.
+        Raise ConnectError if the Rovio cannot be reached or the connection
+        fails, urllib2.HTTPError if a command is refused, TimeoutError if the
+        responses do not all arrive within timeout seconds, and
+        CircuitOpenError without sending anything while the breaker is open.
+        The commands are reported to the breaker, metrics and recorder like
+        those sent through the pool.
+
+        """
+        pages = []
+        for command, speed, duration_ms in steps:
+            page = '/' + self._drive_page(command, speed)
+            repeats = max(1, int(math.ceil(duration_ms / 1000.0 / interval)))
+            pages.append((page, repeats))
+        if stop:
+            pages.append(('/' + self._drive_page(0), 1))
+        if self.breaker is not None and not self.breaker.allow():
+            raise CircuitOpenError(self)
+        pool, headers, base_url = self._target()
+        try:
+            conn = _PipelinedConnection(pool.host, pool.port, headers,
+                                        self._timeout, account=self._account)
+        except urllib2.URLError, e:
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise ConnectError(self, e.reason)
+        futures = []
+        stops = self._stops
+        try:
+            next_send = time.time()
+            for page, repeats in pages:
+                step = []
+                futures.append(step)
+                for i in xrange(repeats):
+                    delay = next_send - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    with self._drive_lock:
+                        if self._stops != stops:
+                            break
+                        step.append((page, conn.send(page)))
+                    next_send += interval
+                if self._stops != stops:
+                    rlog.info('Drive sequence on %s stopped', self._name)
+                    if not step:
+                        futures.pop()
+                    break
+            deadline = time.time() + timeout
+            codes = []
+            for step in futures:
+                step_codes = []
+                for page, future in step:
+                    try:
+                        status, reason, headers, body = future.result(
+                            max(0, deadline - time.time()))
+                    except urllib2.URLError, e:
+                        raise ConnectError(self, e.reason)
+                    if not 200 <= status < 300:
+                        raise urllib2.HTTPError(base_url + page[1:],
+                                                status, reason, headers, None)
+                    step_codes.append(self._response_code(body))
+                codes.append(step_codes)
+            return codes
+        finally:
+            conn.close()
+
+    def _drive_page(self, command, speed=None, angle=None):
+        """Return the page of a manual_drive command."""
         if speed is None:
             speed = self.speed
         # camera commands
@@ -1173,29 +2334,172 @@ class Rovio:
         else:
             page = ('rev.cgi?Cmd=nav&action=%d&drive=%d&speed=%d' %
                     (18, command, speed))
-        r = self._get_request_response(page)
-        return self._parse_response(r)['responses']
+        return page
+
+    def _request(self, page, handler=None, buffers=None, idempotent=False,
+                 ordered=None):
+        """
+        Send a command to the Rovio and handle its response.
+
+        Every command goes through this method, so subclasses can change how
+        requests are sent (see aiorovio.AsyncRovio) while sharing the URL
+        building and response parsing.
 
-    def _get_request_response(self, page):
+        Parameters:
+          - page:       the Rovio API command to request
+          - handler:    function of the raw response returning the command's
+                        result (default None, return the raw response)
+          - buffers:    video.FrameRing to read the response into (default
+                        None)
+          - idempotent: the command may be retried after a connection error
+                        (default False)
+          - ordered:    the command is sent after every ordered command asked
+                        for before it, one at a time (default None, if page
+                        drives the Rovio or changes its paths)
+
+        Return handler(response), or the raw response.
+
+        """
+        if ordered is None:
+            ordered = _is_ordered(page)
+        if ordered:
+            self._drive_lock.acquire()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    r = self._get_request_response(page, buffers)
+                    break
+                except CircuitOpenError:
+                    raise
+                except ConnectError, e:
+                    if not idempotent or attempt >= self.retries:
+                        raise
+                    delay = random.uniform(0, self.backoff * 2 ** attempt)
+                    attempt += 1
+                    rlog.debug('Retrying %s on %s in %.3f s: %s', page,
+                               self._name, delay, e.reason)
+                    time.sleep(delay)
+        finally:
+            if ordered:
+                self._drive_lock.release()
+        if handler is None:
+            return r
+        if metrics is None:
+            return handler(r)
+        start = time.time()
+        result = handler(r)
+        metrics.observe(self._name, _action_label(page), 'parse',
+                        time.time() - start)
+        return result
+
+    def _response_code(self, response):
+        """Return the response code of a parsed CGI response."""
+        return self._parse_response(response)['responses']
+
+    def _get_request_response(self, page, buffers=None):
         """
         Send a command to the Rovio and return its response.
 
         In general, this command should not be called directly.
 
         Parameters:
-          - page: the Rovio API command to request
+          - page:    the Rovio API command to request
+          - buffers: video.FrameRing to read the response into (default None)
+
+        Return the raw response (a memoryview if buffers is given).
+
+        With rovio.metrics set, the time taken by each phase of the request
+        is reported to it; with self.recorder set, the request is recorded.
+
+        Raise ConnectError if the Rovio cannot be reached or the request
+        times out, and CircuitOpenError without making the request while
+        the breaker is open.
+
+        """
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(self)
+        timeout = self.timeout
+        if self.timeouts:
+            timeout = self.timeouts.get(_action_label(page), timeout)
+        timings = None if metrics is None else {}
+        sent = time.time()
+        pool, request_headers, base_url = self._target()
+        try:
+            status, reason, headers, data = pool.request('/' + page,
+                                                         request_headers,
+                                                         buffers, timings,
+                                                         timeout)
+        except (socket.error, httplib.HTTPException), e:
+            self._account(page, sent, 0, None, timings)
+            raise ConnectError(self, e)
+        if status in _REDIRECTS and headers.getheader('location'):
+            # RedirectURL on the Change*.cgi commands; let urllib2 follow it,
+            # and account for the command once, with the final outcome
+            url = urlparse.urljoin(base_url + page,
+                                   headers.getheader('location'))
+            try:
+                data = self._urlopen(url)
+            except urllib2.HTTPError, e:
+                self._account(page, sent, e.code, None, timings)
+                raise
+            except (urllib2.URLError, socket.error,
+                    httplib.HTTPException), e:
+                self._account(page, sent, 0, None, timings)
+                raise ConnectError(self, getattr(e, 'reason', e))
+            self._account(page, sent, 200, data, timings)
+            if buffers is not None:
+                data = buffers.copy(data)
+            return data
+        self._account(page, sent, status, data, timings)
+        if not 200 <= status < 300:
+            raise urllib2.HTTPError(base_url + page, status, reason,
+                                    headers, None)
+        return data
+
+    def _account(self, page, sent, status, data, timings=None):
+        """
+        Report a completed request to the breaker, metrics and recorder.
 
-        Return the raw response.
+        Parameters:
+          - page:    the page requested
+          - sent:    time the request was sent
+          - status:  HTTP status of the response (0 if the request failed)
+          - data:    the response body (None if the request failed)
+          - timings: map of request phases to seconds (default None)
 
         """
-        url = self._base_url + page
+        breaker = self.breaker
+        if breaker is not None:
+            if status:
+                breaker.success()
+            else:
+                breaker.failure()
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(self._name, page, sent, status, data)
+        sink = metrics
+        if sink is not None:
+            action = _action_label(page)
+            if status:
+                for phase, seconds in (timings or {}).iteritems():
+                    sink.observe(self._name, action, phase, seconds)
+            if not status or status >= 400:
+                sink.error(self._name, action)
+
+    def _urlopen(self, url):
+        """Fetch url with urllib2 on a new connection and return the data."""
         req = urllib2.Request(url)
         req.add_header('User-Agent', USER_AGENT)
         if self._base64string is not None:
             req.add_header("Authorization", "Basic %s" % self._base64string)
-        f = urllib2.urlopen(req)
+        if self._timeout is None:
+            f = urllib2.urlopen(req)
+        else:
+            f = urllib2.urlopen(req, timeout=self._timeout)
         data = f.read()
-        return data;
+        return data
 
     def _parse_response(self, response):
         """
@@ -1206,47 +2510,50 @@ class Rovio:
         Responses are of the form (for example):
         'Cmd = nav\nresponses = 0\n|x=-5644|...'
         For this example, return:
-        {'Cmd' : 'nav', 'responses' : '0', 'x' : '-5644', ...}
+        {'Cmd' : 'nav', 'responses' : 0, 'x' : -5644, ...}
+
+        Integer values are converted to int, except for flags.
 
         Return a dictionary of response key/value pairs.
 
         """
-        reply = dict()
-        # split on | (bar)
-        rlst = response.split('|')
-        # handle Cmd=... first line specially
-        rlst[0:1] = rlst[0].splitlines()
-        # split key=val into key,val pairs
-        for pair in rlst:
-            try:
-                (key,val) = pair.split('=')
-            except ValueError:
-                key = pair
-                val = None
-            key = key.strip()
-            if val is not None:
-                val = val.strip()
-            # try to convert to int
-            if key != 'flags':
-                try:
-                    val = int(val)
-                except ValueError:
-                    pass
-                except TypeError:
-                    pass
-            reply[key] = val
-        return reply
+        return _PARSER.parse(response)
 
     def _compile_URLs(self):
-        """Compile all URLs for use in _get_request_response."""
-        if self._username is not None and self._password is not None:
-            self._base64string = base64.encodestring('%s:%s' %
-                                                     (self._username,
-                                                      self._password))[:-1]
-        else:
-            self._base64string = None
-        self._base_url = '%s://%s:%d/' % (self._protocol, self._host,
-                                          self._port)
+        """
+        Compile all URLs for use in _get_request_response.
+
+        The new values are built before they are assigned, and under
+        self._lock, so a request in another thread sees either the old ones
+        or the new ones (see _target).
+
+        """
+        with self._lock:
+            if self._username is not None and self._password is not None:
+                base64string = base64.encodestring('%s:%s' %
+                                                   (self._username,
+                                                    self._password))[:-1]
+            else:
+                base64string = None
+            headers = {'User-Agent': USER_AGENT}
+            if base64string is not None:
+                headers['Authorization'] = 'Basic %s' % base64string
+            self._base64string = base64string
+            self._base_url = '%s://%s:%d/' % (self._protocol, self._host,
+                                              self._port)
+            self._headers = headers
+            if (self._pool is None or self._pool.host != self._host or
+                self._pool.port != self._port):
+                if self._pool is not None:
+                    self._pool.close()
+                self._pool = ConnectionPool(self._host, self._port,
+                                            self._pool_size,
+                                            self._idle_timeout, self._timeout)
+
+    def _target(self):
+        """Return a consistent (pool, headers, base URL) of the Rovio."""
+        with self._lock:
+            return self._pool, self._headers, self._base_url
 
     def _simple_rev_cmd(self, commandID, name=None):
         """Make simple rev.cgi calls (for path ops, not manual_drive)"""
@@ -1254,22 +2561,53 @@ class Rovio:
             page = 'rev.cgi?Cmd=nav&action=%d' % (commandID,)
         else:
             page = 'rev.cgi?Cmd=nav&action=%d&name=%s' % (commandID, name)
-        r = self._get_request_response(page)
-        return self._parse_response(r)['responses']
+        return self._request(page, self._response_code)
 
 class RovioController(threading.Thread):
 
     """
     Controls the Rovio robot.
 
-    A higher-level wrapper for the API.
+    A higher-level wrapper for the API.  Commands are queued with a duration in
+    milliseconds and run in order.  The running command is repeated every wait
+    seconds until its duration has passed (a Rovio only keeps moving while it
+    receives movement commands), and the next command starts as soon as it
+    expires.  The thread sleeps until the next repeat, expiry or change to the
+    queue; it does not poll.  (It waits in select on a socket the queuing
+    threads write to, since under Python 2 a timed Condition.wait polls and
+    would notice a change up to 50 ms late.)
+
+    Commands are queued in priority lanes (HIGH, NORMAL, LOW, or any integer,
+    lower first) and run in order within a lane.  A command queued in a higher
+    lane than the running one preempts it at once: the running command is
+    paused, and resumes for the rest of its duration when the higher lanes are
+    empty, followed by the rest of its script.  The queue is a heap, so
+    queuing and running a command take O(log n) time in the number of queued
+    commands.
+
+    Queuing a command returns a Future, which completes once the command's
+    duration has passed (or it is interrupted) with the result of its last
+    repeat, or with the exception that repeat raised.  Commands discarded
+    before they start are cancelled.  Each future also has timing attributes:
+    queued, started and finished (times in seconds since the epoch, None
+    until they happen), dispatches (number of times the command was sent) and
+    preemptions (number of times it was paused by a higher lane).
+
+    Class constants:
+      - HIGH, NORMAL, LOW: priority lanes
 
     Attributes:
       - rovio: the Rovio being controlled (read-only)
-      - wait: the amount of time to sleep before checking the Rovio event queue
+      - wait: the interval in seconds between repeats of the running command
 
     """
 
+    # Class constants
+
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
     def getRovio(self): return self._rovio
     rovio = property(getRovio, doc="""Rovio being controlled (read-only)""")
 
@@ -1285,49 +2623,314 @@ class RovioController(threading.Thread):
         self._rovio = rovio
         self._running = True
         self._queue = []
+        self._lock = threading.Lock()
+        self._waker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._waker.bind(('127.0.0.1', 0))
+        self._waker.connect(self._waker.getsockname())
+        self._sleeping = False
+        self._seq = itertools.count()
+        self._current = None
+        self._ready = None
+        self._next = None
+        self._done = []
+        self._jitter = collections.deque(maxlen=1000)
         self.wait = 0.1
 
-    def enqueue(self, millis, command, params=[]):
-        self._queue.append([None, millis, command, params])
+    def enqueue(self, millis, command, params=[], priority=NORMAL):
+        """
+        Queue a command to run for millis milliseconds.
 
-    def enqueue_all(self, commands):
-        self._queue.extend(commands)
+        Parameters:
+          - millis:   duration of the command in milliseconds
+          - command:  function to call
+          - params:   list or tuple of positional arguments, or dict of
+                      keyword arguments (default [])
+          - priority: lane of the command (default NORMAL)
 
-    def interrupt(self, millis, command, params=[]):
-        self._queue = [[None, millis, command, params]]
+        Return the command's Future.
 
-    def clear(self):
-        self._queue = []
+        """
+        entry = self._entry(millis, command, params)
+        with self._lock:
+            self._append(entry, priority)
+        return entry[4]
 
-    def _dispatch(self):
-        if len(self._queue) > 0:
-            cmd = self._queue[0][2]
-            parms = self._queue[0][3]
+    def enqueue_all(self, commands, priority=NORMAL):
+        """
+        Queue a script of commands.
+
+        Parameters:
+          - commands: sequence of (millis, command, params) tuples (or
+                      [None, millis, command, params] lists)
+          - priority: lane of the commands (default NORMAL)
+
+        Return the list of the commands' futures.
+
+        """
+        entries = [self._entry(*c[-3:]) for c in commands]
+        with self._lock:
+            for entry in entries:
+                self._append(entry, priority)
+        return [entry[4] for entry in entries]
+
+    def interrupt(self, millis, command, params=[], priority=NORMAL):
+        """
+        Discard the queued commands of a lane and lower lanes and run a
+        command in the lane.
+
+        Commands in higher lanes are kept.  The running (or paused) commands
+        discarded complete, and the others are cancelled.  Return the new
+        command's Future.
+
+        """
+        entry = self._entry(millis, command, params)
+        with self._lock:
+            cancelled = self._discard(priority)
+            self._append(entry, priority)
+        for future in cancelled:
+            future.cancel()
+        return entry[4]
+
+    def clear(self, priority=None):
+        """
+        Discard the queued commands of a lane and lower lanes, like
+        interrupt (default None, every lane).
+
+        """
+        with self._lock:
+            cancelled = self._discard(priority)
+            self._wake()
+        for future in cancelled:
+            future.cancel()
+
+    def wait_all(self, futures=None, timeout=None):
+        """
+        Wait for commands to complete.
+
+        Parameters:
+          - futures: futures of the commands (default None, every command
+                     queued now)
+          - timeout: seconds to wait (default None, no limit)
+
+        Return True if they all completed or were cancelled in time.
+
+        """
+        if futures is None:
+            with self._lock:
+                futures = [item[2][4] for item in self._queue]
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for future in futures:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, deadline - time.time())
+            try:
+                future.exception(remaining)
+            except CancelledError:
+                pass
+            except TimeoutError:
+                return False
+        return True
+
+    def dispatch_jitter(self):
+        """
+        Return statistics on how late recent commands were dispatched.
+
+        Lateness is measured from the time a command was due (its predecessor
+        expired, it was queued, or its next repeat was scheduled) to the time
+        it was sent.  Return a dict with the number of samples and the mean,
+        99th percentile and maximum lateness in milliseconds.
+
+        """
+        with self._lock:
+            samples = sorted(self._jitter)
+        if not samples:
+            return {'count': 0, 'mean_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+        return {'count': len(samples),
+                'mean_ms': sum(samples) / len(samples),
+                'p99_ms': samples[int(0.99 * (len(samples) - 1))],
+                'max_ms': samples[-1]}
+
+    def _entry(self, millis, command, params=[]):
+        """
+        Return a new queue entry.
+
+        An entry is a list [start, millis, command, params, future, outcome],
+        where outcome is (result, exception) of the last dispatch.
+
+        """
+        future = Future()
+        future.queued = time.time()
+        future.started = None
+        future.finished = None
+        future.dispatches = 0
+        future.preemptions = 0
+        return [None, millis, command, params, future, (None, None)]
+
+    def _append(self, entry, priority=NORMAL):
+        """Queue entry and wake the controller; call with _lock held."""
+        item = (priority, self._seq.next(), entry)
+        if not self._queue or item < self._queue[0]:
+            # the first in line is due now
+            self._ready = time.time()
+        heapq.heappush(self._queue, item)
+        self._wake()
+
+    def _wake(self):
+        """Wake the controller if it is sleeping; call with _lock held."""
+        if self._sleeping:
+            self._sleeping = False
+            self._waker.send('!')
+
+    def _sleep(self, timeout):
+        """
+        Release _lock until woken or timeout seconds (None: no limit) pass.
+
+        Call with _lock held.
+
+        """
+        self._sleeping = True
+        self._lock.release()
+        try:
+            select.select([self._waker], [], [], timeout)
+        finally:
+            self._lock.acquire()
+        if self._sleeping:
+            self._sleeping = False
+        else:
+            # woken: the datagram was sent before _lock was released to us
+            self._waker.recv(1)
+
+    def _discard(self, priority=None):
+        """
+        Remove the commands of a lane and lower lanes (default None, every
+        lane) and return the futures to cancel.
+
+        Started commands are completed by the controller thread.  Call with
+        _lock held.
+
+        """
+        cancelled = []
+        kept = []
+        for item in self._queue:
+            if priority is not None and item[0] < priority:
+                kept.append(item)
+            elif item[2][4].started is None:
+                cancelled.append(item[2][4])
+            else:
+                self._done.append(item[2])
+                if item[2] is self._current:
+                    self._current = None
+        if kept and kept[0] is not self._queue[0]:
+            self._ready = time.time()
+        heapq.heapify(kept)
+        self._queue = kept
+        return cancelled
+
+    def _dispatch(self, entry):
+        cmd = entry[2]
+        parms = entry[3]
+        future = entry[4]
+        result = None
+        future.dispatches += 1
+        try:
             if isinstance(parms, list) or isinstance(parms, tuple):
-                cmd(*parms)
+                result = cmd(*parms)
             elif isinstance(parms, dict):
-                cmd(**parms)
+                result = cmd(**parms)
+        except Exception, e:
+            rlog.exception('Error dispatching %r on %s', cmd,
+                           self._rovio.name)
+            entry[5] = (None, e)
+        else:
+            entry[5] = (result, None)
+
+    def _complete(self, entries):
+        """Complete the futures of finished entries."""
+        for entry in entries:
+            future = entry[4]
+            future.finished = time.time()
+            result, exception = entry[5]
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
 
     def stop(self):
-        self._running = False
+        """Stop the controller; queued commands are cancelled."""
+        with self._lock:
+            self._running = False
+            cancelled = self._discard()
+            self._wake()
+        for future in cancelled:
+            future.cancel()
 
     def run(self):
-        while self._running:
-            if len(self._queue) > 0:
-                if self._queue[0][0] is None:
-                    # start executing
-                    self._queue[0][0] = time.time()
-                    self._dispatch()
-                else:
-                    # continue executing, check for time
-                    now = time.time()
-                    elapsed = (now - self._queue[0][0]) * 1000
-                    millis = self._queue[0][1]
-                    if elapsed > millis:
-                        self._queue = self._queue[1:]
-                    else:
-                        self._dispatch()
-            time.sleep(self.wait)
+        while True:
+            with self._lock:
+                entry = self._next_dispatch()
+                done, self._done = self._done, []
+                running = self._running
+            self._complete(done)
+            if entry is not None:
+                self._dispatch(entry)
+            elif not running:
+                self._waker.close()
+                return
+
+    def _next_dispatch(self):
+        """
+        Wait until a command is due and return it.
+
+        Return None once stopped, or when there are finished commands to
+        complete first.  Call with _lock held.
+
+        """
+        while self._running and not self._done:
+            if not self._queue:
+                self._current = None
+                self._sleep(None)
+                continue
+            entry = self._queue[0][2]
+            now = time.time()
+            current = self._current
+            if (current is not None and current is not entry and
+                current[0] is not None):
+                # preempted by a higher lane; pause for the rest of its time
+                current[1] = max(0, current[1] - (now - current[0]) * 1000)
+                current[0] = None
+                current[4].preemptions += 1
+            if entry[0] is None:
+                future = entry[4]
+                if (future.started is None and
+                    not future.set_running_or_notify_cancel()):
+                    # cancelled while it was queued
+                    heapq.heappop(self._queue)
+                    continue
+                # start or resume executing
+                entry[0] = now
+                if future.started is None:
+                    future.started = now
+                self._current = entry
+                due = self._ready
+                self._next = now + self.wait
+            else:
+                # continue executing, check for time
+                end = entry[0] + entry[1] / 1000.0
+                if now >= end:
+                    heapq.heappop(self._queue)
+                    self._done.append(entry)
+                    self._current = None
+                    self._ready = end
+                    continue
+                if now < self._next:
+                    self._sleep(min(self._next, end) - now)
+                    continue
+                due = self._next
+                self._next = max(self._next + self.wait, now)
+            self._jitter.append(max(0.0, now - due) * 1000)
+            return entry
+        return None
 
 #######################
 # TESTING AND SCRIPTS #
@@ -0,0 +1,762 @@
+"""
+A local simulated Rovio.
+
+The StubServer answers the Rovio web API from a SimulatedRovio, so that the
+Rovio class can be exercised and benchmarked without hardware.  It speaks
+HTTP/1.1 with keep-alive, like the Rovio's own web server, and can add
+latency, jitter and lost responses to model a real network.
+
+The SimulatedRovio is a simple kinematic model of the robot: movement
+commands drive it for a short time at a speed set by the command's speed, its
+pose is integrated from its velocity, the wheel encoder ticks of its MCU
+report are derived from the same motion, and paths can be recorded, played
+back forward and backward, and driven home along.  It implements every
+rev.cgi action used by the Rovio class, the camera image and the Change*.cgi
+settings.
+
+Example:
+
+  server = StubServer(latency=0.005, jitter=0.002).start()
+  r = rovio.Rovio('sim', server.host, port=server.port)
+  r.forward()
+  print server.robot.pose
+  server.stop()
+
+  servers = start_fleet(50)            # 50 robots on consecutive ports
+  ...
+  stop_fleet(servers)
+
+Classes:
+  - SimulatedRovio: state and kinematic model of a simulated Rovio
+  - StubServer: threaded HTTP server of a SimulatedRovio
+  - StubHandler: request handler used by StubServer
+
+Module Functions:
+  - start_fleet: start many simulated Rovios
+  - stop_fleet: stop simulated Rovios started by start_fleet
+
+Module Constants:
+  - REPORT: initial response to rev.cgi action 1 (get_report)
+  - STATUS: initial response to rev.cgi action 22 (get_status)
+  - MCU_REPORT: initial response to rev.cgi action 20 (get_MCU_report)
+  - JPEG: placeholder camera image
+  - BOUNDARY: part boundary of the MJPEG stream
+  - MAX_SPEED: meters per second driven at speed 1
+  - MAX_TURN: radians per second turned at speed 1
+  - DRIVE_HOLD: seconds a movement command keeps the Rovio moving
+  - UNITS_PER_METER: navigation units of get_report per meter
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import math
+import random
+import socket
+import struct
+import threading
+import time
+import urlparse
+
+import odometry
+
+REPORT = ('Cmd = nav\nresponses = 0|x=-1339|y=-2296|theta=-2.969|room=0|'
+          'ss=895|beacon=0|beacon_x=0|next_room=9|next_room_ss=38|state=0|'
+          'ui_status=0|resistance=0|sm=15|pp=0|flags=0005|brightness=6|'
+          'resolution=3|video_compression=1|frame_rate=20|privilege=0|'
+          'user_check=1|speaker_volume=15|mic_volume=17|wifi_ss=233|'
+          'show_time=0|ddns_state=0|email_state=0|battery=126|charging=80|'
+          'head_position=203|ac_freq=2')
+"""Initial response to rev.cgi action 1 (get_report)"""
+STATUS = 'Cmd = nav\nresponses = 0|state=0'
+"""Initial response to rev.cgi action 22 (get_status)"""
+MCU_REPORT = 'Cmd = nav\nresponses = 0E0100000000000000000000CA7E02'
+"""Initial response to rev.cgi action 20 (get_MCU_report)"""
+JPEG = '\xff\xd8\xff\xe0' + '\x00' * 1020 + '\xff\xd9'
+"""Placeholder camera image (JPEG markers around 1 KB of padding)"""
+BOUNDARY = 'WINBONDBOUDARY'
+"""Part boundary of the MJPEG stream"""
+
+MAX_SPEED = 0.4
+"""Meters per second driven at speed 1 (speed 10 is a tenth of it)"""
+MAX_TURN = 2.0
+"""Radians per second turned at speed 1"""
+DRIVE_HOLD = 0.15
+"""Seconds a movement command keeps the Rovio moving"""
+UNITS_PER_METER = 1000
+"""Navigation units of get_report per meter"""
+
+# response codes (see rovio.response_codes)
+_SUCCESS = 0
+_UNKNOWN_CGI_ACTION = 4
+_PATH_NOT_FOUND = 9
+_PATH_NAME_NOT_SPECIFIED = 10
+_NOT_RECORDING_PATH = 11
+
+# body-frame (forward, left, turn) directions of the movement commands
+_DIRECTIONS = {0: (0, 0, 0), 1: (1, 0, 0), 2: (-1, 0, 0), 3: (0, 1, 0),
+               4: (0, -1, 0), 5: (0, 0, 1), 6: (0, 0, -1),
+               7: (0.7071, 0.7071, 0), 8: (0.7071, -0.7071, 0),
+               9: (-0.7071, 0.7071, 0), 10: (-0.7071, -0.7071, 0),
+               17: (0, 0, 1), 18: (0, 0, -1)}
+_HEAD_POSITIONS = {11: 65, 12: 204, 13: 135}
+_AC_FREQS = {0: 0, 50: 1, 60: 2}
+# degrees turned per unit of the angle of commands 17 and 18
+_ANGLE_UNIT = 12.0
+_TUNING = ('Cmd = nav\nresponses = 0|LowerLeftNav=1000|HomeStationNav=1000|'
+           'ManDriveSpeed=5|ManDriveTurnSpeed=5|PathDriveSpeed=5|'
+           'PathDriveTurnSpeed=5')
+_LIBNS_VERSION = 'Cmd = nav\nresponses = 0|version=5.3503'
+_STATES = {'idle': 0, 'home': 1, 'dock': 2, 'path': 3, 'recording': 4}
+
+def _report_fields(response):
+    """Return the key=value fields of a response as (key, value) pairs."""
+    return [tuple(pair.split('=', 1)) for pair in response.split('|')[1:]]
+
+class SimulatedRovio(object):
+
+    """
+    State and kinematics of a simulated Rovio.
+
+    The pose is in meters and radians, x forward and theta counter-clockwise
+    from the starting heading of the navigation system.  Motion is integrated
+    lazily, when the state is read or changed.  Each movement command drives
+    the Rovio for DRIVE_HOLD seconds (rotations by an angle, until the angle
+    is turned).  Wheel encoder ticks follow the geometry of odometry.Odometer
+    with its default parameters, so an Odometer fed with the simulated MCU
+    reports tracks the simulated pose.
+
+    The methods named after rev.cgi actions return a response body; they are
+    called by the StubHandler.  All methods are thread-safe.
+
+    Attributes:
+      - obstacle: True if the IR radar sees an obstacle
+      - paths:    map of recorded path names to lists of motion segments
+      - settings: map of get_report keys to the current values of the
+                  camera, audio and other settings
+
+    """
+
+    def __init__(self, x=None, y=None, theta=None):
+        """
+        Initialize a simulated Rovio at a pose (default that of REPORT).
+
+        Parameters:
+          - x, y:  position in meters
+          - theta: heading in radians
+
+        """
+        self.settings = collections.OrderedDict(_report_fields(REPORT))
+        for key, value in self.settings.items():
+            if value.lstrip('-').isdigit() and key != 'flags':
+                self.settings[key] = int(value)
+        if x is None:
+            x = self.settings['x'] / float(UNITS_PER_METER)
+        if y is None:
+            y = self.settings['y'] / float(UNITS_PER_METER)
+        if theta is None:
+            theta = float(self.settings['theta'])
+        self.obstacle = False
+        self.paths = dict()
+        self.parameters = dict()
+        self._lock = threading.RLock()
+        self._x, self._y, self._theta = x, y, theta
+        self._home = (0.0, 0.0, 0.0)
+        self._t = time.time()
+        self._motion = None
+        self._plan = collections.deque()
+        self._plan_kind = None
+        self._paused = False
+        self._recording = None
+        self._ticks = [0.0, 0.0, 0.0]
+        self._wheels = [(-math.sin(math.radians(a)),
+                         math.cos(math.radians(a)), odometry.BASE_RADIUS)
+                        for a in odometry.WHEEL_ANGLES]
+
+    def get_pose(self):
+        with self._lock:
+            self._advance()
+            return odometry.Pose(self._x, self._y, self._theta)
+    pose = property(get_pose, doc="""Current odometry.Pose""")
+
+    def get_state(self):
+        with self._lock:
+            self._advance()
+            if self._recording is not None:
+                return _STATES['recording']
+            if self._plan_kind is not None:
+                return _STATES[self._plan_kind]
+            return _STATES['idle']
+    state = property(get_state,
+                     doc="""Navigation state, as in get_status (0--4)""")
+
+    # rev.cgi actions
+
+    def report(self):
+        """Return a get_report response."""
+        with self._lock:
+            self._advance()
+            s = self.settings
+            s['x'] = int(round(self._x * UNITS_PER_METER))
+            s['y'] = int(round(self._y * UNITS_PER_METER))
+            s['theta'] = '%.3f' % self._theta
+            s['state'] = self.state
+            # IR detector on, home position, obstacle
+            s['flags'] = '%04d' % (7 if self.obstacle else 5)
+            return 'Cmd = nav\nresponses = 0|' + '|'.join(
+                ['%s=%s' % item for item in s.items()])
+
+    def status(self):
+        """Return a get_status response."""
+        return 'Cmd = nav\nresponses = 0|state=%d' % self.state
+
+    def mcu_report(self):
+        """Return a get_MCU_report response; the encoder ticks restart."""
+        with self._lock:
+            self._advance()
+            values = [14, 1]
+            for i in range(3):
+                ticks = int(self._ticks[i])
+                self._ticks[i] -= ticks
+                values.append(4 if ticks < 0 else 0)
+                values.append(min(abs(ticks), 0xffff))
+            head = self.settings['head_position']
+            status = 0x02 | (0x04 if self.obstacle else 0)
+            if self.settings['charging'] >= 80:
+                status |= 0x02 << 3
+            values.extend([0, head, self.settings['battery'], status])
+            payload = struct.pack('>BBBHBHBHBBBB', *values)
+            return 'Cmd = nav\nresponses = ' + payload.encode('hex').upper()
+
+    def manual_drive(self, command, speed=1, angle=None):
+        """Start a movement or camera command."""
+        with self._lock:
+            self._advance()
+            if command in _HEAD_POSITIONS:
+                self.settings['head_position'] = _HEAD_POSITIONS[command]
+                return _SUCCESS
+            if command not in _DIRECTIONS:
+                return _UNKNOWN_CGI_ACTION
+            self._stop_plan()
+            forward, left, turn = _DIRECTIONS[command]
+            factor = (11 - min(max(speed, 1), 10)) / 10.0
+            v = (forward * MAX_SPEED * factor, left * MAX_SPEED * factor,
+                 turn * MAX_TURN * factor)
+            duration = DRIVE_HOLD
+            if command in (17, 18):
+                duration = (math.radians((angle or 1) * _ANGLE_UNIT) /
+                            abs(v[2]))
+            if command == 0:
+                self._motion = None
+            else:
+                self._motion = (v, self._t + duration)
+                self.settings['charging'] = 0
+            return _SUCCESS
+
+    def start_recording(self):
+        with self._lock:
+            self._advance()
+            self._stop_plan()
+            self._recording = []
+            return _SUCCESS
+
+    def abort_recording(self):
+        with self._lock:
+            self._advance()
+            self._recording = None
+            return _SUCCESS
+
+    def stop_recording(self, name):
+        with self._lock:
+            self._advance()
+            if self._recording is None:
+                return _NOT_RECORDING_PATH
+            if not name:
+                return _PATH_NAME_NOT_SPECIFIED
+            self.paths[name] = self._recording
+            self._recording = None
+            return _SUCCESS
+
+    def delete_path(self, name):
+        with self._lock:
+            if name not in self.paths:
+                return _PATH_NOT_FOUND
+            del self.paths[name]
+            return _SUCCESS
+
+    def path_list(self):
+        """Return a get_path_list response."""
+        with self._lock:
+            return 'Cmd = nav\nresponses = 0' + ''.join(
+                ['|' + name for name in sorted(self.paths)])
+
+    def play_path(self, name, backward=False):
+        with self._lock:
+            self._advance()
+            if name not in self.paths:
+                return _PATH_NOT_FOUND
+            segments = self.paths[name]
+            if backward:
+                segments = [(d, tuple(-c for c in v))
+                            for d, v in reversed(segments)]
+            self._start_plan('path', segments)
+            return _SUCCESS
+
+    def stop_playing(self):
+        with self._lock:
+            self._advance()
+            self._stop_plan()
+            self._motion = None
+            return _SUCCESS
+
+    def pause_playing(self):
+        with self._lock:
+            self._advance()
+            if self._plan_kind is not None:
+                self._paused = not self._paused
+            return _SUCCESS
+
+    def rename_path(self, name, new_name):
+        with self._lock:
+            if name not in self.paths:
+                return _PATH_NOT_FOUND
+            if not new_name:
+                return _PATH_NAME_NOT_SPECIFIED
+            self.paths[new_name] = self.paths.pop(name)
+            return _SUCCESS
+
+    def go_home(self, dock=False):
+        """Drive straight to the home position, then turn to its heading."""
+        with self._lock:
+            self._advance()
+            hx, hy, htheta = self._home
+            dx, dy = hx - self._x, hy - self._y
+            distance = math.hypot(dx, dy)
+            segments = []
+            if distance > 0:
+                # the Rovio can drive sideways, so it does not turn first
+                c, s = math.cos(self._theta), math.sin(self._theta)
+                forward = (dx * c + dy * s) / distance * MAX_SPEED
+                left = (-dx * s + dy * c) / distance * MAX_SPEED
+                segments.append((distance / MAX_SPEED, (forward, left, 0.0)))
+            turn = math.atan2(math.sin(htheta - self._theta),
+                              math.cos(htheta - self._theta))
+            if turn:
+                segments.append((abs(turn) / MAX_TURN,
+                                 (0.0, 0.0, math.copysign(MAX_TURN, turn))))
+            self._start_plan('dock' if dock else 'home', segments)
+            return _SUCCESS
+
+    def update_home_position(self):
+        with self._lock:
+            self._advance()
+            self._home = (self._x, self._y, self._theta)
+            return _SUCCESS
+
+    def reset_home_location(self):
+        with self._lock:
+            self._home = (0.0, 0.0, 0.0)
+            return _SUCCESS
+
+    def reset_nav_state_machine(self):
+        with self._lock:
+            self._advance()
+            self._stop_plan()
+            self._motion = None
+            self._recording = None
+            return _SUCCESS
+
+    def clear_all_paths(self):
+        with self._lock:
+            self.paths.clear()
+            return _SUCCESS
+
+    def save_parameter(self, index, value):
+        with self._lock:
+            self.parameters[index] = value
+            return _SUCCESS
+
+    def read_parameter(self, index=None):
+        """Return a read_parameter (or, without index, read_all_parameters)
+        response."""
+        with self._lock:
+            if index is None:
+                return 'Cmd = nav\nresponses = 0' + ''.join(
+                    ['|%d=%d' % (i, self.parameters.get(i, 0))
+                     for i in range(20)])
+            return ('Cmd = nav\nresponses = 0|index=%d|value=%d' %
+                    (index, self.parameters.get(index, 0)))
+
+    def change_setting(self, key, value):
+        """Change a get_report setting (by a Change*.cgi command)."""
+        with self._lock:
+            self.settings[key] = value
+
+    # kinematics
+
+    def _start_plan(self, kind, segments):
+        """Replace the current motion with a planned one; call locked."""
+        self._motion = None
+        self._plan = collections.deque(segments)
+        self._plan_kind = kind
+        self._paused = False
+        if segments:
+            self.settings['charging'] = 0
+
+    def _stop_plan(self):
+        self._plan.clear()
+        self._plan_kind = None
+        self._paused = False
+
+    def _advance(self):
+        """Integrate the motion up to now; call with the lock held."""
+        now = time.time()
+        while self._t < now:
+            if self._motion is None:
+                if self._plan and not self._paused:
+                    duration, v = self._plan.popleft()
+                    self._motion = (v, self._t + duration)
+                    self.settings['pp'] += 1
+                    continue
+                if self._plan_kind is not None and not self._paused:
+                    # the plan is done
+                    if self._plan_kind == 'dock':
+                        self.settings['charging'] = 80
+                    self._plan_kind = None
+                    self.settings['pp'] = 0
+                self._t = now
+                break
+            v, until = self._motion
+            end = min(now, until)
+            self._move(v, end - self._t)
+            self._t = end
+            if end >= until:
+                self._motion = None
+
+    def _move(self, v, dt):
+        """Move at body velocity v for dt seconds."""
+        forward, left, turn = v
+        heading = self._theta + turn * dt / 2.0
+        c, s = math.cos(heading), math.sin(heading)
+        self._x += (forward * c - left * s) * dt
+        self._y += (forward * s + left * c) * dt
+        theta = self._theta + turn * dt
+        self._theta = math.atan2(math.sin(theta), math.cos(theta))
+        for i, (a, b, r) in enumerate(self._wheels):
+            self._ticks[i] += ((a * forward + b * left + r * turn) * dt /
+                               odometry.TICK_DISTANCE)
+        if self._recording is not None:
+            if self._recording and self._recording[-1][1] == v:
+                self._recording[-1] = (self._recording[-1][0] + dt, v)
+            else:
+                self._recording.append((dt, v))
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Answer Rovio web API requests from the server's SimulatedRovio."""
+
+    protocol_version = 'HTTP/1.1'
+    # write each response in one segment; small writes stall on Nagle
+    wbufsize = -1
+
+    _SETTINGS = {'/ChangeResolution.cgi': ('ResType', 'resolution'),
+                 '/ChangeCompressRatio.cgi': ('Ratio', 'video_compression'),
+                 '/ChangeFramerate.cgi': ('Framerate', 'frame_rate'),
+                 '/ChangeBrightness.cgi': ('Brightness', 'brightness'),
+                 '/ChangeSpeakerVolume.cgi': ('SpeakerVolume',
+                                              'speaker_volume'),
+                 '/ChangeMicVolume.cgi': ('MicVolume', 'mic_volume'),
+                 '/SetCamera.cgi': ('Frequency', 'ac_freq')}
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        content_type = 'text/plain'
+        if url.path == '/GetData.cgi':
+            self._stream_video()
+            return
+        if not self._delay():
+            return
+        if url.path == '/rev.cgi':
+            body = self._nav(query)
+        elif url.path.startswith('/Jpeg/CamImg'):
+            body = JPEG
+            content_type = 'image/jpeg'
+        elif url.path in self._SETTINGS:
+            self._change_setting(url.path, query)
+            if query.get('RedirectURL'):
+                self.send_response(302)
+                self.send_header('Location', query['RedirectURL'])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = ''
+        elif url.path.endswith('.cgi'):
+            body = ''
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        """
+        Wait for the simulated network latency.
+
+        Return False if the response is lost, in which case the connection
+        has been dropped.
+
+        """
+        server = self.server
+        delay = server.latency
+        if server.jitter:
+            delay += server.random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if server.loss and server.random.random() < server.loss:
+            self.close_connection = 1
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            return False
+        return True
+
+    def _nav(self, query):
+        """Return the response of a rev.cgi request."""
+        robot = self.server.robot
+        try:
+            action = int(query.get('action'))
+        except (TypeError, ValueError):
+            return 'Cmd = nav\nresponses = %d' % _UNKNOWN_CGI_ACTION
+        name = query.get('name')
+        if action == 1:
+            return robot.report()
+        elif action == 6:
+            return robot.path_list()
+        elif action == 16:
+            return _TUNING
+        elif action == 20:
+            return robot.mcu_report()
+        elif action == 22:
+            return robot.status()
+        elif action == 24:
+            if 'index' in query:
+                return robot.read_parameter(int(query['index']))
+            return robot.read_parameter()
+        elif action == 25:
+            return _LIBNS_VERSION
+        elif action == 2:
+            code = robot.start_recording()
+        elif action == 3:
+            code = robot.abort_recording()
+        elif action == 4:
+            code = robot.stop_recording(name)
+        elif action == 5:
+            code = robot.delete_path(name)
+        elif action in (7, 8):
+            code = robot.play_path(name, backward=(action == 8))
+        elif action == 9:
+            code = robot.stop_playing()
+        elif action == 10:
+            code = robot.pause_playing()
+        elif action == 11:
+            code = robot.rename_path(name, query.get('newname'))
+        elif action in (12, 13):
+            code = robot.go_home(dock=(action == 13))
+        elif action == 14:
+            code = robot.update_home_position()
+        elif action in (15, 26):
+            code = _SUCCESS
+        elif action == 17:
+            code = robot.reset_nav_state_machine()
+        elif action == 18:
+            angle = query.get('angle')
+            code = robot.manual_drive(int(query.get('drive', 0)),
+                                      int(query.get('speed', 1)),
+                                      angle and int(angle))
+        elif action == 21:
+            code = robot.clear_all_paths()
+        elif action == 23:
+            code = robot.save_parameter(int(query.get('index', 0)),
+                                        int(query.get('value', 0)))
+        elif action == 27:
+            code = robot.reset_home_location()
+        else:
+            code = _UNKNOWN_CGI_ACTION
+        return 'Cmd = nav\nresponses = %d' % code
+
+    def _change_setting(self, path, query):
+        param, key = self._SETTINGS[path]
+        try:
+            value = int(query.get(param))
+        except (TypeError, ValueError):
+            return
+        if key == 'ac_freq':
+            value = _AC_FREQS.get(value, 0)
+        elif key == 'frame_rate':
+            self.server.framerate = value
+        self.server.robot.change_setting(key, value)
+
+    def _stream_video(self):
+        """Send JPEG frames as multipart MJPEG until the client goes away."""
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'multipart/x-mixed-replace; boundary=%s' % BOUNDARY)
+        self.end_headers()
+        try:
+            while True:
+                self.wfile.write('--%s\r\nContent-Type: image/jpeg\r\n'
+                                 'Content-Length: %d\r\n\r\n%s\r\n' %
+                                 (BOUNDARY, len(JPEG), JPEG))
+                self.wfile.flush()
+                time.sleep(1.0 / self.server.framerate)
+        except socket.error:
+            pass
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # the client hung up, e.g. in the middle of a video stream
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """
+    A threaded web server of a simulated Rovio.
+
+    Each request is answered after latency seconds plus a random delay of up
+    to jitter seconds; with probability loss, the connection is dropped
+    instead of answered.  The video stream is not delayed.
+
+    Attributes:
+      - host:      address the server is bound to
+      - port:      port the server is bound to (chosen by the OS if 0 was
+                   given)
+      - robot:     the SimulatedRovio answering the requests
+      - framerate: frames per second of the MJPEG stream
+      - latency:   seconds added to each response
+      - jitter:    maximum random seconds added to each response
+      - loss:      probability (0--1) of dropping a request
+      - random:    random.Random used for jitter and loss
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, handler=StubHandler,
+                 robot=None, latency=0.0, jitter=0.0, loss=0.0, seed=None):
+        """
+        Bind a new server (call start to serve).
+
+        Parameters:
+          - host:    address to bind to (default '127.0.0.1')
+          - port:    port to bind to (default 0, any free port)
+          - handler: request handler class (default StubHandler)
+          - robot:   SimulatedRovio to serve (default None, a new one)
+          - latency: seconds added to each response (default 0)
+          - jitter:  maximum random seconds added (default 0)
+          - loss:    probability of dropping a request (default 0)
+          - seed:    seed of the random delays and losses (default None)
+
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), handler)
+        self.host, self.port = self.server_address[:2]
+        if robot is None:
+            robot = SimulatedRovio()
+        self.robot = robot
+        self.framerate = 30
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self._thread = None
+
+    def start(self):
+        """Serve requests on a background thread and return self."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        self.shutdown()
+        self.server_close()
+
+def start_fleet(n, host='127.0.0.1', **kwargs):
+    """
+    Start n simulated Rovios, each on its own port.
+
+    Parameters:
+      - n:      number of Rovios
+      - host:   address to bind to (default '127.0.0.1')
+      - kwargs: passed on to StubServer (latency, jitter, loss, seed)
+
+    Return the list of started StubServers.
+
+    """
+    servers = []
+    try:
+        for i in xrange(n):
+            servers.append(StubServer(host, **kwargs).start())
+    except Exception:
+        stop_fleet(servers)
+        raise
+    return servers
+
+def stop_fleet(servers):
+    """Stop the servers returned by start_fleet."""
+    for server in servers:
+        server.stop()
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # drive a simulated Rovio around and track it by odometry
+    import obstacle
+    import rovio
+    server = StubServer(latency=0.002, jitter=0.002).start()
+    r = rovio.Rovio('sim', server.host, port=server.port)
+    odometer = odometry.Odometer(pose=server.robot.pose)
+    monitor = obstacle.ObstacleMonitor(r, interval=0.02, odometer=odometer)
+    monitor.start()
+    r.start_recording()
+    r.drive_sequence([(1, 1, 1000), (5, 5, 500), (3, 1, 500)])
+    print 'stop_recording:', r.stop_recording('square')
+    print 'paths:', r.get_path_list()
+    monitor.stop()
+    monitor.join()
+    print 'pose:    ', server.robot.pose
+    print 'odometry:', odometer.poll(r)
+    report = r.get_report()
+    print 'report:   x=%(x)d y=%(y)d theta=%(theta)s' % report
+    r.play_path_backward('square')
+    time.sleep(0.2)
+    print 'status:  ', r.get_status()['state']
+    while r.get_status()['raw_state'] != 0:
+        time.sleep(0.1)
+    print 'back at: ', server.robot.pose
+    r.change_resolution(1)
+    assert r.get_report()['resolution'] == [320, 240]
+    r.pool.close()
+    server.stop()
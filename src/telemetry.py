@@ -0,0 +1,374 @@
+"""
+Compact recording of Rovio reports.
+
+A TelemetryRecorder polls get_report at a fixed rate and stores the chosen
+fields in columns of typed arrays (a few bytes per field per sample instead of
+a dictionary per sample).  Recorded samples can be flushed to disk in chunks
+in a binary columnar format and loaded back with load().  Recording into an
+existing file appends to it, if it records the same fields.
+
+Telemetry objects answer range and summary queries over their columns.  If
+NumPy is installed it is used for the summaries; otherwise the builtin
+functions run over the arrays directly.
+
+Example:
+
+  recorder = TelemetryRecorder(rovio, interval=0.2, path='robot1.tlm')
+  recorder.start()
+  ...
+  recorder.stop()
+  last_minute = recorder.telemetry.slice(time.time() - 60)
+  print last_minute.stats('battery')
+
+Classes:
+  - Telemetry: columns of recorded report fields
+  - TelemetryRecorder: thread recording a Rovio's reports
+
+Module Functions:
+  - load: read a telemetry file written by a TelemetryRecorder
+
+Module Constants:
+  - DEFAULT_FIELDS: report fields recorded by default
+
+"""
+
+import array
+import bisect
+import errno
+import struct
+import sys
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import rovio
+
+DEFAULT_FIELDS = ('x', 'y', 'theta', 'room', 'ss', 'next_room_ss', 'state',
+                  'wifi_ss', 'battery', 'charging', 'raw_head_position')
+"""Report fields recorded by default"""
+
+_FLOAT_FIELDS = frozenset(['theta'])
+_MAGIC = 'RVTL'
+_CHUNK = 'CHNK'
+_VERSION = 1
+
+class Telemetry(object):
+
+    """
+    Columns of recorded report fields, indexed by time.
+
+    Each field is an array ('d' for theta, 'i' for the integer fields) and
+    the sample times are in the time column.  Missing integer values are
+    stored as 0, missing floats as NaN.  Samples must be appended in time
+    order.
+
+    Attributes:
+      - fields: names of the recorded fields
+      - times:  array of sample times (seconds since the epoch)
+
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        """
+        Initialize empty columns.
+
+        Parameters:
+          - fields: names of the report fields (default DEFAULT_FIELDS)
+
+        """
+        self.fields = tuple(fields)
+        self.times = array.array('d')
+        self._columns = dict()
+        for name in self.fields:
+            self._columns[name] = array.array(_typecode(name))
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, t, report):
+        """
+        Append one sample.
+
+        Parameters:
+          - t:      sample time
+          - report: a rovio.Report, or a get_report dictionary
+
+        """
+        if isinstance(report, dict):
+            get = report.get
+        else:
+            get = lambda name: getattr(report, name, None)
+        for name in self.fields:
+            value = get(name)
+            if value is None:
+                value = _missing(name)
+            elif name in _FLOAT_FIELDS:
+                value = float(value)
+            self._columns[name].append(value)
+        self.times.append(t)
+
+    def column(self, name):
+        """Return the array of values of a field."""
+        return self._columns[name]
+
+    def slice(self, start=None, end=None):
+        """
+        Return the samples taken from start up to (not including) end.
+
+        Parameters:
+          - start: first time (default None, from the first sample)
+          - end:   end time (default None, up to the last sample)
+
+        Return a new Telemetry.
+
+        """
+        i, j = self._range(start, end)
+        part = Telemetry(self.fields)
+        part.times = self.times[i:j]
+        for name in self.fields:
+            part._columns[name] = self._columns[name][i:j]
+        return part
+
+    def stats(self, name, start=None, end=None):
+        """
+        Summarize a field over a time range.
+
+        Return a dict with count, min, max and mean (None if there are no
+        samples in the range).
+
+        """
+        i, j = self._range(start, end)
+        values = self._columns[name]
+        if i >= j:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None}
+        if numpy is not None:
+            v = numpy.frombuffer(values, dtype=values.typecode)[i:j]
+            return {'count': j - i, 'min': v.min().item(),
+                    'max': v.max().item(), 'mean': v.mean().item()}
+        v = values[i:j]
+        return {'count': j - i, 'min': min(v), 'max': max(v),
+                'mean': float(sum(v)) / (j - i)}
+
+    def _range(self, start, end):
+        """Return the index range of the samples in [start, end)."""
+        if start is None:
+            i = 0
+        else:
+            i = bisect.bisect_left(self.times, start)
+        if end is None:
+            j = len(self.times)
+        else:
+            j = bisect.bisect_left(self.times, end)
+        return i, j
+
+    def _write_header(self, f):
+        """Write the file header describing the columns."""
+        f.write(_MAGIC)
+        f.write(struct.pack('<BBH', _VERSION, sys.byteorder == 'little',
+                            len(self.fields)))
+        for name in self.fields:
+            f.write(struct.pack('<B', len(name)) + name)
+            f.write(self._columns[name].typecode)
+
+    def _write_chunk(self, f, i, j):
+        """Write samples i to j as one chunk of columns."""
+        f.write(_CHUNK + struct.pack('<I', j - i))
+        self.times[i:j].tofile(f)
+        for name in self.fields:
+            self._columns[name][i:j].tofile(f)
+
+class TelemetryRecorder(threading.Thread):
+
+    """
+    Records a Rovio's reports at a fixed rate.
+
+    The recorder polls get_report every interval seconds on its own thread
+    and appends the fields to its Telemetry.  If a path is given, every
+    chunk_size samples are appended to the file, and the rest when the
+    recorder stops.  Failed polls are logged and counted, not recorded.
+
+    An existing file is appended to: its samples are kept (but not loaded
+    into the recorder's Telemetry), and a chunk left partly written by a
+    recorder that died is discarded.  A file that is not a telemetry file,
+    or records other fields, is refused with a RovioError.
+
+    Attributes:
+      - rovio:     the Rovio being recorded (read-only)
+      - telemetry: the recorded Telemetry
+      - interval:  seconds between polls
+      - errors:    number of failed polls
+
+    """
+
+    def getRovio(self): return self._rovio
+    rovio = property(getRovio, doc="""Rovio being recorded (read-only)""")
+
+    def __init__(self, rovio_, fields=DEFAULT_FIELDS, interval=1.0, path=None,
+                 chunk_size=4096):
+        """
+        Initialize a recorder.
+
+        Parameters:
+          - rovio_:     the Rovio to record
+          - fields:     report fields to record (default DEFAULT_FIELDS)
+          - interval:   seconds between polls (default 1.0)
+          - path:       file to append the samples to (default None)
+          - chunk_size: samples per chunk written to the file (default 4096)
+
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._rovio = rovio_
+        self.telemetry = Telemetry(fields)
+        self.interval = interval
+        self.errors = 0
+        self._path = path
+        self._chunk_size = chunk_size
+        self._flushed = 0
+        self._stopped = threading.Event()
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path):
+        """Create the file, or check an existing one for appending."""
+        try:
+            f = open(path, 'r+b')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            f = open(path, 'w+b')
+        try:
+            f.seek(0, 2)
+            size = f.tell()
+            if size == 0:
+                self.telemetry._write_header(f)
+                return
+            f.seek(0)
+            fields, typecodes, little = _read_header(f, path)
+            telemetry = self.telemetry
+            if (tuple(fields) != telemetry.fields or
+                typecodes != [telemetry.column(name).typecode
+                              for name in fields] or
+                bool(little) != (sys.byteorder == 'little')):
+                raise rovio.RovioError('%s records other fields' % path)
+            row = telemetry.times.itemsize + sum(
+                [telemetry.column(name).itemsize for name in fields])
+            end = f.tell()
+            while end + 8 <= size:
+                f.seek(end)
+                tag = f.read(4)
+                if tag != _CHUNK:
+                    raise rovio.RovioError('corrupt telemetry file %s' % path)
+                (rows,) = struct.unpack('<I', f.read(4))
+                if end + 8 + rows * row > size:
+                    break
+                end += 8 + rows * row
+            if end < size:
+                rovio.rlog.warning('Discarding a partial chunk of %s', path)
+                f.truncate(end)
+        finally:
+            f.close()
+
+    def run(self):
+        next_poll = time.time()
+        while not self._stopped.isSet():
+            self.poll()
+            next_poll += self.interval
+            now = time.time()
+            if next_poll < now:
+                # fell behind; skip the missed polls
+                next_poll = now
+            self._stopped.wait(next_poll - now)
+        self.flush()
+
+    def poll(self):
+        """Record one report now."""
+        try:
+            report = self._rovio.get_report(record=True)
+        except Exception:
+            self.errors += 1
+            rovio.rlog.exception('Error polling %s', self._rovio.name)
+            return
+        self.telemetry.append(time.time(), report)
+        if (self._path is not None and
+            len(self.telemetry) - self._flushed >= self._chunk_size):
+            self.flush()
+
+    def flush(self):
+        """Append the samples not yet written to the file."""
+        if self._path is None:
+            return
+        n = len(self.telemetry)
+        if n == self._flushed:
+            return
+        f = open(self._path, 'ab')
+        try:
+            self.telemetry._write_chunk(f, self._flushed, n)
+        finally:
+            f.close()
+        self._flushed = n
+
+    def stop(self):
+        """Stop recording; the remaining samples are flushed."""
+        self._stopped.set()
+
+def load(path):
+    """Read a telemetry file and return its samples as a Telemetry."""
+    f = open(path, 'rb')
+    try:
+        fields, typecodes, little = _read_header(f, path)
+        telemetry = Telemetry(fields)
+        for name, typecode in zip(fields, typecodes):
+            telemetry._columns[name] = array.array(typecode)
+        swap = bool(little) != (sys.byteorder == 'little')
+        columns = [telemetry.times] + [telemetry.column(name)
+                                       for name in fields]
+        while True:
+            tag = f.read(4)
+            if not tag:
+                break
+            if tag != _CHUNK:
+                raise rovio.RovioError('corrupt telemetry file %s' % path)
+            (rows,) = struct.unpack('<I', f.read(4))
+            for column in columns:
+                start = len(column)
+                column.fromfile(f, rows)
+                if swap:
+                    part = column[start:]
+                    part.byteswap()
+                    column[start:] = part
+        return telemetry
+    finally:
+        f.close()
+
+def _read_header(f, path):
+    """Read a file header; return the fields, their typecodes and order."""
+    if f.read(4) != _MAGIC:
+        raise rovio.RovioError('%s is not a telemetry file' % path)
+    try:
+        version, little, nfields = struct.unpack('<BBH', f.read(4))
+    except struct.error:
+        raise rovio.RovioError('corrupt telemetry file %s' % path)
+    if version != _VERSION:
+        raise rovio.RovioError('unsupported telemetry version %d' % version)
+    fields = []
+    typecodes = []
+    for k in xrange(nfields):
+        (size,) = struct.unpack('<B', f.read(1))
+        fields.append(f.read(size))
+        typecodes.append(f.read(1))
+    return fields, typecodes, little
+
+def _typecode(name):
+    if name in _FLOAT_FIELDS:
+        return 'd'
+    return 'i'
+
+def _missing(name):
+    if name in _FLOAT_FIELDS:
+        return float('nan')
+    return 0
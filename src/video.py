@@ -0,0 +1,511 @@
+"""
+Streaming video from a Rovio.
+
+The Rovio serves its camera as a multipart MJPEG stream.  MJPEGStream reads the
+stream on a background thread, splitting it into JPEG frames as the data
+arrives, and hands the frames out as an iterator.  Frames are buffered in a
+bounded queue; when the consumer falls behind, the reader either blocks (and
+TCP slows the Rovio down) or drops the oldest buffered frame.
+
+Example:
+
+  stream = rovio.stream_video(buffer=2, policy=video.DROP_OLDEST)
+  for jpeg in stream:
+      process(jpeg)
+
+Frames can be received into a FrameRing, a ring of preallocated buffers, so
+that no memory is allocated per frame; the frames are then handed out as
+memoryviews of the ring's buffers, each valid until the next frame is taken.
+
+Classes:
+  - MJPEGStream: iterator over frames of a Rovio's MJPEG stream
+  - FrameRing: ring of reusable frame buffers
+
+Module Constants:
+  - BLOCK: backpressure policy, the reader waits for the consumer
+  - DROP_OLDEST: backpressure policy, the oldest buffered frame is dropped
+  - STREAM_PAGE: page of the Rovio's MJPEG stream
+
+"""
+
+import collections
+import mimetools
+import socket
+import StringIO
+import threading
+import time
+import urllib2
+
+import rovio
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+STREAM_PAGE = 'GetData.cgi'
+
+class FrameRing(object):
+
+    """
+    A ring of reusable frame buffers.
+
+    Each frame is read into the next buffer of the ring, so a frame (a
+    memoryview of its buffer) is overwritten once slots more frames have been
+    read.  Consumers that keep a frame longer must copy it (view.tobytes()).
+    A buffer is only reallocated when a frame does not fit in it.
+
+    The last buffer acquired can be held: acquire skips held buffers until
+    they are released, so a frame still in use is not overwritten however
+    many frames are read meanwhile.
+
+    Attributes:
+      - slots:       number of buffers in the ring
+      - allocations: number of buffers allocated so far
+
+    """
+
+    def __init__(self, slots=4, size=65536):
+        """
+        Allocate a new ring of buffers.
+
+        Parameters:
+          - slots: number of buffers (default 4)
+          - size:  initial size in bytes of each buffer (default 64 KB)
+
+        """
+        self.slots = slots
+        self.allocations = slots
+        self._buffers = [bytearray(size) for i in xrange(slots)]
+        self._next = 0
+        self._last = None
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, n):
+        """Return the next unheld buffer, at least n bytes long."""
+        with self._lock:
+            for k in xrange(self.slots):
+                i = (self._next + k) % self.slots
+                if i not in self._held:
+                    break
+            else:
+                raise rovio.RovioError('every buffer of the ring is held')
+            self._next = (i + 1) % self.slots
+            self._last = i
+            buf = self._buffers[i]
+            if len(buf) < n:
+                buf = self._buffers[i] = bytearray(max(n, 2 * len(buf)))
+                self.allocations += 1
+            return buf
+
+    def hold(self):
+        """Hold the last buffer acquired; return a key to release it with."""
+        with self._lock:
+            self._held.add(self._last)
+            return self._last
+
+    def release(self, key):
+        """Let acquire reuse a held buffer again."""
+        with self._lock:
+            self._held.discard(key)
+
+    def copy(self, data):
+        """Copy data into the next buffer and return a memoryview of it."""
+        n = len(data)
+        buf = self.acquire(n)
+        buf[:n] = data
+        return memoryview(buf)[:n]
+
+class MJPEGStream(object):
+
+    """
+    An iterator over the JPEG frames of a Rovio's MJPEG stream.
+
+    The stream is opened on its own connection (not the Rovio's connection
+    pool) and read by a background thread.  Iteration ends when the stream is
+    closed by either side.  Errors in the reader thread are raised from the
+    iterator; a stream that cannot be read, or sends nothing for timeout
+    seconds, fails with rovio.ConnectError.  Connection failures are
+    reported to the Rovio's breaker, and while it is open the stream is not
+    opened (rovio.CircuitOpenError).
+
+    Frames are strings, or memoryviews of the buffers of a FrameRing if one
+    is given.  A ring needs at least buffer + 2 slots: the buffered frames,
+    the frame the consumer holds and the frame being received.  The buffers
+    of the buffered frames and of the frame last returned are held, so with
+    either policy a frame stays valid until the consumer takes the next one
+    or closes the stream, which releases them all.
+
+    Attributes:
+      - frames:  number of frames received
+      - dropped: number of frames dropped by the DROP_OLDEST policy
+      - bytes:   number of JPEG bytes received
+
+    """
+
+    def __init__(self, rovio_, buffer=2, policy=BLOCK, page=STREAM_PAGE,
+                 timeout=None, ring=None):
+        """
+        Open the MJPEG stream of a Rovio.
+
+        Parameters:
+          - rovio_:  the Rovio to stream from
+          - buffer:  maximum number of frames buffered for the consumer
+                     (default 2)
+          - policy:  BLOCK or DROP_OLDEST, what to do when the buffer is full
+                     (default BLOCK)
+          - page:    page of the stream (default STREAM_PAGE)
+          - timeout: socket timeout in seconds (default None, no timeout)
+          - ring:    FrameRing to receive frames into (default None)
+
+        """
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise rovio.ParamError(rovio_, 'policy', policy,
+                                   'must be BLOCK or DROP_OLDEST')
+        if ring is not None and ring.slots < buffer + 2:
+            raise rovio.ParamError(rovio_, 'ring', ring,
+                                   'needs at least buffer + 2 slots')
+        self._ring = ring
+        self._rovio = rovio_
+        self.frames = 0
+        self.dropped = 0
+        self.bytes = 0
+        self._buffer = buffer
+        self._policy = policy
+        self._queue = collections.deque()
+        self._taken = None
+        self._cond = threading.Condition()
+        self._times = collections.deque(maxlen=31)
+        self._error = None
+        self._closed = False
+        self._eof = False
+        self._sock, self._reader, boundary = self._open(rovio_, page, timeout)
+        self._thread = threading.Thread(target=self._read_frames,
+                                        args=(boundary,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next frame, waiting for it if necessary."""
+        with self._cond:
+            while not self._queue and not (self._eof or self._closed):
+                self._cond.wait()
+            if self._queue:
+                frame, key = self._queue.popleft()
+                if self._taken is not None:
+                    self._ring.release(self._taken)
+                self._taken = key
+                self._cond.notifyAll()
+                return frame
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            raise StopIteration
+
+    def close(self):
+        """Close the stream; buffered frames are discarded."""
+        with self._cond:
+            self._closed = True
+            if self._ring is not None:
+                for frame, key in self._queue:
+                    self._ring.release(key)
+                if self._taken is not None:
+                    self._ring.release(self._taken)
+                    self._taken = None
+            self._queue.clear()
+            self._cond.notifyAll()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+
+    def fps(self):
+        """Return the frame rate received over the last 30 frames."""
+        with self._cond:
+            if len(self._times) < 2:
+                return 0.0
+            span = self._times[-1] - self._times[0]
+            if span <= 0:
+                return 0.0
+            return (len(self._times) - 1) / span
+
+    def stats(self):
+        """Return a dict of frames, dropped, bytes, fps and queue depth."""
+        return {'frames': self.frames, 'dropped': self.dropped,
+                'bytes': self.bytes, 'fps': self.fps(),
+                'queued': len(self._queue)}
+
+    def _open(self, rovio_, page, timeout):
+        """Request the stream; return the socket, reader and part boundary."""
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        breaker = rovio_.breaker
+        if breaker is not None and not breaker.allow():
+            raise rovio.CircuitOpenError(rovio_)
+        lines = ['GET /%s HTTP/1.0' % page, 'Host: %s' % rovio_.host]
+        for item in rovio_._headers.items():
+            lines.append('%s: %s' % item)
+        try:
+            sock = socket.create_connection((rovio_.host, rovio_.port),
+                                            timeout)
+        except socket.error, e:
+            if breaker is not None:
+                breaker.failure()
+            raise rovio.ConnectError(rovio_, e)
+        try:
+            sock.sendall('\r\n'.join(lines) + '\r\n\r\n')
+            reader = _SocketReader(sock)
+            status_line = reader.readline()
+            header_lines = []
+            while True:
+                line = reader.readline()
+                if line.strip() == '':
+                    break
+                header_lines.append(line)
+        except socket.error, e:
+            sock.close()
+            if breaker is not None:
+                breaker.failure()
+            raise rovio.ConnectError(rovio_, e)
+        if breaker is not None:
+            breaker.success()
+        headers = mimetools.Message(StringIO.StringIO(''.join(header_lines)))
+        try:
+            version, status, reason = (status_line.split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            sock.close()
+            raise urllib2.URLError('bad status line: %r' % status_line)
+        if status != 200:
+            sock.close()
+            raise urllib2.HTTPError(rovio_._base_url + page, status,
+                                    reason.strip(), headers, None)
+        boundary = headers.getparam('boundary')
+        if not boundary:
+            sock.close()
+            raise rovio.RovioError('%s is not a multipart stream' % page)
+        return sock, reader, boundary.strip('"')
+
+    def _read_frames(self, boundary):
+        try:
+            for frame in _parse_multipart(self._reader, boundary,
+                                          self._ring):
+                if not self._put(frame):
+                    break
+        except socket.error, e:
+            if not self._closed:
+                if self._rovio.breaker is not None:
+                    self._rovio.breaker.failure()
+                self._error = rovio.ConnectError(self._rovio, e)
+        except Exception, e:
+            if not self._closed:
+                self._error = e
+        with self._cond:
+            self._eof = True
+            self._cond.notifyAll()
+
+    def _put(self, frame):
+        """Buffer a frame for the consumer; return False once closed."""
+        key = None if self._ring is None else self._ring.hold()
+        queued = False
+        try:
+            with self._cond:
+                self.frames += 1
+                self.bytes += len(frame)
+                self._times.append(time.time())
+                while (len(self._queue) >= self._buffer and
+                       not self._closed and self._policy == BLOCK):
+                    self._cond.wait()
+                if self._closed:
+                    return False
+                if len(self._queue) >= self._buffer:
+                    old, old_key = self._queue.popleft()
+                    if old_key is not None:
+                        self._ring.release(old_key)
+                    self.dropped += 1
+                self._queue.append((frame, key))
+                queued = True
+                self._cond.notifyAll()
+                return True
+        finally:
+            if key is not None and not queued:
+                self._ring.release(key)
+
+def _parse_multipart(reader, boundary, ring=None):
+    """
+    Generate the bodies of the parts of a multipart stream.
+
+    Parts with a Content-Length header are read directly (into the next
+    buffer of ring, if given); others are read up to the next boundary.
+
+    """
+    if boundary.startswith('--'):
+        delimiters = (boundary, '--' + boundary)
+    else:
+        delimiters = ('--' + boundary,)
+    # skip any preamble
+    while True:
+        line = reader.readline()
+        if not line:
+            return
+        line = line.strip()
+        if line in delimiters:
+            break
+        if line[:-2] in delimiters:
+            return
+    while True:
+        length = None
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            line = line.strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        if length is not None and ring is not None:
+            body = memoryview(ring.acquire(length))[:length]
+            if reader.readinto(body) < length:
+                return
+        elif length is not None:
+            body = reader.read(length)
+            if len(body) < length:
+                return
+        else:
+            body = reader.read_until('\r\n' + delimiters[-1])
+            if body is None:
+                return
+            if ring is not None:
+                body = ring.copy(body)
+        yield body
+        # find the next boundary, skipping the CRLF after the body
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            line = line.strip()
+            if line in delimiters:
+                break
+            if line[:-2] in delimiters:
+                return
+
+class _SocketReader(object):
+
+    """Buffered reading from a socket without copying the whole stream."""
+
+    def __init__(self, sock, bufsize=65536):
+        self._sock = sock
+        self._buf = bytearray(bufsize)
+        self._start = 0
+        self._end = 0
+
+    def readline(self, limit=8192):
+        """Return one line including its newline ('' at end of stream)."""
+        while True:
+            i = self._buf.find('\n', self._start, self._end)
+            if i >= 0:
+                return self._take(i + 1 - self._start)
+            if self._end - self._start >= limit or not self._fill():
+                return self._take(self._end - self._start)
+
+    def read(self, n):
+        """Return n bytes (fewer at end of stream)."""
+        while self._end - self._start < n:
+            if not self._fill(n):
+                break
+        return self._take(min(n, self._end - self._start))
+
+    def readinto(self, view):
+        """Fill memoryview view; return the number of bytes read."""
+        n = len(view)
+        got = min(n, self._end - self._start)
+        view[:got] = memoryview(self._buf)[self._start:self._start + got]
+        self._start += got
+        while got < n:
+            # receive the rest straight into the caller's buffer
+            received = self._sock.recv_into(view[got:])
+            if received == 0:
+                break
+            got += received
+        return got
+
+    def read_until(self, delimiter):
+        """Return the data before delimiter (None at end of stream)."""
+        searched = self._start
+        while True:
+            i = self._buf.find(delimiter, searched, self._end)
+            if i >= 0:
+                return self._take(i - self._start)
+            searched = max(self._start, self._end - len(delimiter) + 1)
+            offset = self._start
+            if not self._fill():
+                return None
+            searched -= offset - self._start
+
+    def _take(self, n):
+        data = str(self._buf[self._start:self._start + n])
+        self._start += n
+        return data
+
+    def _fill(self, need=0):
+        """Read more data into the buffer; return False at end of stream."""
+        if self._start > 0:
+            # move unread data to the front
+            size = self._end - self._start
+            self._buf[:size] = self._buf[self._start:self._end]
+            self._start, self._end = 0, size
+        if len(self._buf) - self._end < max(need - self._end, 4096):
+            self._buf.extend(bytearray(max(need, len(self._buf))))
+        n = self._sock.recv_into(memoryview(self._buf)[self._end:])
+        self._end += n
+        return n > 0
+
+#######################
+# TESTING AND SCRIPTS #
+#######################
+
+if __name__ == "__main__":
+    # a slow consumer of a fast stream keeps its frame intact
+    import simulator
+    server = simulator.StubServer()
+    server.framerate = 200
+    server.start()
+    r = rovio.Rovio('stub', server.host, port=server.port)
+    ring = FrameRing(slots=4)
+    stream = MJPEGStream(r, buffer=2, policy=DROP_OLDEST, ring=ring)
+    frame = next(stream)
+    frame[0:4] = 'TAG!'
+    time.sleep(0.2)
+    print stream.stats()
+    assert frame[0:4].tobytes() == 'TAG!' and stream.dropped > 0
+    assert next(stream)[0:4].tobytes() != 'TAG!'
+    stream.close()
+    stream._thread.join(1)
+    assert not ring._held, 'closed stream still holds %s' % ring._held
+    r.pool.close()
+    server.stop()
+    # a Rovio that accepts the connection and sends nothing
+    silent = socket.socket()
+    silent.bind(('127.0.0.1', 0))
+    silent.listen(8)
+    mute = rovio.Rovio('mute', '127.0.0.1', port=silent.getsockname()[1])
+    mute.timeout = 0.2
+    mute.breaker.threshold = 2
+    for i in range(2):
+        start = time.time()
+        try:
+            mute.stream_video()
+        except rovio.ConnectError, e:
+            print 'failed after %.2f s: %s' % (time.time() - start, e)
+    assert mute.breaker.state == rovio.CircuitBreaker.OPEN
+    try:
+        mute.stream_video()
+    except rovio.CircuitOpenError:
+        pass
+    else:
+        assert False, 'stream opened with the breaker open'
+    silent.close()